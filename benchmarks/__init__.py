@@ -0,0 +1,14 @@
+"""
+Бенчмарки конвейера на синтетических свечах.
+
+    python -m benchmarks.run --markets 170 --days 365 --output benchmark_results.json
+
+synthetic - детерминированные файлы coinbase_data.csv / binance_data.csv в схеме сборщиков,
+run - замеры стадий (слияние save_to_csv, combine_data, инкрементальный join_update, индикаторы,
+сообщение для веб-сервиса, рендер /) с записью времени и пикового потребления памяти в JSON.
+
+    python -m benchmarks.backfill --pairs 170 --days 365 --latency 0.05 --error-rate 0.01
+
+mock_exchange - локальный сервер с REST API Coinbase и Binance (синтетические или записанные
+свечи, задержка, ошибки, 429, заголовки веса), backfill - скорость fetch_all_pairs против него.
+"""
@@ -0,0 +1,184 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from datetime import timedelta
+from typing import Dict, List
+
+import pandas as pd
+
+from benchmarks.report import environment
+from benchmarks.synthetic import DEFAULT_END, coin_names
+from get_data_binance import BinanceDataFetcher
+from get_data_coinbase import CoinbaseDataFetcher
+from http_session import HttpSessionManager
+from ingest_buffer import IngestBuffer
+from rate_limiter import binance_rate_limiter, coinbase_rate_limiter
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Свечи не копятся в памяти за весь бэкфилл: буфер сбрасывается в счётчик каждые FLUSH_ROWS строк
+FLUSH_ROWS = 500_000
+
+# Без лимитов (--rate-scale 0) лимитеры сборщиков получают заведомо недостижимую скорость
+UNLIMITED_RATE = 1e9
+
+FETCHERS = {'coinbase': CoinbaseDataFetcher, 'binance': BinanceDataFetcher}
+
+
+class CandleCounter:
+    """flush_handler буфера: считает свечи и отбрасывает их"""
+
+    def __init__(self):
+        self.rows = 0
+        self.markets = set()
+
+    def __call__(self, df: pd.DataFrame) -> None:
+        self.rows += len(df)
+        self.markets.update(df['market'].unique())
+
+
+def start_mock(args, pairs: int) -> subprocess.Popen:
+    """Mock-сервер в отдельном процессе, чтобы его CPU не смешивался с замеряемым сборщиком"""
+    command = [sys.executable, '-m', 'benchmarks.mock_exchange', '--port', '0', '--markets', str(pairs),
+               '--seed', str(args.seed), '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--error-rate', str(args.error_rate), '--throttle-rate', str(args.throttle_rate),
+               '--retry-after', str(args.retry_after),
+               '--coinbase-rps', str(10 * args.rate_scale),
+               '--binance-weight-limit', str(6000 * args.rate_scale)]
+    if args.coinbase_file:
+        command += ['--coinbase-file', os.path.abspath(args.coinbase_file)]
+    if args.binance_file:
+        command += ['--binance-file', os.path.abspath(args.binance_file)]
+    return subprocess.Popen(command, cwd=REPO_ROOT, stdout=subprocess.PIPE, text=True)
+
+
+async def mock_stats(http: HttpSessionManager, url: str) -> Dict:
+    async with http.session.get(f"{url}/mock/stats") as response:
+        return await response.json()
+
+
+def make_limiter(exchange: str, rate_scale: float):
+    if exchange == 'coinbase':
+        return coinbase_rate_limiter(10 * rate_scale if rate_scale else UNLIMITED_RATE)
+    return binance_rate_limiter(6000 * rate_scale if rate_scale else UNLIMITED_RATE * 60)
+
+
+async def backfill(exchange: str, pairs: List[str], url: str, start, end, rate_scale: float,
+                   http: HttpSessionManager) -> Dict:
+    """fetch_all_pairs одной биржи против mock-сервера; пропускная способность по счётчикам сервера"""
+    limiter = make_limiter(exchange, rate_scale)
+    fetcher = FETCHERS[exchange](pairs, rate_limiter=limiter, session_manager=http, api_url=url)
+    counter = CandleCounter()
+    fetcher.buffer = IngestBuffer(max_rows=FLUSH_ROWS, flush_handler=counter)
+
+    before = (await mock_stats(http, url))[exchange]
+    started = time.perf_counter()
+    await fetcher.fetch_all_pairs(start_time=start, end_time=end)
+    elapsed = time.perf_counter() - started
+    counter(fetcher.buffer.drain())
+    after = (await mock_stats(http, url))[exchange]
+
+    requests = after['requests'] - before['requests']
+    status = {code: count - before['status'].get(code, 0) for code, count in after['status'].items()}
+    return {
+        'pairs': len(pairs),
+        'pairs_fetched': len(counter.markets),
+        'elapsed_s': round(elapsed, 3),
+        'requests': requests,
+        'requests_per_s': round(requests / elapsed, 1) if elapsed else None,
+        'candles': counter.rows,
+        'candles_per_s': round(counter.rows / elapsed, 1) if elapsed else None,
+        'status': {code: count for code, count in status.items() if count},
+        'throttled': limiter.throttled,
+        'failed_ranges': len(fetcher.pop_failed_ranges()),
+    }
+
+
+async def run_backfill(args) -> Dict:
+    end = pd.Timestamp(args.end, tz='UTC').to_pydatetime()
+    start = end - timedelta(days=args.days)
+    exchanges = ['coinbase', 'binance'] if args.exchange == 'both' else [args.exchange]
+    coins = coin_names(args.pairs)
+    pairs = {'coinbase': [f"{coin}-USD" for coin in coins], 'binance': [f"{coin}/USDT" for coin in coins]}
+
+    mock = start_mock(args, args.pairs)
+    http = HttpSessionManager(limit_per_host=args.connections)
+    try:
+        url = mock.stdout.readline().strip()
+        if not url:
+            raise RuntimeError("Mock exchange failed to start")
+        if args.coinbase_file or args.binance_file:
+            async with http.session.get(f"{url}/products") as response:
+                pairs['coinbase'] = [product['id'] for product in await response.json()]
+            async with http.session.get(f"{url}/api/v3/exchangeInfo") as response:
+                pairs['binance'] = [f"{s['baseAsset']}/{s['quoteAsset']}" for s in (await response.json())['symbols']]
+
+        results = {}
+        for exchange in exchanges:
+            print(f"Backfilling {len(pairs[exchange])} {exchange} pairs x {args.days:g} days...", file=sys.stderr)
+            # Сборщики печатают каждый ответ - на время замера вывод отбрасывается
+            with open(os.devnull, 'w') as devnull, \
+                    contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+                results[exchange] = await backfill(exchange, pairs[exchange], url, start, end,
+                                                   args.rate_scale, http)
+            r = results[exchange]
+            print(f"{exchange:<9} {r['elapsed_s']:>10.1f}s  {r['requests_per_s']:>8.1f} req/s  "
+                  f"{r['candles_per_s']:>10.0f} candles/s  429: {r['throttled']}  failed: {r['failed_ranges']}",
+                  file=sys.stderr)
+        results_http = http.stats()
+    finally:
+        await http.close()
+        mock.terminate()
+        mock.wait()
+
+    return {
+        'config': {'pairs': {exchange: len(pairs[exchange]) for exchange in exchanges}, 'days': args.days, 'end': args.end, 'seed': args.seed,
+                   'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+                   'throttle_rate': args.throttle_rate, 'rate_scale': args.rate_scale,
+                   'connections': args.connections,
+                   'recorded': bool(args.coinbase_file or args.binance_file)},
+        'environment': environment(),
+        'results': results,
+        'http': results_http,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Backfill throughput of the fetchers against a local mock exchange")
+    parser.add_argument('--pairs', type=int, default=170)
+    parser.add_argument('--days', type=float, default=365)
+    parser.add_argument('--end', default=DEFAULT_END, help="backfill end (UTC), fixed for reproducible runs")
+    parser.add_argument('--exchange', choices=['coinbase', 'binance', 'both'], default='both')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--latency', type=float, default=0.05, help="mock response latency, seconds")
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--rate-scale', type=float, default=1.0,
+                        help="multiplier for exchange limits on both sides; 0 - no limits (client overhead only)")
+    parser.add_argument('--connections', type=int, default=30, help="HTTP connections per host")
+    parser.add_argument('--coinbase-file', help="replay recorded candles (fetcher CSV schema)")
+    parser.add_argument('--binance-file')
+    parser.add_argument('--output', default='backfill_results.json')
+    parser.add_argument('--verbose', action='store_true', help="keep fetcher output and logging")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    results = asyncio.run(run_backfill(args))
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""
+Исходная реализация расчёта индикаторов (до группового прохода в DataCombiner._calculate_indicators),
+без изменений. Базовый случай python -m benchmarks.run: время против нового кода и проверка, что
+результаты совпадают.
+"""
+import pandas as pd
+
+
+def calculate_indicators(df: pd.DataFrame) -> pd.DataFrame:
+    """DataCombiner._calculate_indicators до группового прохода: группа за группой, растущий pd.concat"""
+
+    # Проверка наличия нужных столбцов
+    required_columns = [
+        'market', 'timestamp_coinbase', 'timestamp_binance', 
+        'close_price_coinbase', 'close_price_binance', 'volume_coinbase', 'volume_binance'
+    ]
+
+    missing_columns = [col for col in required_columns if col not in df.columns]
+
+    if missing_columns:
+        print(f"Warning: Missing columns: {missing_columns}")
+        return pd.DataFrame()  # Возвращаем пустой DataFrame, если данных недостаточно
+
+    def calculate_for_group(group):
+        group = group.sort_values('timestamp_coinbase')  # Сортировка по времени
+        group = group.set_index('timestamp_coinbase')  # Устанавливаем timestamp_coinbase как индекс
+
+        # Премии
+        group['Coinbase Premium'] = group['close_price_coinbase'] - group['close_price_binance']
+        group['Coinbase Premium %'] = (group['Coinbase Premium'] / group['close_price_binance']) * 100
+
+        # Скользящие метрики
+        rolling_intervals = {
+            '1H': '60min', 
+            '24H': '1D', 
+            '1M': '30D',
+            '1Y': '365D'  # Добавляем годовой интервал
+        }
+
+        for label, period in rolling_intervals.items():
+            # Используем shift(-1) перед расчетом скользящих средних
+            shifted_premium = group['Coinbase Premium'].shift(-1)
+            shifted_premium_pct = group['Coinbase Premium %'].shift(-1)
+
+            group[f'Avg {label} Premium Diff'] = (
+                shifted_premium
+                .rolling(window=period, min_periods=1)
+                .median()
+            )
+            group[f'Avg {label} Premium %'] = (
+                shifted_premium_pct
+                .rolling(window=period, min_periods=1)
+                .median()
+            )
+            group[f'Current Diff {label}'] = group['Coinbase Premium'] - group[f'Avg {label} Premium Diff']
+            group[f'Current % {label}'] = group['Coinbase Premium %'] - group[f'Avg {label} Premium %']
+
+        # Модифицируем расчет объемов
+        shifted_volume = group['volume_coinbase'].shift(-1)
+
+        group['Avg 1H Volume'] = (
+            shifted_volume
+            .rolling(window='60min', min_periods=1)
+            .median()
+        )
+
+        group['Avg 24H Volume'] = (
+            shifted_volume
+            .rolling(window='1D', min_periods=1)
+            .median()
+        )
+
+        group['Avg 1M Volume'] = (
+            shifted_volume
+            .rolling(window='30D', min_periods=1)
+            .median()
+        )
+
+        group['Avg 1Y Volume'] = (
+            shifted_volume
+            .rolling(window='365D', min_periods=1)
+            .median()
+        )
+
+        group['Coinbase Volume Diff %'] = (
+            (shifted_volume - group['Avg 1H Volume']) / group['Avg 1H Volume'] * 100
+        )
+
+        # Перепишем таблицу с нужной структурой
+        result = pd.DataFrame({
+            'DateTime': group.index,
+            'Coin': group['market'],
+            'Price @ Coinbase': group['close_price_coinbase'],
+            'Price @ Binance': group['close_price_binance'],
+        #    'coinbase Premium': group['coinbase Premium'],
+            'Coinbase Premium %': group['Coinbase Premium %'],
+        #    'Avg 1H Premium Diff': group['Avg 1H Premium Diff'],
+            'Avg 1H Premium %': group['Avg 1H Premium %'],
+        #    'Current Diff 1H': group['Current Diff 1H'],
+            'Current % 1H': group['Current % 1H'],
+        #    'Avg 24H Premium Diff': group['Avg 24H Premium Diff'],
+            'Avg 24H Premium %': group['Avg 24H Premium %'],
+        #    'Current Diff 24H': group['Current Diff 24H'],
+            'Current % 24H': group['Current % 24H'],
+        #    'Avg 1M Premium Diff': group['Avg 1M Premium Diff'],
+            'Avg 1M Premium %': group['Avg 1M Premium %'],
+        #    'Current Diff 1M': group['Current Diff 1M'],
+            'Current % 1M': group['Current % 1M'],
+        #    'Avg 1Y Premium Diff': group['Avg 1Y Premium Diff'],  # Добавляем годовые метрики
+            'Avg 1Y Premium %': group['Avg 1Y Premium %'],
+         #   'Current Diff 1Y': group['Current Diff 1Y'],
+            'Current % 1Y': group['Current % 1Y'],
+            'Current Volume': group['volume_coinbase'],
+            'Avg 1H Volume': group['Avg 1H Volume'],
+            'Avg 24H Volume': group['Avg 24H Volume'],
+            'Avg 1M Volume': group['Avg 1M Volume'],
+            'Avg 1Y Volume': group['Avg 1Y Volume'],  # Добавляем годовой объем
+            'Coinbase Volume Diff %': group['Coinbase Volume Diff %']
+        })
+
+        return result
+
+    # Инициализация итогового DataFrame со всеми колонками, включая новые годовые
+    result_df = pd.DataFrame(columns=[
+        'DateTime', 'Coin', 'Price @ Coinbase', 'Price @ Binance',
+        'Coinbase Premium %', 'Avg 1H Premium %',
+        'Current % 1H', 'Avg 24H Premium %',
+        'Current % 24H', 'Avg 1M Premium %',
+        'Current % 1M','Avg 1Y Premium %',  
+        'Current % 1Y', 'Current Volume', 
+        'Avg 1H Volume','Avg 24H Volume', 
+        'Avg 1M Volume', 'Avg 1Y Volume', 
+        'Coinbase Volume Diff %'
+    ])
+
+    # Применяем функцию к каждой группе по токенам и добавляем к итоговому DataFrame
+    grouped_df = df.groupby('market')
+
+    for name, group in grouped_df:
+        group_result = calculate_for_group(group)
+
+        if group_result.empty:
+            print(f"Warning: Group for {name} resulted in an empty DataFrame.")
+
+        result_df = pd.concat([result_df, group_result], ignore_index=True)
+
+    return format_indicators(result_df)
+
+def format_indicators(result_df: pd.DataFrame) -> pd.DataFrame:
+    """Округление, форматирование объемов и сортировка итоговой таблицы"""
+    price_columns = [
+        'Price @ Coinbase', 'Price @ Binance'
+    ]
+
+    percentage_columns = [
+        'Coinbase Premium %', 'Avg 1H Premium %',
+        'Current % 1H', 'Avg 24H Premium %',
+        'Current % 24H', 'Avg 1M Premium %',
+        'Current % 1M', 'Avg 1Y Premium %',
+        'Current % 1Y', 'Coinbase Volume Diff %'
+    ]
+
+    volume_columns = [
+        'Current Volume', 'Avg 1H Volume',
+        'Avg 24H Volume', 'Avg 1M Volume',
+        'Avg 1Y Volume'
+    ]
+
+    # Применяем форматирование к разным типам колонок
+    for col in price_columns:
+        if col in result_df.columns:
+            result_df[col] = result_df[col].round(8)  # Цены округляем до 8 знаков
+
+    for col in percentage_columns:
+        if col in result_df.columns:
+            result_df[col] = result_df[col].round(2)  # Проценты округляем до 2 знаков
+
+    for col in volume_columns:
+        if col in result_df.columns:
+            result_df[col] = result_df[col].apply(convert_volume)  # Убираем lambda и float()
+
+    result_df = result_df.sort_values(['DateTime', 'Coin'])
+    result_df['DateTime'] = result_df['DateTime'].apply(lambda x: str(x)[:16])
+    return result_df
+
+
+def convert_volume(value: float) -> str:
+    """
+    Конвертирует числовые значения в формат с суффиксами К, М, В
+    """
+    if value >= 1_000_000_000:  # миллиарды
+        return f"{value/1_000_000_000:.2f}B"
+    elif value >= 1_000_000:     # миллионы
+        return f"{value/1_000_000:.2f}M"
+    elif value >= 1_000:         # тысячи
+        return f"{value/1_000:.2f}K"
+    else:
+        return f"{value:.2f}"
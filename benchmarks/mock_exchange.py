@@ -0,0 +1,382 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+from benchmarks.synthetic import coin_names
+
+logger = logging.getLogger(__name__)
+
+CANDLE_SECONDS = 300
+
+# Лимиты API, которые воспроизводит сервер
+COINBASE_MAX_CANDLES = 300
+BINANCE_MAX_LIMIT = 1000
+BINANCE_WEIGHTS = {'/api/v3/klines': 2, '/api/v3/exchangeInfo': 20}
+
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def _hash_uniform(index: np.ndarray, salt: int) -> np.ndarray:
+    """Детерминированный шум [0, 1) по номеру свечи (splitmix64) - без хранения ряда в памяти"""
+    x = index.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) + np.uint64(salt & 0xFFFFFFFFFFFFFFFF)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    x = (x ^ (x >> np.uint64(31))) & _MASK64
+    return (x >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
+
+class SyntheticCandles:
+    """
+    Синтетические свечи на любой период: цена - гладкая функция времени плюс шум
+    по номеру свечи, поэтому один и тот же запрос всегда возвращает одни и те же данные.
+    Рынки SYN000..: на Coinbase SYN000-USD, на Binance SYN000/USDT (премия ~0.1%).
+    """
+
+    def __init__(self, markets: int = 170, seed: int = 42, gap_rate: float = 0.005):
+        self.coins = coin_names(markets)
+        self.gap_rate = gap_rate
+        rng = np.random.default_rng(seed)
+        self.base_price = dict(zip(self.coins, np.exp(rng.uniform(-6, 10, markets))))
+        self.phases = dict(zip(self.coins, rng.uniform(0, 2 * np.pi, (markets, 3))))
+        self.salts = dict(zip(self.coins, rng.integers(0, 2 ** 62, (markets, 4)).tolist()))
+
+    def markets(self, exchange: str) -> List[str]:
+        if exchange == 'coinbase':
+            return [f"{coin}-USD" for coin in self.coins]
+        return [f"{coin}/USDT" for coin in self.coins]
+
+    def _coin(self, exchange: str, pair: str) -> Optional[str]:
+        coin, _, quote = pair.partition('-' if exchange == 'coinbase' else '/')
+        expected = 'USD' if exchange == 'coinbase' else 'USDT'
+        return coin if quote == expected and coin in self.base_price else None
+
+    def _price(self, coin: str, index: np.ndarray) -> np.ndarray:
+        t = index.astype(np.float64) * CANDLE_SECONDS
+        month, day, _ = self.phases[coin]
+        noise = _hash_uniform(index, self.salts[coin][0]) - 0.5
+        return self.base_price[coin] * np.exp(0.1 * np.sin(2 * np.pi * t / (30 * 86400) + month)
+                                              + 0.02 * np.sin(2 * np.pi * t / 86400 + day)
+                                              + 0.004 * noise)
+
+    def candles(self, exchange: str, pair: str, start: int, end: int) -> Optional[Dict[str, np.ndarray]]:
+        """Свечи с временем открытия в [start, end] (секунды), по возрастанию; None - нет такого рынка"""
+        coin = self._coin(exchange, pair)
+        if coin is None:
+            return None
+        index = np.arange(-(-start // CANDLE_SECONDS), end // CANDLE_SECONDS + 1, dtype=np.int64)
+        # Пропуски на биржах независимы
+        gap_salt = self.salts[coin][1 if exchange == 'coinbase' else 2]
+        index = index[_hash_uniform(index, gap_salt) >= self.gap_rate]
+
+        close = self._price(coin, index)
+        opening = self._price(coin, index - 1)
+        if exchange == 'binance':
+            premium = 0.0005 + 0.001 * np.sin(2 * np.pi * index * CANDLE_SECONDS / (7 * 86400)
+                                              + self.phases[coin][2])
+            close, opening = close / (1 + premium), opening / (1 + premium)
+        spread = 0.001 * _hash_uniform(index, self.salts[coin][3])
+        volume = np.exp(3 + 2 * _hash_uniform(index, self.salts[coin][3] + 1))
+        if exchange == 'binance':
+            volume = volume * 3
+        return {
+            'time': index * CANDLE_SECONDS,
+            'open': opening,
+            'high': np.maximum(opening, close) * (1 + spread),
+            'low': np.minimum(opening, close) * (1 - spread),
+            'close': close,
+            'volume': volume,
+            'quote_volume': volume * close,
+        }
+
+
+class RecordedCandles:
+    """Свечи из файлов в схеме сборщиков (coinbase_data.csv, binance_data.csv)"""
+
+    def __init__(self, coinbase_file: Optional[str] = None, binance_file: Optional[str] = None):
+        self.series: Dict[str, Dict[str, Dict[str, np.ndarray]]] = {'coinbase': {}, 'binance': {}}
+        for exchange, path in (('coinbase', coinbase_file), ('binance', binance_file)):
+            if path is None:
+                continue
+            df = pd.read_csv(path, parse_dates=['candle_date_time_utc'])
+            df = df.sort_values(['market', 'candle_date_time_utc']).drop_duplicates(
+                subset=['market', 'candle_date_time_utc'], keep='last')
+            for market, group in df.groupby('market', sort=False):
+                close = group['close_price'].to_numpy(np.float64)
+                volume = group['volume'].to_numpy(np.float64)
+                if exchange == 'coinbase':
+                    # Сборщик хранит объём Coinbase в котируемой валюте (объём API * close)
+                    quote_volume, volume = volume, volume / close
+                else:
+                    quote_volume = group['quote_volume'].to_numpy(np.float64)
+                self.series[exchange][market] = {
+                    'time': group['candle_date_time_utc'].to_numpy().view(np.int64) // 1_000_000_000,
+                    'open': group['opening_price'].to_numpy(np.float64),
+                    'high': group['high_price'].to_numpy(np.float64),
+                    'low': group['low_price'].to_numpy(np.float64),
+                    'close': close,
+                    'volume': volume,
+                    'quote_volume': quote_volume,
+                }
+
+    def markets(self, exchange: str) -> List[str]:
+        return sorted(self.series[exchange])
+
+    def candles(self, exchange: str, pair: str, start: int, end: int) -> Optional[Dict[str, np.ndarray]]:
+        series = self.series[exchange].get(pair)
+        if series is None:
+            return None
+        lo = int(np.searchsorted(series['time'], start, side='left'))
+        hi = int(np.searchsorted(series['time'], end, side='right'))
+        return {col: values[lo:hi] for col, values in series.items()}
+
+
+class MockExchange:
+    """
+    Локальный aiohttp-сервер вместо Coinbase (/products, /products/{id}/candles) и
+    Binance (/api/v3/exchangeInfo, /api/v3/klines) для офлайн-прогонов сборщиков.
+
+    Воспроизводит лимиты бирж (запросы в секунду Coinbase, вес за минуту Binance с
+    заголовком X-MBX-USED-WEIGHT-1M и Retry-After на 429) и вносит задержку, случайные
+    5xx и 429 с заданной вероятностью (seed - для воспроизводимости). Счётчики по
+    биржам отдаются stats() и GET /mock/stats.
+    """
+
+    def __init__(self, source, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, retry_after: float = 1.0, coinbase_rps: Optional[float] = 10,
+                 coinbase_burst: Optional[float] = None, binance_weight_limit: Optional[float] = 6000,
+                 seed: int = 0):
+        self.source = source
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        # None - лимит не проверяется
+        # Coinbase: coinbase_rps запросов в секунду со всплесками до coinbase_burst (по умолчанию 1.5x)
+        self.coinbase_rps = coinbase_rps
+        self.coinbase_burst = coinbase_burst or (coinbase_rps * 1.5 if coinbase_rps else None)
+        self.binance_weight_limit = binance_weight_limit
+        self.random = random.Random(seed)
+
+        self._coinbase_tokens = self.coinbase_burst
+        self._coinbase_updated = time.monotonic()
+        self._weight_minute = None
+        self._weight_used = 0
+        self.counters = {exchange: {'requests': 0, 'candles': 0, 'status': Counter()}
+                         for exchange in ('coinbase', 'binance')}
+        self.started_at = None
+        self.url = None
+        self._runner = None
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get('/products', self._coinbase_products)
+        app.router.add_get('/products/{product_id}/candles', self._coinbase_candles)
+        app.router.add_get('/api/v3/exchangeInfo', self._binance_exchange_info)
+        app.router.add_get('/api/v3/klines', self._binance_klines)
+        app.router.add_get('/mock/stats', self._stats)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Запускает сервер (port=0 - свободный порт) и возвращает базовый URL для api_url сборщиков"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        self.started_at = time.monotonic()
+        logger.info(f"Mock exchange listening on {self.url}")
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def stats(self) -> Dict[str, Dict]:
+        return {exchange: {'requests': c['requests'], 'candles': c['candles'],
+                           'status': {str(code): count for code, count in sorted(c['status'].items())}}
+                for exchange, c in self.counters.items()}
+
+    # --- лимиты и ошибки ---
+
+    def _roll_weight_minute(self) -> None:
+        """Вес Binance считается по календарным минутам"""
+        minute = int(time.time() // 60)
+        if minute != self._weight_minute:
+            self._weight_minute, self._weight_used = minute, 0
+
+    def _limit_response(self, exchange: str, path: str) -> Optional[web.Response]:
+        """429 при превышении лимита биржи; иначе запрос учитывается в лимите"""
+        if exchange == 'coinbase':
+            if self.coinbase_rps is None:
+                return None
+            now = time.monotonic()
+            self._coinbase_tokens = min(self.coinbase_burst,
+                                        self._coinbase_tokens + (now - self._coinbase_updated) * self.coinbase_rps)
+            self._coinbase_updated = now
+            if self._coinbase_tokens < 1:
+                return web.json_response({'message': 'Public rate limit exceeded'}, status=429)
+            self._coinbase_tokens -= 1
+            return None
+
+        self._roll_weight_minute()
+        weight = BINANCE_WEIGHTS.get(path, 1)
+        if self.binance_weight_limit is not None and self._weight_used + weight > self.binance_weight_limit:
+            retry_after = max(1, int(60 - time.time() % 60))
+            return web.json_response({'code': -1003, 'msg': 'Too much request weight used'}, status=429,
+                                     headers={'Retry-After': str(retry_after)})
+        self._weight_used += weight
+        return None
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        if request.path.startswith('/mock/'):
+            return await handler(request)
+        exchange = 'binance' if request.path.startswith('/api/') else 'coinbase'
+        counters = self.counters[exchange]
+        counters['requests'] += 1
+
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self.random.uniform(0, self.jitter))
+
+        response = self._limit_response(exchange, request.path)
+        if response is None and self.random.random() < self.throttle_rate:
+            response = web.json_response({'message': 'Injected throttle'}, status=429,
+                                         headers={'Retry-After': f"{self.retry_after:g}"})
+        if response is None and self.random.random() < self.error_rate:
+            response = web.json_response({'message': 'Injected error'}, status=self.random.choice((500, 502, 503)))
+        if response is None:
+            response = await handler(request)
+            counters['candles'] += request.get('candles', 0)
+
+        if exchange == 'binance':
+            response.headers['X-MBX-USED-WEIGHT-1M'] = str(self._weight_used)
+        counters['status'][response.status] += 1
+        return response
+
+    # --- Coinbase ---
+
+    async def _coinbase_products(self, request: web.Request) -> web.Response:
+        products = []
+        for pair in self.source.markets('coinbase'):
+            base, _, quote = pair.partition('-')
+            products.append({'id': pair, 'base_currency': base, 'quote_currency': quote,
+                             'status': 'online', 'trading_disabled': False})
+        return web.json_response(products)
+
+    async def _coinbase_candles(self, request: web.Request) -> web.Response:
+        try:
+            start = int(pd.Timestamp(request.query['start']).timestamp())
+            end = int(pd.Timestamp(request.query['end']).timestamp())
+            granularity = int(request.query.get('granularity', CANDLE_SECONDS))
+        except (KeyError, ValueError):
+            return web.json_response({'message': 'Invalid start/end/granularity'}, status=400)
+        if granularity != CANDLE_SECONDS:
+            return web.json_response({'message': 'Only granularity=300 is served'}, status=400)
+        if (end - start) // granularity + 1 > COINBASE_MAX_CANDLES:
+            return web.json_response({'message': 'granularity too small for the requested time range'},
+                                     status=400)
+
+        candles = self.source.candles('coinbase', request.match_info['product_id'], start, end)
+        if candles is None:
+            return web.json_response({'message': 'NotFound'}, status=404)
+        request['candles'] = len(candles['time'])
+        # [time, low, high, open, close, volume], новые свечи первыми
+        rows = np.column_stack([candles['time'], candles['low'], candles['high'], candles['open'],
+                                candles['close'], candles['volume']])[::-1].tolist()
+        for row in rows:
+            row[0] = int(row[0])
+        return web.Response(text=json.dumps(rows), content_type='application/json')
+
+    # --- Binance ---
+
+    def _binance_pairs(self) -> Dict[str, str]:
+        return {pair.replace('/', ''): pair for pair in self.source.markets('binance')}
+
+    async def _binance_exchange_info(self, request: web.Request) -> web.Response:
+        symbols = []
+        for symbol, pair in self._binance_pairs().items():
+            base, _, quote = pair.partition('/')
+            symbols.append({'symbol': symbol, 'status': 'TRADING', 'baseAsset': base, 'quoteAsset': quote})
+        return web.json_response({'timezone': 'UTC', 'symbols': symbols})
+
+    async def _binance_klines(self, request: web.Request) -> web.Response:
+        pair = self._binance_pairs().get(request.query.get('symbol', ''))
+        if pair is None:
+            return web.json_response({'code': -1121, 'msg': 'Invalid symbol.'}, status=400)
+        try:
+            start = int(request.query.get('startTime', 0)) // 1000
+            end = int(request.query.get('endTime', int(time.time() * 1000))) // 1000
+            limit = min(int(request.query.get('limit', 500)), BINANCE_MAX_LIMIT)
+        except ValueError:
+            return web.json_response({'code': -1100, 'msg': 'Illegal characters found in parameter.'}, status=400)
+
+        candles = {col: values[:limit].tolist()
+                   for col, values in self.source.candles('binance', pair, start, end).items()}
+        request['candles'] = len(candles['time'])
+        # Цены и объёмы Binance отдаёт строками
+        rows = [[t * 1000, repr(o), repr(h), repr(l), repr(c), repr(v), (t + CANDLE_SECONDS) * 1000 - 1, repr(q),
+                 0, '0', '0', '0']
+                for t, o, h, l, c, v, q in zip(candles['time'], candles['open'], candles['high'], candles['low'],
+                                               candles['close'], candles['volume'], candles['quote_volume'])]
+        return web.Response(text=json.dumps(rows), content_type='application/json')
+
+    async def _stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats())
+
+
+async def serve(exchange: MockExchange, host: str, port: int) -> None:
+    url = await exchange.start(host, port)
+    # Первая строка вывода - адрес для api_url (её читает benchmarks.backfill)
+    print(url, flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await exchange.stop()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Local Coinbase/Binance REST stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090, help="0 - any free port")
+    parser.add_argument('--markets', type=int, default=170, help="synthetic markets")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--coinbase-file', help="serve recorded candles (fetcher CSV schema) instead of synthetic")
+    parser.add_argument('--binance-file')
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="extra random latency, seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of 5xx responses")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="share of injected 429 responses")
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    parser.add_argument('--coinbase-rps', type=float, default=10, help="0 - no limit")
+    parser.add_argument('--binance-weight-limit', type=float, default=6000, help="per minute, 0 - no limit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.coinbase_file or args.binance_file:
+        source = RecordedCandles(args.coinbase_file, args.binance_file)
+    else:
+        source = SyntheticCandles(args.markets, seed=args.seed)
+    exchange = MockExchange(source, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            throttle_rate=args.throttle_rate, retry_after=args.retry_after,
+                            coinbase_rps=args.coinbase_rps or None,
+                            binance_weight_limit=args.binance_weight_limit or None, seed=args.seed)
+    try:
+        asyncio.run(serve(exchange, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from aiohttp import WSMsgType, web
+
+logger = logging.getLogger(__name__)
+
+CANDLE_MS = 300_000
+
+
+def binance_kline(pair: str, start: datetime, open_: float, high: float, low: float, close: float,
+                  volume: float, closed: bool = True) -> dict:
+    """Событие <symbol>@kline_5m в формате Binance (цены и объёмы строками)"""
+    symbol = pair.replace('/', '')
+    start_ms = int(start.timestamp() * 1000)
+    return {
+        'e': 'kline', 'E': start_ms + CANDLE_MS, 's': symbol,
+        'k': {
+            't': start_ms, 'T': start_ms + CANDLE_MS - 1, 's': symbol, 'i': '5m',
+            'o': str(open_), 'h': str(high), 'l': str(low), 'c': str(close),
+            'v': str(volume), 'q': str(volume * close), 'x': closed,
+        },
+    }
+
+
+def coinbase_match(pair: str, price: float, size: float, traded_at: datetime, trade_id: int = 1) -> dict:
+    """Сообщение канала matches Coinbase Exchange"""
+    return {
+        'type': 'match', 'trade_id': trade_id, 'product_id': pair, 'side': 'buy',
+        'price': str(price), 'size': str(size),
+        'time': traded_at.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+    }
+
+
+class MockStreamServer:
+    """
+    Локальная замена WebSocket API бирж: /binance/ws (kline) и /coinbase (matches).
+
+    Сервер ничего не генерирует сам: тест отправляет события через publish() и обрывает
+    соединения через drop(), проверяя разбор свечей, переподключение и повторную подписку.
+    Каждое сообщение подписки запоминается в subscriptions[exchange].
+    """
+
+    def __init__(self):
+        self.url: Optional[str] = None
+        self.clients: Dict[str, List[web.WebSocketResponse]] = {'binance': [], 'coinbase': []}
+        self.subscriptions: Dict[str, List[dict]] = {'binance': [], 'coinbase': []}
+        self.connects: Dict[str, int] = {'binance': 0, 'coinbase': 0}
+        self._subscribed = asyncio.Condition()
+        self._runner: Optional[web.AppRunner] = None
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/binance/ws', self._binance)
+        app.router.add_get('/coinbase', self._coinbase)
+        return app
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Запускает сервер (port=0 - свободный порт) и возвращает базовый ws:// URL"""
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"ws://{host}:{port}"
+        logger.info(f"Mock stream server listening on {self.url}")
+        return self.url
+
+    def stream_url(self, exchange: str) -> str:
+        """Адрес для url= потока CandleStream"""
+        return f"{self.url}/binance/ws" if exchange == 'binance' else f"{self.url}/coinbase"
+
+    async def stop(self) -> None:
+        await self.drop()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def publish(self, exchange: str, message: dict) -> None:
+        """Отправляет событие всем подписанным клиентам биржи"""
+        for ws in list(self.clients[exchange]):
+            await ws.send_json(message)
+
+    async def drop(self, exchange: Optional[str] = None) -> None:
+        """Закрывает соединения со стороны сервера (обрыв потока)"""
+        for name in [exchange] if exchange else list(self.clients):
+            for ws in list(self.clients[name]):
+                await ws.close()
+
+    async def wait_subscribed(self, exchange: str, count: int, timeout: float = 5.0) -> None:
+        """Ждёт count-й подписки по бирже (первое подключение - 1, после обрыва - 2 и т.д.)"""
+        async with self._subscribed:
+            await asyncio.wait_for(
+                self._subscribed.wait_for(lambda: len(self.subscriptions[exchange]) >= count), timeout)
+
+    async def _binance(self, request: web.Request) -> web.WebSocketResponse:
+        return await self._handle('binance', request)
+
+    async def _coinbase(self, request: web.Request) -> web.WebSocketResponse:
+        return await self._handle('coinbase', request)
+
+    async def _handle(self, exchange: str, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.connects[exchange] += 1
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                message = msg.json()
+                if exchange == 'binance' and message.get('method') == 'SUBSCRIBE':
+                    await ws.send_json({'result': None, 'id': message.get('id')})
+                elif exchange == 'coinbase' and message.get('type') == 'subscribe':
+                    await ws.send_json({'type': 'subscriptions', 'channels': [
+                        {'name': name, 'product_ids': message.get('product_ids', [])}
+                        for name in message.get('channels', [])]})
+                else:
+                    continue
+                # Клиент получает события только после подписки, как у бирж
+                if ws not in self.clients[exchange]:
+                    self.clients[exchange].append(ws)
+                async with self._subscribed:
+                    self.subscriptions[exchange].append(message)
+                    self._subscribed.notify_all()
+        finally:
+            if ws in self.clients[exchange]:
+                self.clients[exchange].remove(ws)
+        return ws
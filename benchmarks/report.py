@@ -0,0 +1,28 @@
+import os
+import platform
+import subprocess
+from datetime import datetime, timezone
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+import push_protocol
+
+
+def environment() -> Dict:
+    info = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'push_formats': push_protocol.supported_formats(),
+    }
+    try:
+        info['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                        text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
@@ -0,0 +1,262 @@
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+import push_protocol
+from candle_join import CandleJoin
+from candle_store import CandleStore
+from data_combiner import DataCombiner
+from get_data_binance import BinanceDataFetcher
+from get_data_coinbase import CoinbaseDataFetcher
+from benchmarks import baseline_indicators
+from benchmarks.report import environment
+from benchmarks.synthetic import SyntheticConfig, coin_names, generate
+
+# Допустимый рост времени/памяти стадии относительно базового прогона (--baseline)
+DEFAULT_TOLERANCE = 0.25
+
+# Стадии короче этого не сравниваются по времени: разброс больше самого замера
+MIN_COMPARED_SECONDS = 0.05
+
+
+def _read_status_kb(field: str) -> Optional[int]:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss() -> bool:
+    """Сбрасывает пик RSS процесса (Linux, /proc/self/clear_refs); False - сброс недоступен"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss_kb() -> int:
+    peak = _read_status_kb('VmHWM')
+    if peak is not None:
+        return peak
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage // 1024 if sys.platform == 'darwin' else usage  # macOS отдаёт байты
+
+
+class StageRunner:
+    """
+    Замер стадий: время (perf_counter), пик RSS за стадию и, по желанию, пик
+    выделений Python (tracemalloc; заметно замедляет код с большим числом мелких объектов,
+    поэтому время с ним несравнимо с обычным прогоном).
+    """
+
+    def __init__(self, trace_allocations: bool = False):
+        self.trace_allocations = trace_allocations
+        self.results: List[Dict] = []
+
+    def measure(self, name: str, func: Callable, *args, **kwargs):
+        gc.collect()
+        scoped = _reset_peak_rss()
+        rss_before = _read_status_kb('VmRSS')
+        if self.trace_allocations:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        wall = time.perf_counter() - start
+
+        record = {
+            'name': name,
+            'wall_s': round(wall, 4),
+            'peak_rss_mb': round(_peak_rss_kb() / 1024, 1),
+            # stage - пик именно этой стадии, process - пик процесса с начала запуска
+            'peak_rss_scope': 'stage' if scoped else 'process',
+        }
+        if rss_before is not None:
+            record['rss_before_mb'] = round(rss_before / 1024, 1)
+        if self.trace_allocations:
+            record['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            tracemalloc.stop()
+        if isinstance(result, pd.DataFrame):
+            record['rows'] = len(result)
+
+        self.results.append(record)
+        print(f"{name:<30} {wall:>9.3f}s  peak RSS {record['peak_rss_mb']:>9.1f} MB")
+        return result
+
+
+def _merge(fetcher, update: pd.DataFrame) -> None:
+    asyncio.run(fetcher.buffer.put(update))
+    fetcher.save_to_csv()
+
+
+def _primed_join(paths: Dict[str, str]) -> CandleJoin:
+    """CandleJoin с окном в памяти по последним суткам истории, как после старта main.py"""
+    join = CandleJoin(CandleStore('candles'), CandleStore('joined_candles'))
+    frames = {}
+    for exchange in ('coinbase', 'binance'):
+        df = pd.read_csv(paths[exchange], parse_dates=['candle_date_time_utc'])
+        frames[exchange] = join._keyed(exchange, df[df['candle_date_time_utc'] >= df['candle_date_time_utc'].max()
+                                                    - pd.Timedelta(days=1)])
+    join._join(frames['coinbase'], frames['binance'], complete=True)
+    return join
+
+
+def _payload(combiner: DataCombiner) -> Dict[str, int]:
+    """Сообщение полной синхронизации, как в send_to_web_service; размер в каждом формате"""
+    latest = combiner._latest_rows()
+    message = push_protocol.make_message(1, 0, list(latest.values()), full=True)
+    return {content_type: len(push_protocol.encode(message, content_type))
+            for content_type in push_protocol.supported_formats()}
+
+
+def _render(client, headers=None):
+    response = client.get('/', headers=headers or {})
+    if response.status_code not in (200, 304):
+        raise RuntimeError(f"GET / returned {response.status_code}")
+    return response
+
+
+def _check_baseline(indicators: pd.DataFrame, baseline: pd.DataFrame) -> None:
+    """Новый расчёт индикаторов должен давать ровно то же, что исходный"""
+    pd.testing.assert_frame_equal(indicators.reset_index(drop=True), baseline.reset_index(drop=True),
+                                  check_exact=True)
+
+
+def run_benchmarks(config: SyntheticConfig, data_dir: str, workers: int = 1,
+                   rank_error: Optional[float] = None, trace_allocations: bool = False,
+                   baseline: bool = True) -> Dict:
+    runner = StageRunner(trace_allocations)
+    paths = runner.measure('generate', generate, config, data_dir)
+    coinbase_update = pd.read_csv(paths['coinbase_update'], parse_dates=['candle_date_time_utc'])
+    binance_update = pd.read_csv(paths['binance_update'], parse_dates=['candle_date_time_utc'])
+
+    coins = coin_names(config.markets)
+    cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='benchmark-')
+    combiner = DataCombiner(rank_error=rank_error, workers=workers)
+    try:
+        # save_to_csv работает с файлами в текущем каталоге - сливаем в копии истории
+        shutil.copy(paths['coinbase'], os.path.join(work_dir, 'coinbase_data.csv'))
+        shutil.copy(paths['binance'], os.path.join(work_dir, 'binance_data.csv'))
+        os.chdir(work_dir)
+
+        coinbase = CoinbaseDataFetcher([f"{coin}-USD" for coin in coins])
+        binance = BinanceDataFetcher([f"{coin}/USDT" for coin in coins])
+        runner.measure('save_to_csv_coinbase', _merge, coinbase, coinbase_update)
+        runner.measure('save_to_csv_binance', _merge, binance, binance_update)
+
+        combined = runner.measure('combine_data', combiner.combine_data, 'coinbase_data.csv', 'binance_data.csv')
+        # Инкрементальное объединение той же порции; подготовка окна в замер не входит
+        join = _primed_join(paths)
+        runner.measure('join_update', join.update, coinbase_update, binance_update)
+        del join
+        indicators = runner.measure('calculate_indicators', combiner._calculate_indicators, combined)
+        if baseline:
+            # Исходная реализация (группа за группой); с --rank-error медианы приближённые и не сравниваются
+            expected = runner.measure('calculate_indicators_baseline', baseline_indicators.calculate_indicators,
+                                      combined)
+            if rank_error is None:
+                _check_baseline(indicators, expected)
+            del expected
+        del combined
+        combiner.processed_data = indicators
+        sizes = runner.measure('push_payload', _payload, combiner)
+        runner.results[-1]['bytes'] = sizes
+
+        import web_server
+        web_server.state.replace(list(combiner._latest_rows().values()))
+        client = web_server.app.test_client()
+        response = runner.measure('web_render', _render, client)
+        runner.results[-1]['bytes'] = len(response.data)
+        runner.measure('web_render_cached', _render, client, {'If-None-Match': response.headers['ETag']})
+    finally:
+        os.chdir(cwd)
+        combiner.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'config': dict(config.as_dict(), workers=workers, rank_error=rank_error,
+                       tracemalloc=trace_allocations, baseline=baseline),
+        'environment': environment(),
+        'stages': runner.results,
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float = DEFAULT_TOLERANCE) -> List[str]:
+    """Стадии, ставшие медленнее или тяжелее базового прогона больше чем на tolerance"""
+    if baseline.get('config') != results.get('config'):
+        print("Warning: baseline was recorded with a different configuration")
+    previous = {stage['name']: stage for stage in baseline.get('stages', [])}
+    regressions = []
+    for stage in results['stages']:
+        before = previous.get(stage['name'])
+        if before is None or stage['name'] == 'generate':
+            continue
+        if before['wall_s'] >= MIN_COMPARED_SECONDS and stage['wall_s'] > before['wall_s'] * (1 + tolerance):
+            regressions.append(f"{stage['name']}: {before['wall_s']:.3f}s -> {stage['wall_s']:.3f}s")
+        if (stage.get('peak_rss_scope') == before.get('peak_rss_scope') == 'stage'
+                and stage['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance)):
+            regressions.append(f"{stage['name']}: peak RSS {before['peak_rss_mb']:.1f} MB -> "
+                               f"{stage['peak_rss_mb']:.1f} MB")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the candle pipeline on synthetic data")
+    parser.add_argument('--markets', type=int, default=170)
+    parser.add_argument('--days', type=float, default=365)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--data-dir', default='benchmark_data',
+                        help="synthetic files are generated here once per configuration")
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--workers', type=int, default=1, help="DataCombiner process pool size")
+    parser.add_argument('--rank-error', type=float, default=None,
+                        help="approximate 1M/1Y medians within this rank error (default: exact)")
+    parser.add_argument('--tracemalloc', action='store_true', help="also record peak Python allocations")
+    parser.add_argument('--skip-baseline', action='store_true',
+                        help="do not time the original per-market indicator calculation (slow on a full year)")
+    parser.add_argument('--baseline', help="results JSON to compare against; exit code 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--verbose', action='store_true', help="keep pipeline logging")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    config = SyntheticConfig(markets=args.markets, days=args.days, seed=args.seed)
+    results = run_benchmarks(config, os.path.abspath(args.data_dir), workers=args.workers,
+                             rank_error=args.rank_error, trace_allocations=args.tracemalloc,
+                             baseline=not args.skip_baseline)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
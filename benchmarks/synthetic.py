@@ -0,0 +1,123 @@
+import json
+import os
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from candle_decoder import BINANCE_COLUMNS, COINBASE_COLUMNS
+
+CANDLE = pd.Timedelta('5min')
+
+# Конец синтетической истории фиксирован, чтобы файлы не зависели от даты запуска
+DEFAULT_END = '2024-01-01'
+
+# Доля пропущенных свечей на каждой бирже (рынок без сделок за 5 минут)
+GAP_RATE = 0.005
+
+MANIFEST = 'synthetic.json'
+
+
+class SyntheticConfig:
+    """Параметры генерации: одинаковая конфигурация и seed дают одинаковые файлы"""
+
+    def __init__(self, markets: int = 170, days: float = 365, seed: int = 42, end: str = DEFAULT_END,
+                 update_candles: int = 12, update_overlap: int = 6):
+        self.markets = markets
+        self.days = days
+        self.seed = seed
+        self.end = end
+        # Порция для слияния save_to_csv: update_candles новых свечей по каждому рынку
+        # плюс update_overlap последних уже записанных (обновлённая незакрытая свеча)
+        self.update_candles = update_candles
+        self.update_overlap = update_overlap
+
+    @property
+    def candles(self) -> int:
+        return int(round(pd.Timedelta(days=self.days) / CANDLE))
+
+    def as_dict(self) -> Dict:
+        return {'markets': self.markets, 'days': self.days, 'seed': self.seed, 'end': self.end,
+                'update_candles': self.update_candles, 'update_overlap': self.update_overlap}
+
+
+def coin_names(count: int) -> List[str]:
+    return [f"SYN{i:03d}" for i in range(count)]
+
+
+def _market_frames(coin: str, times: pd.DatetimeIndex, rng: np.random.Generator
+                   ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Свечи одного рынка на обеих биржах: общий случайный путь цены и небольшая премия"""
+    n = len(times)
+    start_price = float(np.exp(rng.uniform(-6, 10)))
+    close = start_price * np.exp(np.cumsum(rng.normal(0, 0.002, n)))
+    opening = np.concatenate([[start_price], close[:-1]])
+    spread = np.abs(rng.normal(0, 0.001, n))
+    high = np.maximum(opening, close) * (1 + spread)
+    low = np.minimum(opening, close) * (1 - spread)
+    volume = rng.lognormal(3, 1, n)
+
+    # Премия Coinbase к Binance: медленно меняющийся шум порядка 0.1%
+    premium = np.cumsum(rng.normal(0, 0.0001, n)) * 0.1 + rng.normal(0.0005, 0.0005, n)
+    binance_close = close / (1 + premium)
+    binance_volume = volume * rng.uniform(2, 6)
+
+    coinbase = pd.DataFrame({
+        'market': f"{coin}-USD",
+        'candle_date_time_utc': times,
+        'opening_price': opening, 'high_price': high, 'low_price': low, 'close_price': close,
+        'volume': volume,
+        'market_type': 'spot',
+    }, columns=COINBASE_COLUMNS)
+    binance = pd.DataFrame({
+        'market': f"{coin}/USDT",
+        'candle_date_time_utc': times,
+        'opening_price': opening / (1 + premium), 'high_price': high / (1 + premium),
+        'low_price': low / (1 + premium), 'close_price': binance_close,
+        'volume': binance_volume,
+        'quote_volume': binance_volume * binance_close,
+        'market_type': 'spot',
+    }, columns=BINANCE_COLUMNS)
+    return coinbase, binance
+
+
+def generate(config: SyntheticConfig, data_dir: str, force: bool = False) -> Dict[str, str]:
+    """
+    Пишет в data_dir coinbase_data.csv / binance_data.csv (история) и coinbase_update.csv /
+    binance_update.csv (порция для слияния). Файлы с той же конфигурацией переиспользуются.
+    Возвращает пути по ключам coinbase, binance, coinbase_update, binance_update.
+    """
+    paths = {'coinbase': os.path.join(data_dir, 'coinbase_data.csv'),
+             'binance': os.path.join(data_dir, 'binance_data.csv'),
+             'coinbase_update': os.path.join(data_dir, 'coinbase_update.csv'),
+             'binance_update': os.path.join(data_dir, 'binance_update.csv')}
+    manifest_path = os.path.join(data_dir, MANIFEST)
+
+    if not force and os.path.exists(manifest_path) and all(os.path.exists(p) for p in paths.values()):
+        with open(manifest_path) as f:
+            if json.load(f) == config.as_dict():
+                return paths
+
+    os.makedirs(data_dir, exist_ok=True)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    history = config.candles
+    end = pd.Timestamp(config.end)
+    times = pd.date_range(end=end + CANDLE * (config.update_candles - 1), periods=history + config.update_candles,
+                          freq=CANDLE)
+    rng = np.random.default_rng(config.seed)
+
+    for index, coin in enumerate(coin_names(config.markets)):
+        coinbase, binance = _market_frames(coin, times, rng)
+        mode, header = ('w', True) if index == 0 else ('a', False)
+        for name, frame in (('coinbase', coinbase), ('binance', binance)):
+            past = frame.iloc[:history]
+            past = past[rng.random(len(past)) >= GAP_RATE]
+            past.to_csv(paths[name], mode=mode, header=header, index=False)
+            frame.iloc[history - config.update_overlap:].to_csv(paths[f"{name}_update"], mode=mode,
+                                                                  header=header, index=False)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(config.as_dict(), f)
+    return paths
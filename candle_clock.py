@@ -0,0 +1,107 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class CandleClock:
+    """
+    Расписание опроса REST по закрытию свечей вместо фиксированной паузы.
+
+    Основной тик - граница интервала плюс settle_delay (биржам нужно несколько секунд,
+    чтобы отдать закрытую свечу). Рынки, по которым свеча ещё не пришла, опрашиваются
+    отдельными короткими тиками через follow_up_delay, не больше follow_ups раз. Цикл
+    ограничен deadline секундами от границы: после него поздние рынки догружаются
+    хвостом уже в следующем цикле.
+    """
+
+    def __init__(self, interval: timedelta = timedelta(minutes=5), settle_delay: float = 3.0,
+                 follow_up_delay: float = 10.0, follow_ups: int = 3, deadline: float = 90.0):
+        if deadline >= interval.total_seconds():
+            raise ValueError("Cycle deadline must be shorter than the candle interval")
+        self.interval = interval
+        self.settle_delay = settle_delay
+        self.follow_up_delay = follow_up_delay
+        self.follow_ups = follow_ups
+        self.deadline = deadline
+        self.boundary: Optional[datetime] = None  # конец последней закрытой свечи текущего цикла
+        self.late: Dict[str, List[str]] = {}      # exchange -> рынки без закрытой свечи
+        self.ticks = 0                            # тиков в текущем цикле, включая основной
+        self.cycles = 0
+        self.missed_cycles = 0
+        self.late_markets = 0
+
+    def next_boundary(self, now: datetime) -> datetime:
+        """Ближайшая граница интервала, для которой основной тик ещё впереди"""
+        step = int(self.interval.total_seconds())
+        epoch = int((now - timedelta(seconds=self.settle_delay)).timestamp())
+        return datetime.fromtimestamp((epoch // step + 1) * step, tz=timezone.utc)
+
+    def closed_end(self, boundary: Optional[datetime] = None) -> datetime:
+        """Верхняя граница запроса: последняя закрытая свеча без формирующейся (endTime включительно)"""
+        return (boundary or self.boundary) - timedelta(milliseconds=1)
+
+    def last_boundary(self, now: datetime) -> datetime:
+        """Граница последней закрытой к моменту now свечи"""
+        step = int(self.interval.total_seconds())
+        return datetime.fromtimestamp(int(now.timestamp()) // step * step, tz=timezone.utc)
+
+    def target(self) -> pd.Timestamp:
+        """Время открытия свечи, закрывшейся на границе цикла (naive UTC, как у фетчеров)"""
+        return pd.Timestamp(self.boundary - self.interval).tz_localize(None)
+
+    def remaining(self) -> float:
+        """Секунд до дедлайна текущего цикла"""
+        return (self.boundary + timedelta(seconds=self.deadline) - datetime.now(timezone.utc)).total_seconds()
+
+    async def wait(self) -> bool:
+        """
+        Ждёт следующего тика. True - основной тик новой свечи (self.boundary сдвинута),
+        False - повторный тик для поздних рынков из self.late.
+        """
+        if self.late and self.ticks <= self.follow_ups and self.remaining() > self.follow_up_delay:
+            await asyncio.sleep(self.follow_up_delay)
+            self.ticks += 1
+            return False
+        if self.late:
+            logger.info(f"Giving up on late markets until the next candle: {self.late}")
+
+        now = datetime.now(timezone.utc)
+        boundary = self.next_boundary(now)
+        if self.boundary is not None and boundary <= self.boundary:
+            # Таймер сработал чуть раньше границы по настенным часам
+            boundary = self.boundary + self.interval
+        if self.boundary is not None and boundary - self.boundary > self.interval:
+            # Предыдущий цикл не уложился в интервал - пропущенные свечи придут хвостом
+            self.missed_cycles += int((boundary - self.boundary) / self.interval) - 1
+        await asyncio.sleep(max(0.0, (boundary - now).total_seconds() + self.settle_delay))
+        self.boundary = boundary
+        self.late = {}
+        self.ticks = 1
+        self.cycles += 1
+        return True
+
+    def update_late(self, exchange: str, requested: Iterable[str], frame: pd.DataFrame) -> List[str]:
+        """Запоминает рынки из requested, по которым в frame нет свечи границы цикла"""
+        target = self.target()
+        arrived = set(frame.loc[frame['candle_date_time_utc'] >= target, 'market']) if not frame.empty else set()
+        late = [market for market in requested if market not in arrived]
+        if late:
+            self.late[exchange] = late
+            self.late_markets += len(late)
+        else:
+            self.late.pop(exchange, None)
+        return late
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'cycles': self.cycles,
+            'missed_cycles': self.missed_cycles,
+            'late_markets': self.late_markets,
+            'pending_late': sum(len(markets) for markets in self.late.values()),
+            'tick': self.ticks,
+        }
@@ -0,0 +1,62 @@
+import json
+from typing import Any, Callable, List
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него используется стандартный json
+    orjson = None
+
+PRICE_COLUMNS = ['opening_price', 'high_price', 'low_price', 'close_price']
+COINBASE_COLUMNS = ['market', 'candle_date_time_utc'] + PRICE_COLUMNS + ['volume', 'market_type']
+BINANCE_COLUMNS = ['market', 'candle_date_time_utc'] + PRICE_COLUMNS + ['volume', 'quote_volume', 'market_type']
+
+# Позиции полей в ответах API
+# Coinbase /products/<id>/candles: [time (s), low, high, open, close, volume]
+COINBASE_FIELDS = {'time': 0, 'low_price': 1, 'high_price': 2, 'opening_price': 3, 'close_price': 4, 'volume': 5}
+# Binance /api/v3/klines: [open time (ms), open, high, low, close, volume, close time, quote volume, ...]
+BINANCE_FIELDS = {'time': 0, 'opening_price': 1, 'high_price': 2, 'low_price': 3, 'close_price': 4,
+                  'volume': 5, 'quote_volume': 7}
+
+json_loads: Callable[[bytes], Any] = orjson.loads if orjson is not None else json.loads
+
+
+def empty_frame(columns: List[str]) -> pd.DataFrame:
+    frame = pd.DataFrame({col: pd.Series(dtype='float64') for col in columns})
+    frame['market'] = frame['market'].astype(object)
+    frame['market_type'] = frame['market_type'].astype(object)
+    frame['candle_date_time_utc'] = frame['candle_date_time_utc'].astype('datetime64[ns]')
+    return frame
+
+
+def _frame(pair: str, epoch_ns: np.ndarray, values: dict, columns: List[str]) -> pd.DataFrame:
+    data = {'market': np.full(len(epoch_ns), pair, dtype=object),
+            # int64 ns -> datetime64 без промежуточных строк (naive UTC, как в CandleStore.read)
+            'candle_date_time_utc': epoch_ns.view('datetime64[ns]')}
+    data.update(values)
+    data['market_type'] = np.full(len(epoch_ns), 'spot', dtype=object)
+    return pd.DataFrame(data, columns=columns)
+
+
+def decode_coinbase(pair: str, payload: list) -> pd.DataFrame:
+    """Ответ Coinbase (список списков) -> колонки; volume в котируемой валюте (объём * close)"""
+    if not payload:
+        return empty_frame(COINBASE_COLUMNS)
+    array = np.asarray(payload, dtype=np.float64)
+    epoch_ns = array[:, COINBASE_FIELDS['time']].astype(np.int64) * 1_000_000_000
+    values = {col: array[:, COINBASE_FIELDS[col]] for col in PRICE_COLUMNS}
+    values['volume'] = array[:, COINBASE_FIELDS['volume']] * values['close_price']
+    return _frame(pair, epoch_ns, values, COINBASE_COLUMNS)
+
+
+def decode_binance(pair: str, payload: list) -> pd.DataFrame:
+    """Ответ Binance klines (цены строками) -> колонки"""
+    if not payload:
+        return empty_frame(BINANCE_COLUMNS)
+    array = np.asarray(payload, dtype=object)
+    epoch_ns = array[:, BINANCE_FIELDS['time']].astype(np.int64) * 1_000_000
+    values = {col: array[:, BINANCE_FIELDS[col]].astype(np.float64)
+              for col in PRICE_COLUMNS + ['volume', 'quote_volume']}
+    return _frame(pair, epoch_ns, values, BINANCE_COLUMNS)
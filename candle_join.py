@@ -0,0 +1,373 @@
+import json
+import logging
+import os
+import threading
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from candle_store import CandleStore
+
+logger = logging.getLogger(__name__)
+
+BUCKET = timedelta(minutes=5)
+BUCKET_NS = int(BUCKET.total_seconds()) * 10**9
+
+# "Биржа" объединённой серии в своём CandleStore: <root>/joined/<market>/<YYYY-MM-DD>.parquet
+JOINED = 'joined'
+
+# Колонки фетчера -> колонки объединённой таблицы (как у DataCombiner.combine_frames)
+SIDE_COLUMNS = {
+    'coinbase': {'close_price': 'close_price_coinbase', 'volume': 'volume_coinbase'},
+    'binance': {'close_price': 'close_price_binance', 'quote_volume': 'volume_binance'},
+}
+VALUE_COLUMNS = ['close_price_coinbase', 'volume_coinbase', 'close_price_binance', 'volume_binance']
+
+# Журнал необъединённых диапазонов в корне объединённого хранилища
+UNJOINED_FILE = 'unjoined.json'
+# Свечи рынка с разрывом больше RANGE_GAP - отдельные диапазоны журнала (candle_ranges)
+RANGE_GAP = timedelta(days=1)
+
+
+def market_key(exchange: str, pair: str) -> str:
+    """Общий ключ рынка: BTC-USD (Coinbase) и BTC/USDT (Binance) -> BTCUSDT"""
+    if exchange == 'coinbase':
+        return pair.replace('-', '') + 'T'
+    return pair.replace('/', '')
+
+
+def candle_ranges(df: Optional[pd.DataFrame], before=None) -> List[Tuple[str, pd.Timestamp, pd.Timestamp]]:
+    """
+    Диапазоны (pair, start, end) свечей в схеме фетчера - по рынку, с разрывами не больше
+    RANGE_GAP; before - только свечи раньше этого времени (UTC).
+    """
+    if df is None or df.empty:
+        return []
+    timestamps = df['candle_date_time_utc']
+    if not pd.api.types.is_datetime64_any_dtype(timestamps):
+        timestamps = pd.to_datetime(timestamps)
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
+    frame = pd.DataFrame({'market': df['market'].to_numpy(), 'time': timestamps.to_numpy()})
+    if before is not None:
+        before = pd.Timestamp(before)
+        frame = frame[frame['time'] < (before.tz_convert('UTC').tz_localize(None) if before.tz else before)]
+    if frame.empty:
+        return []
+    frame = frame.sort_values(['market', 'time'], kind='mergesort')
+    run = ((frame['market'] != frame['market'].shift()) | (frame['time'].diff() > RANGE_GAP)).cumsum()
+    runs = frame.groupby(run.to_numpy(), sort=False).agg(market=('market', 'first'),
+                                                         start=('time', 'min'), end=('time', 'max'))
+    return list(zip(runs['market'], runs['start'], runs['end']))
+
+
+def _bucket(moment) -> int:
+    """Номер 5-минутной корзины; naive время - UTC"""
+    return pd.Timestamp(moment).value // BUCKET_NS
+
+
+def _utc(moment) -> pd.Timestamp:
+    moment = pd.Timestamp(moment)
+    return moment.tz_localize('UTC') if moment.tz is None else moment.tz_convert('UTC')
+
+
+def _bucket_time(bucket: int) -> pd.Timestamp:
+    return pd.Timestamp(bucket * BUCKET_NS, tz='UTC')
+
+
+class CandleJoin:
+    """
+    Инкрементальное объединение свечей Coinbase и Binance по точному ключу (market, 5m bucket).
+
+    Корзина - int64 номер 5-минутного интервала (epoch_ns // BUCKET_NS), поэтому вместо
+    merge_asof по всей истории - выравнивание индексов только для новых свечей. Свечи обеих
+    бирж за последние horizon держатся в памяти; партнёр постарше (пропуск, догруженный
+    планировщиком) читается из хранилища свечей по затронутым рынкам и дням. Опоздавшая
+    свеча любой стороны переобъединяет только свою корзину. Результат дописывается в
+    объединённую серию (отдельный CandleStore, перезаписываются только затронутые дни).
+
+    Как и прежнее объединение, это left join по Coinbase: корзина без свечи Binance
+    попадает в таблицу с NaN, свеча Binance без пары ждёт свою свечу Coinbase.
+
+    Свечи, записанные в хранилище мимо update() (сброс переполненного буфера фетчера,
+    бэкфилл и пропуски старше окна в памяти), отмечаются в журнале mark_unjoined(). Журнал
+    лежит в объединённом хранилище и переживает перезапуск; update() и _catch_up()
+    переобъединяют его диапазоны из хранилища свечей, сколько бы им ни было лет.
+    """
+
+    def __init__(self, candles: CandleStore, joined: CandleStore, horizon: timedelta = timedelta(days=1)):
+        self.candles = candles
+        self.joined = joined
+        self.horizon_buckets = int(horizon / BUCKET)
+        self.latest_bucket = None
+        self.recent = {side: self._empty(side) for side in SIDE_COLUMNS}
+        # Ключ рынка -> пара биржи, чтобы читать из хранилища свечей. Пополняют и стадия store
+        # (mark_unjoined), и compute (update) из разных потоков - только под _pairs_lock
+        self.pairs: Dict[str, Dict[str, str]] = {side: {} for side in SIDE_COLUMNS}
+        self._pairs_lock = threading.Lock()
+        self.joined_rows = 0
+        self.rejoined_rows = 0
+        self.store_lookups = 0
+        # Ключ рынка -> [[первая, последняя корзина]]; отмечает стадия store, вычёркивает compute
+        self.unjoined_path = os.path.join(joined.root, UNJOINED_FILE)
+        self.unjoined: Dict[str, List[List[int]]] = self._load_unjoined()
+        self._unjoined_lock = threading.Lock()
+
+    @staticmethod
+    def _empty(side: str) -> pd.DataFrame:
+        index = pd.MultiIndex.from_arrays([np.array([], dtype=object), np.array([], dtype='int64')],
+                                          names=['market', 'bucket'])
+        return pd.DataFrame({column: np.array([], dtype='float64') for column in SIDE_COLUMNS[side].values()},
+                            index=index)
+
+    def _keyed(self, side: str, df: Optional[pd.DataFrame]) -> pd.DataFrame:
+        """Свечи в схеме фетчера -> цена и объём по (market, bucket)"""
+        if df is None or df.empty:
+            return self._empty(side)
+        # Строковые операции - по уникальным парам, а не по каждой строке
+        keys = {pair: market_key(side, pair) for pair in pd.unique(df['market'])}
+        with self._pairs_lock:
+            self.pairs[side].update({key: pair for pair, key in keys.items()})
+
+        timestamps = df['candle_date_time_utc']
+        if not pd.api.types.is_datetime64_any_dtype(timestamps):
+            timestamps = pd.to_datetime(timestamps)
+        if timestamps.dt.tz is not None:
+            timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
+        buckets = timestamps.to_numpy('datetime64[ns]').astype('int64') // BUCKET_NS
+
+        index = pd.MultiIndex.from_arrays([df['market'].map(keys).to_numpy(), buckets], names=['market', 'bucket'])
+        frame = pd.DataFrame({column: pd.to_numeric(df[source], errors='coerce').to_numpy('float64')
+                              for source, column in SIDE_COLUMNS[side].items()}, index=index)
+        return frame[~frame.index.duplicated(keep='last')]
+
+    def _cutoff(self) -> int:
+        return self.latest_bucket - self.horizon_buckets
+
+    def window_start(self) -> Optional[pd.Timestamp]:
+        """Начало окна свечей в памяти; None - окно ещё пустое (до первого объединения)"""
+        if self.latest_bucket is None:
+            return None
+        return _bucket_time(self._cutoff())
+
+    def _load_unjoined(self) -> Dict[str, List[List[int]]]:
+        if not os.path.exists(self.unjoined_path):
+            return {}
+        with open(self.unjoined_path) as f:
+            return json.load(f)
+
+    def _save_unjoined(self) -> None:
+        os.makedirs(os.path.dirname(self.unjoined_path) or '.', exist_ok=True)
+        tmp_path = f"{self.unjoined_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.unjoined, f)
+        os.replace(tmp_path, self.unjoined_path)
+
+    def mark_unjoined(self, exchange: str, ranges: List[Tuple[str, pd.Timestamp, pd.Timestamp]]) -> None:
+        """Отмечает (pair, start, end) свечей биржи, которые записаны в хранилище, но не объединены"""
+        if not ranges:
+            return
+        with self._unjoined_lock:
+            for pair, start, end in ranges:
+                key = market_key(exchange, pair)
+                with self._pairs_lock:
+                    self.pairs[exchange][key] = pair
+                self.unjoined.setdefault(key, []).append([_bucket(start), _bucket(end)])
+            self._save_unjoined()
+
+    def _pending(self) -> Dict[str, List[List[int]]]:
+        with self._unjoined_lock:
+            return {key: list(spans) for key, spans in self.unjoined.items()}
+
+    def _forget(self, done: Dict[str, List[List[int]]]) -> None:
+        """Вычёркивает из журнала переобъединённые диапазоны (новые отметки остаются)"""
+        if not done:
+            return
+        with self._unjoined_lock:
+            for key, spans in done.items():
+                left = [span for span in self.unjoined.get(key, []) if span not in spans]
+                if left:
+                    self.unjoined[key] = left
+                else:
+                    self.unjoined.pop(key, None)
+            self._save_unjoined()
+
+    def _pair(self, side: str, key: str) -> Optional[str]:
+        with self._pairs_lock:
+            pair = self.pairs[side].get(key)
+        if pair is not None:
+            return pair
+        stored = {market_key(side, pair): pair for pair in self.candles.markets(side)}
+        with self._pairs_lock:
+            for stored_key, pair in stored.items():
+                self.pairs[side].setdefault(stored_key, pair)
+            return self.pairs[side].get(key)
+
+    def _rejoin(self, spans: Dict[str, List[List[int]]]) -> pd.DataFrame:
+        """Переобъединяет диапазоны журнала из хранилища свечей: обе биржи, только эти рынки и дни"""
+        frames = {side: [] for side in SIDE_COLUMNS}
+        for key, key_spans in spans.items():
+            for first, last in key_spans:
+                for side in SIDE_COLUMNS:
+                    pair = self._pair(side, key)
+                    if pair is None:
+                        continue
+                    self.store_lookups += 1
+                    frames[side].append(self._keyed(side, self.candles.read(
+                        side, markets=[pair], start=_bucket_time(first), end=_bucket_time(last))))
+        keyed = {}
+        for side, parts in frames.items():
+            frame = pd.concat(parts) if parts else self._empty(side)
+            keyed[side] = frame[~frame.index.duplicated(keep='last')]
+        joined = self._join(keyed['coinbase'], keyed['binance'], complete=True)
+        self.rejoined_rows += len(joined)
+        logger.info(f"Re-joined {len(joined)} buckets from {sum(map(len, spans.values()))} unjoined ranges")
+        return joined
+
+    def _remember(self, side: str, frame: pd.DataFrame) -> None:
+        """Добавляет свечи в окно последних horizon и отбрасывает вышедшие из него"""
+        recent = pd.concat([self.recent[side], frame])
+        recent = recent[~recent.index.duplicated(keep='last')]
+        self.recent[side] = recent[recent.index.get_level_values('bucket') >= self._cutoff()]
+
+    def _read(self, side: str, keys: pd.MultiIndex) -> pd.DataFrame:
+        """Свечи стороны side по ключам старше окна - из хранилища, только затронутые рынки и дни"""
+        with self._pairs_lock:
+            pairs = [self.pairs[side][market] for market in keys.unique('market') if market in self.pairs[side]]
+        if not pairs:
+            return self._empty(side)
+        buckets = keys.get_level_values('bucket')
+        self.store_lookups += 1
+        df = self.candles.read(side, markets=pairs,
+                               start=pd.Timestamp(buckets.min() * BUCKET_NS, tz='UTC'),
+                               end=pd.Timestamp(buckets.max() * BUCKET_NS, tz='UTC'))
+        return self._keyed(side, df)
+
+    def _values(self, side: str, batch: pd.DataFrame, keys: pd.MultiIndex, complete: bool) -> pd.DataFrame:
+        """Цена и объём стороны side по ключам: из пакета, затем из окна в памяти, затем из хранилища"""
+        values = batch.reindex(keys)
+        close = values.columns[0]
+        missing = values[close].isna().to_numpy()
+        if missing.any() and not complete:
+            values.loc[missing] = self.recent[side].reindex(keys[missing]).to_numpy()
+            old = missing & values[close].isna().to_numpy() & (keys.get_level_values('bucket') < self._cutoff())
+            if old.any():
+                values.loc[old] = self._read(side, keys[old]).reindex(keys[old]).to_numpy()
+        return values
+
+    def _join(self, coinbase: pd.DataFrame, binance: pd.DataFrame, complete: bool = False) -> pd.DataFrame:
+        """
+        Объединённые строки для корзин, затронутых новыми свечами.
+        complete - пакет содержит все свечи обеих бирж за свой интервал (догрузка серии),
+        искать партнёров в памяти и хранилище не нужно.
+        """
+        if coinbase.empty and binance.empty:
+            return pd.DataFrame(columns=VALUE_COLUMNS)
+        newest = max(frame.index.get_level_values('bucket').max() for frame in (coinbase, binance) if not frame.empty)
+        self.latest_bucket = newest if self.latest_bucket is None else max(self.latest_bucket, newest)
+
+        keys = coinbase.index.union(binance.index)
+        left = self._values('coinbase', coinbase, keys, complete)
+        present = left['close_price_coinbase'].notna().to_numpy()
+        keys, left = keys[present], left[present]
+        right = self._values('binance', binance, keys, complete)
+
+        self._remember('coinbase', coinbase)
+        self._remember('binance', binance)
+        joined = pd.concat([left, right], axis=1)
+        self.joined_rows += len(joined)
+        self.rejoined_rows += int((~keys.isin(coinbase.index)).sum())
+        return joined
+
+    def _persist(self, joined: pd.DataFrame) -> None:
+        if joined.empty:
+            return
+        frame = joined.reset_index()
+        frame.insert(1, 'candle_date_time_utc', pd.to_datetime(frame.pop('bucket') * BUCKET_NS))
+        self.joined.upsert(JOINED, frame)
+
+    @staticmethod
+    def _output(joined: pd.DataFrame) -> pd.DataFrame:
+        """Схема DataCombiner.combine_frames: market, timestamp_*, close_price_*, volume_*"""
+        if joined.empty:
+            return pd.DataFrame(columns=['market', 'timestamp_coinbase', 'timestamp_binance'] + VALUE_COLUMNS)
+        timestamps = pd.DatetimeIndex(joined.index.get_level_values('bucket') * BUCKET_NS).tz_localize('UTC')
+        matched = joined['close_price_binance'].notna().to_numpy()
+        result = pd.DataFrame({
+            'market': joined.index.get_level_values('market'),
+            'timestamp_coinbase': timestamps,
+            'timestamp_binance': timestamps.where(matched),
+        })
+        for column in VALUE_COLUMNS:
+            result[column] = joined[column].to_numpy()
+        return result.sort_values(['market', 'timestamp_coinbase']).reset_index(drop=True)
+
+    def update(self, coinbase_df: Optional[pd.DataFrame], binance_df: Optional[pd.DataFrame]) -> pd.DataFrame:
+        """
+        Новые свечи обеих бирж (схема фетчера) -> объединённые строки только затронутых
+        корзин, включая ранее объединённые корзины, к которым пришла опоздавшая свеча Binance,
+        и диапазоны журнала mark_unjoined().
+        """
+        pending = self._pending()
+        rejoined = self._rejoin(pending) if pending else None
+        joined = self._join(self._keyed('coinbase', coinbase_df), self._keyed('binance', binance_df))
+        if rejoined is not None and not rejoined.empty:
+            joined = rejoined if joined.empty else pd.concat([rejoined, joined])
+            joined = joined[~joined.index.duplicated(keep='last')]
+        self._persist(joined)
+        self._forget(pending)
+        return self._output(joined)
+
+    def _catch_up(self, start, end) -> None:
+        """
+        Догоняет объединённую серию по хранилищу свечей (первый запуск, бэкфилл, сбой между
+        записью свечей и серии) и заполняет окно в памяти.
+        """
+        start, end = _utc(start), _utc(end)
+        since = end - self.horizon_buckets * BUCKET
+        for pair in self.candles.markets('coinbase'):
+            last = self.joined.last_timestamp(JOINED, market_key('coinbase', pair))
+            since = min(since, start if last is None else max(last, start))
+
+        # Диапазоны журнала до since (пропуски любой давности); после since объединяется всё подряд
+        pending = self._pending()
+        older = {}
+        for key, spans in pending.items():
+            clipped = [[first, min(last, _bucket(since) - 1)] for first, last in spans if first < _bucket(since)]
+            if clipped:
+                older[key] = clipped
+        if older:
+            self._persist(self._rejoin(older))
+
+        logger.info(f"Joining stored candles from {since} to {end}")
+        coinbase = self._keyed('coinbase', self.candles.read('coinbase', start=since, end=end))
+        binance = self._keyed('binance', self.candles.read('binance', start=since, end=end))
+        self.recent = {side: self._empty(side) for side in SIDE_COLUMNS}
+        self._persist(self._join(coinbase, binance, complete=True))
+        self._forget(pending)
+
+    def load(self, start, end) -> pd.DataFrame:
+        """Вся объединённая история [start, end] (полный расчёт индикаторов при старте)"""
+        self._catch_up(start, end)
+        return self.read(start, end)
+
+    def read(self, start=None, end=None, markets: Optional[List[str]] = None) -> pd.DataFrame:
+        """Объединённая серия из хранилища в схеме combine_frames (markets - ключи рынков)"""
+        df = self.joined.read(JOINED, markets=markets, start=start, end=end)
+        if df.empty:
+            return self._output(pd.DataFrame(columns=VALUE_COLUMNS))
+        buckets = df['candle_date_time_utc'].to_numpy('datetime64[ns]').astype('int64') // BUCKET_NS
+        index = pd.MultiIndex.from_arrays([df['market'].to_numpy(), buckets], names=['market', 'bucket'])
+        return self._output(pd.DataFrame({column: df[column].to_numpy() for column in VALUE_COLUMNS}, index=index))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'recent_coinbase': len(self.recent['coinbase']),
+            'recent_binance': len(self.recent['binance']),
+            'joined_rows': self.joined_rows,
+            'rejoined_rows': self.rejoined_rows,
+            'store_lookups': self.store_lookups,
+            'unjoined_ranges': sum(len(spans) for spans in self._pending().values()),
+        }
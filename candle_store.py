@@ -0,0 +1,192 @@
+import os
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Union
+from urllib.parse import quote, unquote
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+TimeLike = Union[datetime, pd.Timestamp, str]
+
+
+class CandleStore:
+    """
+    Хранилище свечей в Parquet, разбитое по бирже, рынку и дню:
+    <root>/<exchange>/<market>/<YYYY-MM-DD>.parquet
+
+    Время хранится типизированной колонкой timestamp (UTC), цены и объемы - float64.
+    Запись - идемпотентный upsert по времени свечи, перезаписываются только
+    затронутые дневные партиции.
+    """
+
+    def __init__(self, root: str = 'candle_store'):
+        self.root = root
+        # Последняя сохранённая свеча по (exchange, market), обновляется при upsert
+        self._high_water: Dict[tuple, pd.Timestamp] = {}
+        # upsert - чтение-слияние-запись партиции; конвейер пишет из потока стадии store,
+        # а переполненный буфер может сбрасываться из event loop одновременно с ним
+        self._write_lock = threading.Lock()
+
+    def _market_dir(self, exchange: str, market: str) -> str:
+        return os.path.join(self.root, exchange, quote(market, safe=''))
+
+    def _partition_path(self, exchange: str, market: str, day: str) -> str:
+        return os.path.join(self._market_dir(exchange, market), f"{day}.parquet")
+
+    def markets(self, exchange: str) -> List[str]:
+        """Список рынков, по которым есть данные"""
+        exchange_dir = os.path.join(self.root, exchange)
+        if not os.path.isdir(exchange_dir):
+            return []
+        return sorted(unquote(name) for name in os.listdir(exchange_dir))
+
+    def partitions(self, exchange: str, market: str) -> List[str]:
+        """Отсортированный список дней (YYYY-MM-DD), по которым есть партиции"""
+        market_dir = self._market_dir(exchange, market)
+        if not os.path.isdir(market_dir):
+            return []
+        return sorted(name[:-len('.parquet')] for name in os.listdir(market_dir)
+                      if name.endswith('.parquet'))
+
+    @staticmethod
+    def _to_frame(df: pd.DataFrame) -> pd.DataFrame:
+        """Приводит строки фетчера к типизированной схеме хранилища"""
+        frame = df.drop(columns=['market_type'], errors='ignore')
+        timestamps = frame.pop('candle_date_time_utc')
+        # Декодер фетчеров уже отдаёт datetime64/float64; строки (CSV) разбираются здесь
+        if not pd.api.types.is_datetime64_any_dtype(timestamps):
+            timestamps = pd.to_datetime(timestamps)
+        if timestamps.dt.tz is None:
+            timestamps = timestamps.dt.tz_localize('UTC')
+        frame.insert(0, 'timestamp', timestamps.dt.tz_convert('UTC'))
+        for col in frame.columns:
+            if col not in ('timestamp', 'market') and frame[col].dtype != 'float64':
+                frame[col] = pd.to_numeric(frame[col], errors='coerce').astype('float64')
+        return frame
+
+    def upsert(self, exchange: str, df: pd.DataFrame) -> int:
+        """
+        Добавляет или обновляет свечи (колонки как у фетчеров: market, candle_date_time_utc, ...).
+        Возвращает число перезаписанных партиций.
+        """
+        if df.empty:
+            return 0
+        with self._write_lock:
+            return self._upsert(exchange, df)
+
+    def _upsert(self, exchange: str, df: pd.DataFrame) -> int:
+        frame = self._to_frame(df)
+        frame['day'] = frame['timestamp'].dt.strftime('%Y-%m-%d')
+        written = 0
+
+        for (market, day), part in frame.groupby(['market', 'day'], sort=False):
+            part = part.drop(columns=['market', 'day'])
+            path = self._partition_path(exchange, market, day)
+
+            if os.path.exists(path):
+                existing = pd.read_parquet(path)
+                merged = pd.concat([existing, part], ignore_index=True)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                existing = None
+                merged = part
+
+            merged = (merged.drop_duplicates(subset=['timestamp'], keep='last')
+                      .sort_values('timestamp')
+                      .reset_index(drop=True))
+
+            # Повторная загрузка тех же свечей не должна переписывать файл
+            if existing is not None and merged.equals(existing.reset_index(drop=True)):
+                continue
+
+            tmp_path = f"{path}.tmp"
+            merged.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            written += 1
+
+            key = (exchange, market)
+            last = merged['timestamp'].iloc[-1]
+            if key in self._high_water and self._high_water[key] is not None:
+                self._high_water[key] = max(self._high_water[key], last)
+            else:
+                self._high_water.pop(key, None)
+
+        logger.info(f"{exchange}: upserted {len(frame)} candles, {written} partitions rewritten")
+        return written
+
+    def last_timestamp(self, exchange: str, market: str) -> Optional[pd.Timestamp]:
+        """Время последней сохранённой свечи рынка (None, если данных нет)"""
+        key = (exchange, market)
+        if key not in self._high_water:
+            days = self.partitions(exchange, market)
+            if days:
+                part = pd.read_parquet(self._partition_path(exchange, market, days[-1]), columns=['timestamp'])
+                self._high_water[key] = part['timestamp'].max()
+            else:
+                self._high_water[key] = None
+        return self._high_water[key]
+
+    def timestamps(self, exchange: str, market: str, start: Optional[TimeLike] = None) -> pd.DatetimeIndex:
+        """Отсортированные времена всех сохранённых свечей рынка начиная со start"""
+        start = _to_utc(start)
+        start_day = start.strftime('%Y-%m-%d') if start is not None else None
+        frames = [pd.read_parquet(self._partition_path(exchange, market, day), columns=['timestamp'])
+                  for day in self.partitions(exchange, market)
+                  if start_day is None or day >= start_day]
+        if not frames:
+            return pd.DatetimeIndex([], tz='UTC')
+        index = pd.DatetimeIndex(pd.concat(frames, ignore_index=True)['timestamp'])
+        if start is not None:
+            index = index[index >= start]
+        return index.sort_values()
+
+    def read(self, exchange: str, markets: Optional[List[str]] = None,
+             start: Optional[TimeLike] = None, end: Optional[TimeLike] = None) -> pd.DataFrame:
+        """
+        Читает свечи за интервал [start, end] в формате, совместимом с CSV фетчеров
+        (candle_date_time_utc - naive UTC datetime).
+        """
+        start = _to_utc(start)
+        end = _to_utc(end)
+        start_day = start.strftime('%Y-%m-%d') if start is not None else None
+        end_day = end.strftime('%Y-%m-%d') if end is not None else None
+
+        frames = []
+        for market in (markets if markets is not None else self.markets(exchange)):
+            for day in self.partitions(exchange, market):
+                if (start_day and day < start_day) or (end_day and day > end_day):
+                    continue
+                part = pd.read_parquet(self._partition_path(exchange, market, day))
+                part.insert(0, 'market', market)
+                frames.append(part)
+
+        if not frames:
+            return pd.DataFrame()
+
+        df = pd.concat(frames, ignore_index=True)
+        if start is not None:
+            df = df[df['timestamp'] >= start]
+        if end is not None:
+            df = df[df['timestamp'] <= end]
+
+        df = df.rename(columns={'timestamp': 'candle_date_time_utc'})
+        df['candle_date_time_utc'] = df['candle_date_time_utc'].dt.tz_localize(None)
+        df['market_type'] = 'spot'
+        return df.reset_index(drop=True)
+
+    def stats(self) -> Dict[str, int]:
+        """Количество партиций по биржам"""
+        if not os.path.isdir(self.root):
+            return {}
+        return {exchange: sum(len(self.partitions(exchange, market)) for market in self.markets(exchange))
+                for exchange in sorted(os.listdir(self.root))}
+
+
+def _to_utc(value: Optional[TimeLike]) -> Optional[pd.Timestamp]:
+    if value is None:
+        return None
+    ts = pd.Timestamp(value)
+    return ts.tz_localize('UTC') if ts.tz is None else ts.tz_convert('UTC')
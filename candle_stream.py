@@ -0,0 +1,257 @@
+import abc
+import asyncio
+import json
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import Dict, List, Optional
+
+import aiohttp
+
+from http_session import session_scope
+
+logger = logging.getLogger(__name__)
+
+
+class CandleStream(abc.ABC):
+    """
+    Потоковый приём 5-минутных свечей по WebSocket для одного REST-фетчера.
+
+    Закрытые свечи проходят через process_candles фетчера и попадают в его
+    IngestBuffer, поэтому save_to_store() и расчёт индикаторов работают как
+    при опросе REST. Пропуски (обрыв соединения, неполная свеча при подключении)
+    записываются в failed_ranges фетчера, и REST догружает только их.
+    После обрыва поток переподключается с экспоненциальной задержкой и заново
+    подписывается на все пары.
+    """
+
+    exchange = None
+
+    def __init__(self, fetcher, url: str, interval: timedelta = timedelta(minutes=5),
+                 reconnect_delay: float = 1.0, max_reconnect_delay: float = 60.0,
+                 heartbeat: float = 30.0):
+        self.fetcher = fetcher
+        self.url = url
+        self.interval = interval
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.heartbeat = heartbeat
+        # Начало последней закрытой свечи по паре
+        self.last_closed: Dict[str, datetime] = {}
+        # Взводится при каждой закрытой свече; сбрасывает потребитель
+        self.closed = asyncio.Event()
+        self.connected = False
+        self.connects = 0
+        self.messages = 0
+        self.candles = 0
+        self.gaps = 0
+
+    def seed_from_store(self, store) -> None:
+        """Продолжение с последней сохранённой свечи: она могла быть незакрытой, поэтому считается пропуском"""
+        for pair in self.fetcher.target_pairs:
+            last = store.last_timestamp(self.exchange, pair)
+            if last is not None:
+                self.last_closed[pair] = last.to_pydatetime() - self.interval
+
+    def bucket_start(self, moment: datetime) -> datetime:
+        seconds = int(self.interval.total_seconds())
+        return datetime.fromtimestamp(int(moment.timestamp()) // seconds * seconds, tz=timezone.utc)
+
+    def record_gap(self, pair: str, start: datetime, end: datetime) -> None:
+        if end <= start:
+            return
+        self.gaps += 1
+        logger.info(f"{self.exchange} stream: {pair} gap {start} - {end} scheduled for REST repair")
+        self.fetcher.failed_ranges.append((pair, start, end))
+
+    async def emit(self, pair: str, candle_start: datetime, candles: list) -> None:
+        """Закрытая свеча в сыром формате REST API биржи -> буфер фетчера"""
+        await self.fetcher.buffer.put(self.fetcher.process_candles(pair, candles))
+        last = self.last_closed.get(pair)
+        if last is None or candle_start > last:
+            self.last_closed[pair] = candle_start
+        self.candles += 1
+        self.closed.set()
+
+    @abc.abstractmethod
+    def subscribe_message(self, pairs: List[str]) -> dict:
+        """Сообщение подписки на пары; отправляется при каждом (пере)подключении"""
+
+    async def on_connect(self, pairs: List[str]) -> None:
+        pass
+
+    @abc.abstractmethod
+    async def handle_message(self, message: dict) -> None:
+        """Разобранное JSON-сообщение биржи; закрытые свечи передаются в emit()"""
+
+    async def tick(self) -> None:
+        """Вызывается примерно раз в секунду, даже если сообщений нет"""
+        pass
+
+    async def _listen(self, session: aiohttp.ClientSession) -> None:
+        async with session.ws_connect(self.url, heartbeat=self.heartbeat) as ws:
+            pairs = self.fetcher.symbols.filter(self.fetcher.target_pairs)
+            await ws.send_json(self.subscribe_message(pairs))
+            self.connected = True
+            self.connects += 1
+            logger.info(f"{self.exchange} stream: connected, subscribed to {len(pairs)} pairs")
+            await self.on_connect(pairs)
+
+            loop = asyncio.get_running_loop()
+            last_tick = loop.time()
+            while True:
+                try:
+                    msg = await ws.receive(timeout=1.0)
+                except asyncio.TimeoutError:
+                    msg = None
+
+                if msg is not None:
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        self.messages += 1
+                        await self.handle_message(json.loads(msg.data))
+                    elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSING,
+                                      aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        logger.warning(f"{self.exchange} stream: connection closed ({msg.type.name})")
+                        return
+
+                if loop.time() - last_tick >= 1.0:
+                    last_tick = loop.time()
+                    await self.tick()
+
+    async def run(self) -> None:
+        """Слушает поток до отмены задачи, переподключаясь после ошибок"""
+        delay = self.reconnect_delay
+        async with session_scope(self.fetcher.session_manager) as session:
+            while True:
+                connects = self.connects
+                try:
+                    await self._listen(session)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"{self.exchange} stream: {e}")
+                finally:
+                    self.connected = False
+
+                if self.connects > connects:
+                    delay = self.reconnect_delay
+                logger.info(f"{self.exchange} stream: reconnecting in {delay:.0f} seconds")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'connected': self.connected,
+            'connects': self.connects,
+            'messages': self.messages,
+            'candles': self.candles,
+            'gaps': self.gaps,
+        }
+
+
+class BinanceKlineStream(CandleStream):
+    """Потоки <symbol>@kline_5m; свеча отдаётся, когда Binance помечает её закрытой (k.x)"""
+
+    exchange = 'binance'
+
+    def __init__(self, fetcher, url: str = "wss://stream.binance.com:9443/ws", **kwargs):
+        super().__init__(fetcher, url, **kwargs)
+        self.symbol_map = {pair.replace('/', ''): pair for pair in fetcher.target_pairs}
+
+    def subscribe_message(self, pairs: List[str]) -> dict:
+        streams = [f"{pair.replace('/', '').lower()}@kline_5m" for pair in pairs]
+        return {"method": "SUBSCRIBE", "params": streams, "id": self.connects + 1}
+
+    async def handle_message(self, message: dict) -> None:
+        # Комбинированные потоки (/stream) заворачивают событие в {"stream", "data"}
+        message = message.get('data', message)
+        if message.get('e') != 'kline':
+            return
+        kline = message['k']
+        if not kline['x']:
+            return
+
+        pair = self.symbol_map.get(kline['s'])
+        if pair is None:
+            return
+        candle_start = datetime.fromtimestamp(kline['t'] / 1000, tz=timezone.utc)
+
+        # Binance отдаёт свечу каждого интервала, даже пустую: разрыв - это пропущенные события
+        last = self.last_closed.get(pair)
+        if last is not None:
+            self.record_gap(pair, last + self.interval, candle_start)
+
+        # Тот же формат, что у /api/v3/klines
+        candle = [kline['t'], kline['o'], kline['h'], kline['l'], kline['c'], kline['v'], kline['T'], kline['q']]
+        await self.emit(pair, candle_start, [candle])
+
+
+class CoinbaseMatchStream(CandleStream):
+    """
+    Канал matches Coinbase Exchange: свечи собираются из сделок в памяти.
+
+    Свеча закрывается первой сделкой следующего интервала или по таймеру через
+    close_delay после конца интервала. Свеча, начавшаяся до подключения, неполная:
+    она не отдаётся, а вместе с периодом обрыва уходит в REST-догрузку.
+    """
+
+    exchange = 'coinbase'
+
+    def __init__(self, fetcher, url: str = "wss://ws-feed.exchange.coinbase.com",
+                 close_delay: float = 2.0, **kwargs):
+        super().__init__(fetcher, url, **kwargs)
+        self.close_delay = close_delay
+        self.connected_at: Optional[datetime] = None
+        # pair -> [start, open, high, low, close, base_volume] текущей свечи
+        self.buckets: Dict[str, list] = {}
+
+    def subscribe_message(self, pairs: List[str]) -> dict:
+        return {"type": "subscribe", "product_ids": pairs, "channels": ["matches"]}
+
+    async def on_connect(self, pairs: List[str]) -> None:
+        self.connected_at = datetime.now(timezone.utc)
+        self.buckets = {}
+        partial_end = self.bucket_start(self.connected_at) + self.interval
+        for pair in pairs:
+            last = self.last_closed.get(pair)
+            if last is not None:
+                self.record_gap(pair, last + self.interval, partial_end)
+                self.last_closed[pair] = partial_end - self.interval
+
+    async def _close_bucket(self, pair: str) -> None:
+        start, open_, high, low, close, volume = self.buckets.pop(pair)
+        # Тот же формат, что у /products/<id>/candles: [time, low, high, open, close, volume]
+        await self.emit(pair, start, [[int(start.timestamp()), low, high, open_, close, volume]])
+
+    async def handle_message(self, message: dict) -> None:
+        message_type = message.get('type')
+        if message_type == 'error':
+            logger.error(f"coinbase stream: {message.get('message')} {message.get('reason', '')}")
+            return
+        if message_type != 'match':
+            return
+
+        pair = message['product_id']
+        price = float(message['price'])
+        size = float(message['size'])
+        traded_at = datetime.fromisoformat(message['time'].replace('Z', '+00:00'))
+        start = self.bucket_start(traded_at)
+        if start < self.connected_at:
+            return
+
+        bucket = self.buckets.get(pair)
+        if bucket is not None and start > bucket[0]:
+            await self._close_bucket(pair)
+            bucket = None
+
+        if bucket is None:
+            self.buckets[pair] = [start, price, price, price, price, size]
+        elif start == bucket[0]:
+            bucket[2] = max(bucket[2], price)
+            bucket[3] = min(bucket[3], price)
+            bucket[4] = price
+            bucket[5] += size
+
+    async def tick(self) -> None:
+        deadline = datetime.now(timezone.utc) - self.interval - timedelta(seconds=self.close_delay)
+        for pair in [pair for pair, bucket in self.buckets.items() if bucket[0] <= deadline]:
+            await self._close_bucket(pair)
@@ -2,22 +2,25 @@ import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
 import os
-import aiohttp
 import logging
 from typing import Dict, List, Optional, Union
 import sys
 from rich import print
+from indicator_engine import IndicatorEngine, ROLLING_INTERVALS, RESULT_COLUMNS
+from candle_store import CandleStore
+from candle_join import CandleJoin
+from premium_history import PremiumHistoryStore
+from rollup import plan_windows, rolling_bucket_medians, window_rank_errors
+from shard_pool import ShardPool
+from http_session import HttpSessionManager, session_scope
+import push_protocol
+import metrics
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('data_combiner.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# Запас истории перед окном 1Y при пересчёте рынка: окно строки перед опоздавшей свечой
+RECOMPUTE_MARGIN = pd.Timedelta(days=7)
+
 class DataValidationError(Exception):
     """Пользовательское исключение для ошибок валидации данных"""
     pass
@@ -25,10 +28,41 @@ class DataValidationError(Exception):
 class DataCombiner:
     """Класс для объединения и обработки рыночных данных от coinbase и Binance"""
     
-    def __init__(self, server_url: str = 'http://localhost:5000'):
+    def __init__(self, server_url: str = 'http://localhost:5000',
+                 session_manager: Optional[HttpSessionManager] = None,
+                 history: Optional[PremiumHistoryStore] = None,
+                 rank_error: Optional[float] = None,
+                 workers: int = 1,
+                 join: Optional[CandleJoin] = None):
         self.server_url = server_url
+        # Инкрементальное объединение по (market, 5m bucket): combine_batch() и полная история
+        # в combine_from_store(); без него - merge_asof по прочитанному интервалу
+        self.join = join
+        # workers > 1: объединение и полный расчёт индикаторов по шардам рынков в пуле процессов
+        self.shard_pool = ShardPool(workers) if workers > 1 else None
+        # rank_error - допустимая ошибка медиан по рангу (доля окна): длинные окна (1M, 1Y)
+        # считаются по скетчам часовых/дневных корзин, если укладываются в неё (см. rollup.py);
+        # None - все окна точно по 5-минутным свечам
+        self.rank_error = rank_error
+        self.window_plans = plan_windows(ROLLING_INTERVALS, rank_error)
+        for label, plan in self.window_plans.items():
+            if plan is not None:
+                logger.info(f"Avg {label}: approximate median from {plan.describe()}")
+        # История премии по монетам для /api/history; пополняется при каждом объединении из хранилища
+        self.history = history
+        # Общий пул HTTP-соединений; без него отправка открывает новую сессию
+        self.session_manager = session_manager
         self.raw_data = pd.DataFrame()
         self.processed_data = pd.DataFrame()
+        self.indicator_engine = IndicatorEngine(rank_error)
+        # Таблица индикаторов частями: полный расчёт, затем пересчитанные строки каждого цикла.
+        # Части только дописываются; строка может повторяться - действует последняя (indicator_history)
+        self.indicator_chunks: List[pd.DataFrame] = []
+        # Состояние дельта-протокола с веб-сервисом: номер последнего подтверждённого
+        # обновления, отправленные строки по монетам и формат (msgpack, если доступен)
+        self.push_seq = 0
+        self.pushed_rows: Dict[str, dict] = {}
+        self.push_format = push_protocol.supported_formats()[0]
         
         # Требуемые столбцы для проверки
         self.required_columns = {
@@ -90,21 +124,83 @@ class DataCombiner:
         try:
             # Read data files
             coinbase_df = pd.read_csv(coinbase_file)
-            coinbase_df['market'] = coinbase_df['market'].str.replace('-', '') + 'T'
             binance_df = pd.read_csv(binance_file)
+        except Exception as e:
+            logging.error(f"Error combining data: {e}")
+            raise
+        return self.combine_frames(coinbase_df, binance_df)
+
+    def combine_from_store(self, store: CandleStore, start=None, end=None) -> pd.DataFrame:
+        """Combines data from the partitioned candle store for the given time range"""
+        if self.join is not None:
+            combined = self.join.load(start, end)
+            self.processed_data = combined
+        else:
+            try:
+                coinbase_df = store.read('coinbase', start=start, end=end)
+                binance_df = store.read('binance', start=start, end=end)
+            except Exception as e:
+                logging.error(f"Error combining data: {e}")
+                raise
+            if coinbase_df.empty or binance_df.empty:
+                logger.warning("No candles in store for the requested range")
+                return pd.DataFrame()
+            combined = self.combine_frames(coinbase_df, binance_df)
+        if combined.empty:
+            logger.warning("No candles in store for the requested range")
+            return pd.DataFrame()
+        if self.history is not None:
+            self.history.upsert(combined)
+        return combined
+
+    @metrics.timed_stage('join_candles')
+    def combine_batch(self, coinbase_df: pd.DataFrame, binance_df: pd.DataFrame) -> pd.DataFrame:
+        """Joins only newly arrived candles (and the buckets they complete) via CandleJoin"""
+        combined = self.join.update(coinbase_df, binance_df)
+        logger.info(f"Joined {len(combined)} buckets: {self.join.stats()}")
+        if self.history is not None and not combined.empty:
+            self.history.upsert(combined)
+        return combined
+
+    def _worker_config(self) -> dict:
+        """Параметры DataCombiner в процессах пула"""
+        return {'rank_error': self.rank_error}
+
+    def close(self) -> None:
+        if self.shard_pool is not None:
+            self.shard_pool.close()
+
+    @metrics.timed_stage('combine_data')
+    def combine_frames(self, coinbase_df: pd.DataFrame, binance_df: pd.DataFrame) -> pd.DataFrame:
+        """Combines coinbase and Binance candle frames (fetcher schema)"""
+        if self.shard_pool is not None:
+            keys = pd.concat([coinbase_df['market'].str.replace('-', '') + 'T',
+                              binance_df['market'].str.replace('/', '')], ignore_index=True)
+            if self.shard_pool.should_shard(len(keys), keys.nunique()):
+                shard_ids = self.shard_pool.assign(keys)
+                parts = self.shard_pool.run('combine', [coinbase_df, binance_df],
+                                            [shard_ids[:len(coinbase_df)], shard_ids[len(coinbase_df):]],
+                                            self._worker_config())
+                self.processed_data = (pd.concat(parts, ignore_index=True)
+                                       .sort_values(by=['market', 'timestamp_coinbase'])
+                                       .reset_index(drop=True))
+                return self.processed_data
+
+        try:
+            coinbase_df['market'] = coinbase_df['market'].str.replace('-', '') + 'T'
             
             # Rename columns to avoid conflicts and create required columns
             coinbase_df = coinbase_df.rename(columns={
                 'close_price': 'close_price_coinbase',
                 'volume': 'volume_coinbase'
             })
-            coinbase_df = coinbase_df.drop(columns=['opening_price', 'high_price', 'low_price', 'market_type'])
+            coinbase_df = coinbase_df.drop(columns=['opening_price', 'high_price', 'low_price', 'market_type'], errors='ignore')
             
             binance_df = binance_df.rename(columns={
                 'close_price': 'close_price_binance',
                 'quote_volume': 'volume_binance'
             })
-            binance_df = binance_df.drop(columns=['opening_price', 'volume', 'high_price', 'low_price', 'market_type'])
+            binance_df = binance_df.drop(columns=['opening_price', 'volume', 'high_price', 'low_price', 'market_type'], errors='ignore')
             binance_df['market'] = binance_df['market'].replace('/', '', regex=True)
             
             # Convert timestamps with UTC awareness
@@ -163,8 +259,9 @@ class DataCombiner:
         else:
             return f"{value:.2f}"
 
-    def _calculate_indicators(self, df: pd.DataFrame) -> pd.DataFrame:
-        """Вычисляет премии и объемы по каждому токену и сохраняет в итоговую таблицу"""
+    @metrics.timed_stage('calculate_indicators')
+    def _calculate_indicators(self, df: pd.DataFrame, raw: bool = False) -> pd.DataFrame:
+        """Вычисляет премии и объемы по каждому токену и сохраняет в итоговую таблицу (raw - без форматирования)"""
         
         # Проверка наличия нужных столбцов
         required_columns = [
@@ -178,129 +275,138 @@ class DataCombiner:
             print(f"Warning: Missing columns: {missing_columns}")
             return pd.DataFrame()  # Возвращаем пустой DataFrame, если данных недостаточно
         
-        def calculate_for_group(group):
-            group = group.sort_values('timestamp_coinbase')  # Сортировка по времени
-            group = group.set_index('timestamp_coinbase')  # Устанавливаем timestamp_coinbase как индекс
-            
-            # Премии
-            group['Coinbase Premium'] = group['close_price_coinbase'] - group['close_price_binance']
-            group['Coinbase Premium %'] = (group['Coinbase Premium'] / group['close_price_binance']) * 100
-            
-            # Скользящие метрики
-            rolling_intervals = {
-                '1H': '60min', 
-                '24H': '1D', 
-                '1M': '30D',
-                '1Y': '365D'  # Добавляем годовой интервал
-            }
-            
-            for label, period in rolling_intervals.items():
-                # Используем shift(-1) перед расчетом скользящих средних
-                shifted_premium = group['Coinbase Premium'].shift(-1)
-                shifted_premium_pct = group['Coinbase Premium %'].shift(-1)
-                
-                group[f'Avg {label} Premium Diff'] = (
-                    shifted_premium
-                    .rolling(window=period, min_periods=1)
-                    .median()
-                )
-                group[f'Avg {label} Premium %'] = (
-                    shifted_premium_pct
-                    .rolling(window=period, min_periods=1)
-                    .median()
-                )
-                group[f'Current Diff {label}'] = group['Coinbase Premium'] - group[f'Avg {label} Premium Diff']
-                group[f'Current % {label}'] = group['Coinbase Premium %'] - group[f'Avg {label} Premium %']
-            
-            # Модифицируем расчет объемов
-            shifted_volume = group['volume_coinbase'].shift(-1)
-            
-            group['Avg 1H Volume'] = (
-                shifted_volume
-                .rolling(window='60min', min_periods=1)
-                .median()
-            )
-            
-            group['Avg 24H Volume'] = (
-                shifted_volume
-                .rolling(window='1D', min_periods=1)
-                .median()
-            )
-            
-            group['Avg 1M Volume'] = (
-                shifted_volume
-                .rolling(window='30D', min_periods=1)
-                .median()
-            )
-            
-            group['Avg 1Y Volume'] = (
-                shifted_volume
-                .rolling(window='365D', min_periods=1)
-                .median()
-            )
-            
-            group['Coinbase Volume Diff %'] = (
-                (shifted_volume - group['Avg 1H Volume']) / group['Avg 1H Volume'] * 100
-            )
-            
-            # Перепишем таблицу с нужной структурой
-            result = pd.DataFrame({
-                'DateTime': group.index,
-                'Coin': group['market'],
-                'Price @ Coinbase': group['close_price_coinbase'],
-                'Price @ Binance': group['close_price_binance'],
-            #    'coinbase Premium': group['coinbase Premium'],
-                'Coinbase Premium %': group['Coinbase Premium %'],
-            #    'Avg 1H Premium Diff': group['Avg 1H Premium Diff'],
-                'Avg 1H Premium %': group['Avg 1H Premium %'],
-            #    'Current Diff 1H': group['Current Diff 1H'],
-                'Current % 1H': group['Current % 1H'],
-            #    'Avg 24H Premium Diff': group['Avg 24H Premium Diff'],
-                'Avg 24H Premium %': group['Avg 24H Premium %'],
-            #    'Current Diff 24H': group['Current Diff 24H'],
-                'Current % 24H': group['Current % 24H'],
-            #    'Avg 1M Premium Diff': group['Avg 1M Premium Diff'],
-                'Avg 1M Premium %': group['Avg 1M Premium %'],
-            #    'Current Diff 1M': group['Current Diff 1M'],
-                'Current % 1M': group['Current % 1M'],
-            #    'Avg 1Y Premium Diff': group['Avg 1Y Premium Diff'],  # Добавляем годовые метрики
-                'Avg 1Y Premium %': group['Avg 1Y Premium %'],
-             #   'Current Diff 1Y': group['Current Diff 1Y'],
-                'Current % 1Y': group['Current % 1Y'],
-                'Current Volume': group['volume_coinbase'],
-                'Avg 1H Volume': group['Avg 1H Volume'],
-                'Avg 24H Volume': group['Avg 24H Volume'],
-                'Avg 1M Volume': group['Avg 1M Volume'],
-                'Avg 1Y Volume': group['Avg 1Y Volume'],  # Добавляем годовой объем
-                'Coinbase Volume Diff %': group['Coinbase Volume Diff %']
-            })
-            
-            return result
+        if df.empty:
+            empty = pd.DataFrame(columns=RESULT_COLUMNS)
+            return empty if raw else self._format_indicators(empty)
 
-        # Инициализация итогового DataFrame со всеми колонками, включая новые годовые
-        result_df = pd.DataFrame(columns=[
-            'DateTime', 'Coin', 'Price @ Coinbase', 'Price @ Binance',
-            'Coinbase Premium %', 'Avg 1H Premium %',
-            'Current % 1H', 'Avg 24H Premium %',
-            'Current % 24H', 'Avg 1M Premium %',
-            'Current % 1M','Avg 1Y Premium %',  
-            'Current % 1Y', 'Current Volume', 
-            'Avg 1H Volume','Avg 24H Volume', 
-            'Avg 1M Volume', 'Avg 1Y Volume', 
-            'Coinbase Volume Diff %'
-        ])
-
-        # Применяем функцию к каждой группе по токенам и добавляем к итоговому DataFrame
-        grouped_df = df.groupby('market')
-        
-        for name, group in grouped_df:
-            group_result = calculate_for_group(group)
-            
-            if group_result.empty:
-                print(f"Warning: Group for {name} resulted in an empty DataFrame.")
-            
-            result_df = pd.concat([result_df, group_result], ignore_index=True)
+        if self.shard_pool is not None and self.shard_pool.should_shard(len(df), df['market'].nunique()):
+            return self._calculate_sharded(df, raw)
 
+        # Один проход по всем рынкам: сортировка один раз, сдвиг и скользящие медианы
+        # считаются groupby по всей таблице, итог собирается одним DataFrame без pd.concat
+        data = df.sort_values(['market', 'timestamp_coinbase'], kind='mergesort')
+        timestamps = data['timestamp_coinbase']
+        premium_pct, series = self._window_series(data)
+        grouped = series.groupby('market', sort=False)[['premium_pct', 'volume']]
+
+        # Группы идут в порядке сортировки data, поэтому результат rolling совпадает с ней построчно
+        medians = {}
+        for label, period in ROLLING_INTERVALS.items():
+            plan = self.window_plans[label]
+            if plan is None:
+                rolled = grouped.rolling(window=period, min_periods=1).median()
+                medians[label] = (rolled['premium_pct'].to_numpy(), rolled['volume'].to_numpy())
+            else:
+                # Окно по скетчам корзин уровня вместо тысяч 5-минутных строк
+                rolled = rolling_bucket_medians(
+                    series.index.asi8, pd.factorize(series['market'])[0],
+                    {'premium_pct': series['premium_pct'].to_numpy(), 'volume': series['volume'].to_numpy()},
+                    period, plan.resolution, plan.sketch)
+                medians[label] = (rolled['premium_pct'], rolled['volume'])
+
+        premium_pct = premium_pct.to_numpy()
+        shifted_volume = series['volume'].to_numpy()
+        avg_1h_volume = medians['1H'][1]
+
+        # Перепишем таблицу с нужной структурой
+        result = {
+            'DateTime': timestamps.array,
+            'Coin': data['market'].to_numpy(),
+            'Price @ Coinbase': data['close_price_coinbase'].to_numpy(),
+            'Price @ Binance': data['close_price_binance'].to_numpy(),
+            'Coinbase Premium %': premium_pct,
+        }
+        for label in ROLLING_INTERVALS:
+            result[f'Avg {label} Premium %'] = medians[label][0]
+            result[f'Current % {label}'] = premium_pct - medians[label][0]
+        result['Current Volume'] = data['volume_coinbase'].to_numpy()
+        for label in ROLLING_INTERVALS:
+            result[f'Avg {label} Volume'] = medians[label][1]
+        result['Coinbase Volume Diff %'] = (shifted_volume - avg_1h_volume) / avg_1h_volume * 100
+
+        result_df = pd.DataFrame(result)
+        return result_df if raw else self._format_indicators(result_df)
+
+    @staticmethod
+    def _window_series(data: pd.DataFrame):
+        """
+        Премия и ряды окон для таблицы, отсортированной по (market, время): shift(-1)
+        внутри каждого рынка - значение следующей свечи под временем текущей.
+        """
+        premium = data['close_price_coinbase'] - data['close_price_binance']
+        premium_pct = (premium / data['close_price_binance']) * 100
+        series = pd.DataFrame({
+            'market': data['market'].to_numpy(),
+            'premium_pct': premium_pct.to_numpy(),
+            'volume': data['volume_coinbase'].to_numpy(),
+        }, index=pd.DatetimeIndex(data['timestamp_coinbase']))
+        grouped = series.groupby('market', sort=False)
+        series[['premium_pct', 'volume']] = grouped[['premium_pct', 'volume']].shift(-1)
+        return premium_pct, series
+
+    def _calculate_sharded(self, df: pd.DataFrame, raw: bool) -> pd.DataFrame:
+        """_calculate_indicators по шардам рынков в пуле процессов, в той же схеме и порядке"""
+        parts = self.shard_pool.run('indicators', [df], [self.shard_pool.assign(df['market'])],
+                                    self._worker_config(), {'raw': raw})
+        # Метки строк как у расчёта в одном процессе: позиция в порядке (рынок, время)
+        result_df = (pd.concat(parts, ignore_index=True)
+                     .sort_values(['Coin', 'DateTime'], kind='mergesort')
+                     .reset_index(drop=True))
+        return result_df if raw else result_df.sort_values(['DateTime', 'Coin'])
+
+    def compare_with_exact(self, df: pd.DataFrame, sample: int = 2000) -> Dict[str, Dict[str, float]]:
+        """
+        Сравнивает приближённые окна (скетчи корзин) с точным расчётом pandas по свечам.
+        Для каждой приближённой колонки: граница ошибки по рангу и фактическая ошибка по
+        рангу относительно точного окна (по sample строкам с полным окном), абсолютная
+        ошибка премии или относительная ошибка объёма и доля строк, у которых отличается
+        значение в том виде, как его показывает дашборд.
+        """
+        exact = DataCombiner(self.server_url)._calculate_indicators(df, raw=True)
+        approx = self._calculate_indicators(df, raw=True)
+        # Строки расчёта идут в порядке (market, время), как и ряды окон
+        data = df.sort_values(['market', 'timestamp_coinbase'], kind='mergesort')
+        _, series = self._window_series(data)
+        keys = series.index.asi8
+        codes = pd.factorize(series['market'])[0]
+        starts = pd.Series(keys).groupby(codes).transform('min').to_numpy()
+        report = {}
+        for label, plan in self.window_plans.items():
+            if plan is None:
+                continue
+            period = pd.Timedelta(ROLLING_INTERVALS[label]).value
+            full = np.flatnonzero(keys - period >= starts)
+            rows = full[np.linspace(0, len(full) - 1, min(sample, len(full))).astype(np.int64)] if len(full) else full
+            for col, name, is_volume in ((f'Avg {label} Premium %', 'premium_pct', False),
+                                         (f'Avg {label} Volume', 'volume', True)):
+                expected = exact[col].to_numpy(dtype=np.float64)
+                actual = approx[col].to_numpy(dtype=np.float64)
+                ranks = window_rank_errors(keys, codes, series[name].to_numpy(), actual, period, rows)
+                ranks = ranks[~np.isnan(ranks)]
+                both = ~np.isnan(expected) & ~np.isnan(actual)
+                expected, actual = expected[both], actual[both]
+                if is_volume:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        error = np.abs(actual - expected) / np.abs(expected)
+                    error = error[np.isfinite(error)]
+                    shown = self._map_unique(pd.Series(actual), self._convert_volume)
+                    mismatch = shown != self._map_unique(pd.Series(expected), self._convert_volume)
+                else:
+                    error = np.abs(actual - expected)
+                    mismatch = np.round(actual, 2) != np.round(expected, 2)
+                report[col] = {
+                    'rank_error_bound': plan.rank_error,
+                    'max_rank_error': float(ranks.max()) if len(ranks) else 0.0,
+                    'rows_checked': len(ranks),
+                    'max_error': float(error.max()) if len(error) else 0.0,
+                    'p99_error': float(np.quantile(error, 0.99)) if len(error) else 0.0,
+                    'display_mismatch': float(mismatch.mean()) if len(mismatch) else 0.0,
+                }
+                logger.info(f"{col} ({plan.describe()}): {report[col]}")
+        return report
+
+    def _format_indicators(self, result_df: pd.DataFrame) -> pd.DataFrame:
+        """Округление, форматирование объемов и сортировка итоговой таблицы"""
         price_columns = [
             'Price @ Coinbase', 'Price @ Binance'
         ]
@@ -330,16 +436,101 @@ class DataCombiner:
 
         for col in volume_columns:
             if col in result_df.columns:
-                result_df[col] = result_df[col].apply(self._convert_volume)  # Убираем lambda и float()
+                result_df[col] = self._map_unique(result_df[col], self._convert_volume)
 
         result_df = result_df.sort_values(['DateTime', 'Coin'])
-        result_df['DateTime'] = result_df['DateTime'].apply(lambda x: str(x)[:16])
+        result_df['DateTime'] = self._map_unique(result_df['DateTime'], lambda x: str(x)[:16])
         return result_df
 
-    def save_combined_data(self, file_path: str) -> None:
-        """Сохраняет обработанные данные в файл"""
+    @staticmethod
+    def _map_unique(series: pd.Series, func) -> np.ndarray:
+        """Форматирует только уникальные значения колонки (время общее для всех рынков, медианы повторяются)"""
+        codes, uniques = pd.factorize(series, use_na_sentinel=False)
+        return np.asarray([func(value) for value in uniques], dtype=object)[codes]
+
+    @metrics.timed_stage('update_indicators')
+    def update_indicators(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Инкрементальный пересчёт индикаторов через IndicatorEngine.
+        Считаются только новые свечи каждого рынка; возвращаются только пересчитанные строки
+        (при первом запуске - вся таблица), они же дописываются в indicator_chunks.
+        """
+        if not self.indicator_engine.markets or not self.indicator_chunks:
+            # Первый запуск - полный расчёт и загрузка состояния окон
+            raw = self._calculate_indicators(df, raw=True)
+            self.indicator_engine.prime(df, raw)
+            result = self._format_indicators(raw).reset_index(drop=True)
+            self.indicator_chunks = [result]
+            return result
+
+        parts = []
+        late = self.indicator_engine.late_markets(df)
+        if late and self.join is None:
+            logger.warning(f"Dropping late candles of {len(late)} markets: no joined series to recompute from")
+        elif late:
+            parts.append(self._recompute_markets(late))
+            df = df[~df['market'].isin(list(late))]
+        new_rows = self.indicator_engine.select_new_rows(df)
+        parts.append(self.indicator_engine.update(new_rows))
+        parts = [part for part in parts if not part.empty]
+        raw = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=RESULT_COLUMNS)
+        updated = self._format_indicators(raw).reset_index(drop=True)
+        logger.info(f"Recalculated {len(updated)} indicator rows from {len(new_rows)} new candles"
+                    f" and {len(late)} recomputed markets")
+        if not updated.empty:
+            self.indicator_chunks.append(updated)
+        return updated
+
+    def _recompute_markets(self, late: Dict[str, pd.Timestamp]) -> pd.DataFrame:
+        """
+        Пересчёт рынков с самого раннего изменённого времени по объединённой серии: полный
+        расчёт по истории рынка и новое состояние движка. Возвращает строки (без форматирования)
+        с изменённого времени и предыдущую строку - её окна и Volume Diff видят следующую свечу.
+        """
+        longest = max(pd.Timedelta(period) for period in ROLLING_INTERVALS.values())
+        history = self.join.read(start=min(late.values()) - longest - RECOMPUTE_MARGIN, markets=list(late))
+        raw = self._calculate_indicators(history, raw=True)
+        changed = raw['Coin'].map(pd.Series(late, dtype='datetime64[ns, UTC]'))
+        previous = raw['DateTime'].where(raw['DateTime'] < changed).groupby(raw['Coin']).transform('max')
+        rows = raw[raw['DateTime'] >= previous.fillna(changed)]
+
+        indicators = dict(tuple(raw.groupby('Coin', sort=False)))
+        for market, group in history.groupby('market'):
+            self.indicator_engine.prime_market(market, group, indicators.get(market))
+        logger.info(f"Recomputed {len(rows)} indicator rows of {len(late)} markets with late candles")
+        return rows.reset_index(drop=True)
+
+    def indicator_history(self) -> pd.DataFrame:
+        """Полная таблица индикаторов из indicator_chunks: последняя версия каждой строки"""
+        if not self.indicator_chunks:
+            return pd.DataFrame(columns=RESULT_COLUMNS)
+        data = pd.concat(self.indicator_chunks, ignore_index=True)
+        return (data.drop_duplicates(subset=['Coin', 'DateTime'], keep='last')
+                .sort_values(['DateTime', 'Coin'], kind='mergesort')
+                .reset_index(drop=True))
+
+    def save_combined_data(self, file_path: str, data: Optional[pd.DataFrame] = None) -> None:
+        """Сохраняет обработанные данные (по умолчанию processed_data) в файл"""
     #    logger.info(f"Saving combined data to {"combined_data_with_indicators.csv"}")
-        self.processed_data.to_csv(file_path, index=False)
+        (self.processed_data if data is None else data).to_csv(file_path, index=False)
+
+    def save_indicator_rows(self, directory: str, rows: pd.DataFrame, append: bool = True) -> int:
+        """
+        Дописывает строки индикаторов (результат update_indicators) в <directory>/<YYYY-MM-DD>.csv.
+        Пересчитанная строка дописывается повторно - при чтении действует последняя по (Coin, DateTime).
+        append=False перезаписывает затронутые дни (полный расчёт). Возвращает число файлов.
+        """
+        if rows.empty:
+            return 0
+        os.makedirs(directory, exist_ok=True)
+        written = 0
+        # DateTime уже отформатирован как 'YYYY-MM-DD HH:MM'
+        for day, part in rows.groupby(rows['DateTime'].str[:10], sort=True):
+            path = os.path.join(directory, f"{day}.csv")
+            header = not append or not os.path.exists(path)
+            part.to_csv(path, mode='a' if append else 'w', header=header, index=False)
+            written += 1
+        return written
 
     def save_processed_indicators(self, file_path: str) -> None:
         """Сохраняет вычисленные индикаторы"""
@@ -347,35 +538,101 @@ class DataCombiner:
         processed_indicators = self._calculate_indicators(self.processed_data)
         processed_indicators.to_csv(file_path, index=False)
 
-    async def send_to_web_service(self) -> None:
-        """Send last record for each unique coin to web service"""
-        if self.processed_data.empty:
+    def _latest_rows(self, data: Optional[pd.DataFrame] = None) -> Dict[str, dict]:
+        """
+        Последняя строка по каждой монете (без NaN), ключ - Coin.
+        Без data - из IndicatorEngine.latest (после update_indicators), иначе по processed_data.
+        """
+        if data is None and self.indicator_engine.latest:
+            data = self._format_indicators(pd.DataFrame(list(self.indicator_engine.latest.values()),
+                                                        columns=RESULT_COLUMNS))
+            latest = data.sort_values('Coin').dropna()
+            return {row['Coin']: row for row in latest.to_dict(orient='records')}
+        if data is None:
+            data = self.processed_data
+        # Таблица индикаторов уже отсортирована по DateTime - повторная сортировка не нужна
+        if not data['DateTime'].is_monotonic_increasing:
+            data = data.sort_values(['DateTime', 'Coin'])
+        latest = (data
+                  .drop_duplicates(subset=['Coin', 'DateTime'], keep='last')  # Удаляем дубликаты, оставляя последнюю запись
+                  .groupby('Coin')  # Группируем по монетам
+                  .last()  # Берем последнюю запись для каждой группы
+                  .reset_index()
+                  .dropna())  # Удаляем строки, содержащие NaN
+        return {row['Coin']: row for row in latest.to_dict(orient='records')}
+
+    async def _post_update(self, session, message: dict) -> int:
+        """POST одного сообщения в согласованном формате; 415 - переход на JSON"""
+        while True:
+            body = push_protocol.encode(message, self.push_format)
+            async with session.post(f"{self.server_url}/update_data", data=body,
+                                    headers={'Content-Type': self.push_format}) as response:
+                if response.status == 415 and self.push_format != push_protocol.JSON:
+                    logger.info(f"Web service does not accept {self.push_format}, falling back to JSON")
+                    self.push_format = push_protocol.JSON
+                    continue
+                return response.status
+
+    async def send_to_web_service(self, latest: Optional[Dict[str, dict]] = None) -> None:
+        """
+        Send changed coins to the web service as a versioned delta.
+        Only coins whose latest row differs from the last acknowledged push are sent;
+        on a version gap (HTTP 409) the full state is resent.
+        latest - _latest_rows() prepared off the event loop (ingest pipeline compute stage).
+        """
+        if latest is None and self.processed_data.empty and not self.indicator_engine.latest:
             logger.error("No data to send to web service")
             return
-        try:
-            # Получаем последние данные для каждого уникального коина, удаляя дубликаты по времени
-            data_to_send = (self.processed_data
-                        .sort_values(['DateTime', 'Coin'])  # Сортируем по времени и монетам
-                        .drop_duplicates(subset=['Coin', 'DateTime'], keep='last')  # Удаляем дубликаты, оставляя последнюю запись
-                        .groupby('Coin')  # Группируем по монетам
-                        .last()  # Берем последнюю запись для каждой группы
-                        .reset_index()  # Сбрасываем индекс
-                        .dropna()  # Удаляем строки, содержащие NaN
-                        .to_dict(orient='records'))  # Конвертируем в список словарей
-            
-            # Выводим количество уникальных монет без NaN
-            print(f"Sending data for {len(data_to_send)} unique coins (excluding rows with NaN values)")
-
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{self.server_url}/update_data", json=data_to_send) as response:
-                    if response.status == 200:
-                        logger.info(f"Successfully sent data for {len(data_to_send)} coins")
-                    else:
-                        logger.error(f"Failed to send data to web service: {response.status}")
-        except Exception as e:
-            logger.error(f"Error sending data to web service: {str(e)}")
+        with metrics.stage('send_to_web_service', rows_in=len(self.processed_data)) as timer:
+            try:
+                if latest is None:
+                    latest = self._latest_rows()
+                full = not self.pushed_rows
+                changed = [row for coin, row in latest.items() if self.pushed_rows.get(coin) != row]
+                removed = [coin for coin in self.pushed_rows if coin not in latest]
+                if not full and not changed and not removed:
+                    logger.info("No coin changed since the last push")
+                    return
+
+                async with session_scope(self.session_manager) as session:
+                    message = push_protocol.make_message(
+                        self.push_seq + 1, self.push_seq,
+                        list(latest.values()) if full else changed, removed, full=full
+                    )
+                    status = await self._post_update(session, message)
+                    if status == 409:
+                        # Сервер потерял или опередил нашу версию - отправляем всё состояние
+                        logger.info("Web service requested a full resync")
+                        full = True
+                        message = push_protocol.make_message(self.push_seq + 1, self.push_seq,
+                                                             list(latest.values()), full=True)
+                        status = await self._post_update(session, message)
+
+                if status == 200:
+                    self.push_seq = message['seq']
+                    self.pushed_rows = latest
+                    timer.rows_out = len(message['rows'])
+                    if latest:
+                        metrics.observe_candle_lag('pushed', max(row['DateTime'] for row in latest.values()))
+                    logger.info(f"Successfully sent {'full state' if full else 'delta'} "
+                                f"#{self.push_seq}: {len(message['rows'])} of {len(latest)} coins")
+                else:
+                    metrics.STAGE_ERRORS.inc(stage='send_to_web_service')
+                    logger.error(f"Failed to send data to web service: {status}")
+            except Exception as e:
+                metrics.STAGE_ERRORS.inc(stage='send_to_web_service')
+                logger.error(f"Error sending data to web service: {str(e)}")
 
 def main():
+    # Логирование настраивает точка входа: модуль импортируют воркеры ShardPool (spawn)
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler('data_combiner.log'),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
     combiner = DataCombiner()
     coinbase_file = "coinbase_data.csv"
     binance_file = "binance_data.csv"
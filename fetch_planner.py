@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import pandas as pd
+
+from candle_store import CandleStore
+
+logger = logging.getLogger(__name__)
+
+Range = Tuple[datetime, datetime]
+
+# Журнал интервалов, на которые биржа ответила без свечей, в корне хранилища свечей
+EMPTY_FILE = 'empty_ranges.json'
+
+# Интервал считается пустым, только если свеча закрылась хотя бы EMPTY_SETTLE назад
+EMPTY_SETTLE = timedelta(minutes=15)
+
+
+def empty_ranges(pair: str, start: datetime, end: datetime, times: Iterable[int],
+                 interval: timedelta = timedelta(minutes=5), now: Optional[datetime] = None) -> List[tuple]:
+    """
+    (pair, start, end) интервалов окна [start, end], за которые успешный ответ не содержал свечей
+    (times - начала полученных свечей, секунды epoch). Учитываются только закрытые свечи
+    (старше now - EMPTY_SETTLE): последняя свеча могла ещё не появиться.
+    """
+    step = int(interval.total_seconds())
+    now = now or datetime.now(timezone.utc)
+    first = -(-int(start.timestamp()) // step) * step
+    stop = int(min(end, now - EMPTY_SETTLE).timestamp())
+    present = set(int(t) for t in times)
+    ranges = []
+    for t in range(first, stop - step + 1, step):
+        if t in present:
+            continue
+        if ranges and ranges[-1][1] == t:
+            ranges[-1][1] = t + step
+        else:
+            ranges.append([t, t + step])
+    return [(pair, datetime.fromtimestamp(a, timezone.utc), datetime.fromtimestamp(b, timezone.utc))
+            for a, b in ranges]
+
+
+class FetchPlanner:
+    """
+    Планировщик догрузки свечей по (exchange, market).
+
+    Знает последнюю сохранённую свечу каждого рынка (high-water mark из CandleStore),
+    при первом обращении к рынку ищет дыры в истории, а также принимает интервалы,
+    которые фетчеры пропустили после "Max retries reached". plan() выдаёт минимальный
+    набор интервалов для fetch_historical_candles: обычно это только хвост с последней
+    (возможно незакрытой) свечи до текущего момента.
+
+    Интервалы, которые биржа уже вернула пустыми (mark_empty; у Coinbase нет свечей для 5m
+    без сделок), хранятся в журнале <store.root>/empty_ranges.json и дырами не считаются,
+    в том числе после перезапуска.
+    """
+
+    def __init__(self, store: CandleStore, interval: timedelta = timedelta(minutes=5),
+                 merge_gap: timedelta = timedelta(hours=1)):
+        self.store = store
+        self.interval = interval
+        # Соседние дыры ближе merge_gap объединяются в один запрос
+        self.merge_gap = merge_gap
+        self.scanned = set()
+        self.pending: Dict[tuple, List[Range]] = {}
+        # "exchange|market" -> [[начало, конец)] пустых интервалов, нс
+        self.empty_path = os.path.join(store.root, EMPTY_FILE)
+        self.empty: Dict[str, List[List[int]]] = self._load_empty()
+
+    def add_gaps(self, exchange: str, ranges: Iterable[tuple]) -> None:
+        """Добавляет интервалы (market, start, end), которые нужно догрузить"""
+        for market, start, end in ranges:
+            self.pending.setdefault((exchange, market), []).append((start, end))
+            logger.info(f"{exchange} {market}: scheduled refetch of {start} - {end}")
+
+    def _load_empty(self) -> Dict[str, List[List[int]]]:
+        if not os.path.exists(self.empty_path):
+            return {}
+        with open(self.empty_path) as f:
+            return json.load(f)
+
+    def _save_empty(self) -> None:
+        os.makedirs(os.path.dirname(self.empty_path) or '.', exist_ok=True)
+        tmp_path = f"{self.empty_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.empty, f)
+        os.replace(tmp_path, self.empty_path)
+
+    def mark_empty(self, exchange: str, ranges: Iterable[tuple]) -> None:
+        """Отмечает интервалы (market, start, end), на которые биржа ответила без свечей"""
+        ranges = list(ranges)
+        if not ranges:
+            return
+        for market, start, end in ranges:
+            self.empty.setdefault(f"{exchange}|{market}", []).append(
+                [pd.Timestamp(start).value, pd.Timestamp(end).value])
+        for key in {f"{exchange}|{market}" for market, _, _ in ranges}:
+            merged = []
+            for start, end in sorted(self.empty[key]):
+                if merged and start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], end)
+                else:
+                    merged.append([start, end])
+            self.empty[key] = merged
+        self._save_empty()
+
+    def _subtract_empty(self, exchange: str, market: str, gaps: List[Range]) -> List[Range]:
+        """Части пропусков, которые не покрыты пустыми интервалами журнала"""
+        spans = self.empty.get(f"{exchange}|{market}")
+        if not spans:
+            return gaps
+        left = []
+        for gap_start, gap_end in gaps:
+            cursor = pd.Timestamp(gap_start).value
+            stop = pd.Timestamp(gap_end).value
+            for start, end in spans:
+                if end <= cursor or start >= stop:
+                    continue
+                if start > cursor:
+                    left.append((cursor, start))
+                cursor = max(cursor, end)
+            if cursor < stop:
+                left.append((cursor, stop))
+        return [(pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC')) for start, end in left]
+
+    def _scan(self, exchange: str, market: str, start: datetime) -> None:
+        """Ищет пропуски в сохранённой истории рынка начиная со start"""
+        key = (exchange, market)
+        self.scanned.add(key)
+        timestamps = self.store.timestamps(exchange, market, start=start)
+        if timestamps.empty:
+            return
+
+        gaps = []
+        if timestamps[0] - pd.Timestamp(start) >= self.interval:
+            gaps.append((pd.Timestamp(start), timestamps[0]))
+
+        deltas = timestamps[1:] - timestamps[:-1]
+        for idx in (deltas > self.interval).nonzero()[0]:
+            gaps.append((timestamps[idx] + self.interval, timestamps[idx + 1]))
+
+        gaps = self._subtract_empty(exchange, market, gaps)
+        if gaps:
+            logger.info(f"{exchange} {market}: found {len(gaps)} gaps in stored history")
+            self.pending.setdefault(key, []).extend(gaps)
+
+    def _coalesce(self, ranges: List[Range]) -> List[Range]:
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start - merged[-1][1] <= self.merge_gap:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    def plan(self, exchange: str, markets: List[str], start: datetime, end: datetime,
+             include_tail: bool = True, closed_only: bool = False) -> Dict[str, List[Range]]:
+        """
+        Интервалы для догрузки по каждому рынку в пределах [start, end].
+        Пропуски выдаются один раз; неудачные запросы возвращаются через add_gaps().
+        include_tail=False - только пропуски (хвост приходит из WebSocket-потока).
+        closed_only - end перед границей свечи и в хранилище только закрытые свечи (CandleClock):
+        рынок, у которого последняя закрытая свеча уже сохранена, хвоста не получает.
+        """
+        plan = {}
+        for market in markets:
+            key = (exchange, market)
+            if key not in self.scanned:
+                self._scan(exchange, market, start)
+
+            ranges = [(max(pd.Timestamp(gap_start), pd.Timestamp(start)), gap_end)
+                      for gap_start, gap_end in self.pending.pop(key, [])
+                      if gap_end > start]
+
+            # Хвост начинается с последней свечи: она могла быть незакрытой
+            last = self.store.last_timestamp(exchange, market)
+            tail_start = pd.Timestamp(start) if last is None else max(last, pd.Timestamp(start))
+            complete = closed_only and last is not None and last + self.interval > pd.Timestamp(end)
+            if include_tail and tail_start < end and not complete:
+                ranges.append((tail_start, end))
+
+            ranges = self._coalesce(ranges)
+            if ranges:
+                plan[market] = ranges
+
+        requested = sum(len(ranges) for ranges in plan.values())
+        logger.info(f"{exchange}: planned {requested} ranges for {len(plan)} markets")
+        return plan
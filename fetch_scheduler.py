@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Iterable, Tuple
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# (session, pair, window_start, window_end) - аргументы fetch_job фетчера
+Job = Tuple[aiohttp.ClientSession, str, datetime, datetime]
+
+
+class FetchScheduler:
+    """
+    Очередь заданий (pair, окно времени), которую обслуживают N воркеров.
+
+    Медленная пара занимает только одного воркера, остальные продолжают брать задания,
+    поэтому пропускная способность упирается в лимитер биржи, а не в самую медленную
+    пару в пачке. Прогресс и ETA пишутся в лог раз в progress_interval секунд.
+    """
+
+    def __init__(self, name: str, workers: int, progress_interval: float = 10.0):
+        self.name = name
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.started_at = None
+        self._last_report = 0.0
+
+    def progress(self) -> Dict[str, float]:
+        """Выполнено заданий, скорость (заданий в секунду) и оценка оставшегося времени"""
+        elapsed = time.monotonic() - self.started_at if self.started_at else 0.0
+        rate = self.completed / elapsed if elapsed > 0 else 0.0
+        remaining = self.total - self.completed
+        eta = remaining / rate if rate > 0 else float('inf')
+        return {
+            'total': self.total,
+            'completed': self.completed,
+            'failed': self.failed,
+            'elapsed': elapsed,
+            'jobs_per_second': rate,
+            'eta_seconds': eta if remaining else 0.0,
+        }
+
+    def _report(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._last_report < self.progress_interval:
+            return
+        self._last_report = now
+        p = self.progress()
+        logger.info(f"{self.name}: {p['completed']}/{p['total']} jobs done "
+                    f"({p['jobs_per_second']:.1f}/s, ETA {p['eta_seconds']:.0f}s, failed {p['failed']})")
+
+    async def _worker(self, queue: asyncio.Queue, handler: Callable[..., Awaitable]) -> None:
+        while True:
+            job = await queue.get()
+            try:
+                await handler(*job)
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"{self.name}: job {job} failed: {e}")
+            finally:
+                self.completed += 1
+                queue.task_done()
+                self._report()
+
+    async def run(self, jobs: Iterable[Job], handler: Callable[..., Awaitable]) -> Dict[str, float]:
+        """Выполняет все задания и возвращает итоговый прогресс"""
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        self.total = queue.qsize()
+        self.completed = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        if not self.total:
+            return self.progress()
+
+        workers = [asyncio.create_task(self._worker(queue, handler))
+                   for _ in range(min(self.workers, self.total))]
+        try:
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        self._report(force=True)
+        return self.progress()
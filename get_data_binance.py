@@ -1,83 +1,155 @@
-import aiohttp
 import asyncio
+import threading
+import time
 import pandas as pd
+import metrics
 from datetime import datetime, timezone, timedelta
-import time
+from ingest_buffer import IngestBuffer
+from rate_limiter import binance_rate_limiter
+from fetch_scheduler import FetchScheduler
+from http_session import session_scope
+from symbol_cache import SymbolCache
+from candle_join import candle_ranges
+from candle_decoder import decode_binance, json_loads
+
+BINANCE_API_URL = "https://api.binance.com"
 
 class BinanceDataFetcher:
-    def __init__(self, target_pairs):
-        self.base_url = "https://api.binance.com/api/v3/klines"
-        self.all_pairs_data = []
-        self.request_window = 1.0
-        self.max_requests_per_second = 1000
-        self.request_timestamps = []
-        self.batch_delay = 0.5
+    def __init__(self, target_pairs, store=None, max_buffer_rows=None, max_buffer_bytes=None, rate_limiter=None,
+                 session_manager=None, symbol_ttl=3600.0, api_url=None):
+        # api_url - другой адрес API (например, локальный mock-сервер из benchmarks.mock_exchange)
+        api_url = (api_url or BINANCE_API_URL).rstrip('/')
+        self.base_url = f"{api_url}/api/v3/klines"
+        self.exchange_info_url = f"{api_url}/api/v3/exchangeInfo"
+        self.store = store
+        # Общий пул HTTP-соединений (HttpSessionManager); без него - сессия на каждый вызов
+        self.session_manager = session_manager
+        # Буфер свечей с последнего сохранения; при переполнении сбрасывается в store
+        self.buffer = IngestBuffer(
+            max_rows=max_buffer_rows,
+            max_bytes=max_buffer_bytes,
+            flush_handler=self._flush_to_store if store is not None else None
+        )
+        # Один запрос покрывает максимум свечей, который отдаёт API
+        self.candle_interval = timedelta(minutes=5)
+        self.max_candles_per_request = 1000
+        # Токен-бакет в единицах веса запросов (REQUEST_WEIGHT за минуту) и вес одного klines-запроса
+        self.rate_limiter = rate_limiter or binance_rate_limiter()
+        self.request_weight = 2
+        # Число параллельных воркеров очереди заданий
+        self.max_workers = 20
+        self.failed_ranges = []  # (pair, start, end) интервалы, пропущенные после всех попыток
+        self.flushed_ranges = []  # (pair, start, end) свечи, сброшенные в хранилище при переполнении буфера
+        self._flushed_lock = threading.Lock()  # сброс идёт в потоке IngestBuffer.flush_async
         self.target_pairs = target_pairs
+        # Листинг из exchangeInfo (вес 20) перезапрашивается раз в symbol_ttl секунд
+        self.symbols = SymbolCache('binance', ttl=symbol_ttl)
+        self.exchange_info_weight = 20
         self.start_time = None
 
-    async def check_rate_limit(self):
-        """Rate limit check"""
-        current_time = time.time()
-        self.request_timestamps = [ts for ts in self.request_timestamps 
-                                 if current_time - ts <= self.request_window]
-        
-        if len(self.request_timestamps) >= self.max_requests_per_second:
-            wait_time = self.request_timestamps[0] + self.request_window - current_time
-            if wait_time > 0:
-                print(f"Rate limit reached, waiting {wait_time:.2f} seconds")
-                await asyncio.sleep(wait_time)
-        
-        self.request_timestamps.append(current_time)
+    async def get_available_pairs(self, session):
+        """Fetch spot pairs in TRADING status from exchangeInfo as BASE/QUOTE"""
+        try:
+            await self.rate_limiter.acquire(cost=self.exchange_info_weight)
+            async with session.get(self.exchange_info_url) as response:
+                self.rate_limiter.update(response.status, response.headers)
+                if response.status == 200:
+                    exchange_info = await response.json()
+                    spot_pairs = [
+                        f"{symbol['baseAsset']}/{symbol['quoteAsset']}"
+                        for symbol in exchange_info.get('symbols', [])
+                        if symbol.get('status') == 'TRADING'
+                    ]
+                    print(f"Found {len(spot_pairs)} trading pairs on Binance")
+                    return spot_pairs
+                else:
+                    print(f"Error fetching exchange info: {response.status}")
+                    return []
+        except Exception as e:
+            print(f"Error fetching exchange info: {e}")
+            return []
 
-    async def fetch_historical_candles(self, session, pair, start_time, end_time, retries=3, backoff_factor=1.5):
-        """Fetch historical candles with retries and proper interval handling"""
-        pair_for_binance = pair.replace("/", "")
-        all_candles = []
+    def split_windows(self, start_time, end_time):
+        """Split a range into windows of exactly max_candles_per_request candles"""
+        windows = []
         current_start = start_time
-
         while current_start < end_time:
-            current_batch_end = min(current_start + timedelta(days=1), end_time)
-            attempt = 0
+            # endTime включительно, лишняя свеча на границе отсекается limit
+            current_batch_end = min(current_start + self.candle_interval * self.max_candles_per_request, end_time)
+            windows.append((current_start, current_batch_end))
+            current_start = current_batch_end
+        return windows
 
-            while attempt < retries:
-                try:
-                    await self.check_rate_limit()
+    async def fetch_window(self, session, pair, current_start, current_batch_end, retries=3, backoff_factor=1.5):
+        """Fetch one window of klines with retries; the window is recorded in failed_ranges if all attempts fail"""
+        pair_for_binance = pair.replace("/", "")
+        attempt = 0
 
-                    params = {
-                        "symbol": pair_for_binance,
-                        "interval": "5m",
-                        "startTime": int(current_start.timestamp() * 1000),
-                        "endTime": int(current_batch_end.timestamp() * 1000),
-                        "limit": 1000
-                    }
+        while attempt < retries:
+            status = None
+            try:
+                await self.rate_limiter.acquire(cost=self.request_weight)
 
+                params = {
+                    "symbol": pair_for_binance,
+                    "interval": "5m",
+                    "startTime": int(current_start.timestamp() * 1000),
+                    "endTime": int(current_batch_end.timestamp() * 1000),
+                    "limit": self.max_candles_per_request
+                }
+
+                started = time.perf_counter()
+                try:
                     async with session.get(self.base_url, params=params) as response:
+                        status = response.status
+                        # Сверка веса по X-MBX-USED-WEIGHT-1M, пауза на Retry-After при 418/429
+                        self.rate_limiter.update(response.status, response.headers)
                         if response.status == 200:
-                            candles = await response.json()
+                            candles = json_loads(await response.read())
+                            metrics.EXCHANGE_CANDLES.inc(len(candles), exchange='binance')
                             if candles:
-                                all_candles.extend(candles)
                                 print(f"Fetched {len(candles)} candles for {pair} from {current_start} to {current_batch_end}")
                             else:
                                 print(f"No data for {pair} from {current_start} to {current_batch_end}")
-                            break
+                            return candles
+                        elif response.status == 400:
+                            error = await response.json(content_type=None)
+                            # -1121 Invalid symbol: пара не торгуется, ретраи бесполезны
+                            if error.get('code') == -1121:
+                                self.symbols.mark_unavailable(pair, error.get('msg', 'invalid symbol'))
+                                return []
+                            raise Exception(f"HTTP {response.status}: {error.get('msg')}")
                         else:
                             print(f"Error {response.status} fetching data for {pair}")
                             raise Exception(f"HTTP {response.status}")
+                finally:
+                    metrics.observe_request('binance', 'klines', started, status)
 
-                except Exception as e:
-                    print(f"Error fetching data for {pair}: {e}")
-                    attempt += 1
-                    if attempt < retries:
-                        await asyncio.sleep(backoff_factor ** attempt)
-                    else:
-                        print(f"Max retries reached for {pair}. Skipping.")
-                        break
+            except Exception as e:
+                print(f"Error fetching data for {pair}: {e}")
+                attempt += 1
+                if attempt < retries:
+                    metrics.EXCHANGE_RETRIES.inc(exchange='binance', endpoint='klines')
+                    await asyncio.sleep(backoff_factor ** attempt)
 
-            current_start = current_batch_end
-            await asyncio.sleep(self.batch_delay)
+        print(f"Max retries reached for {pair}. Skipping.")
+        metrics.EXCHANGE_FAILED_WINDOWS.inc(exchange='binance')
+        self.failed_ranges.append((pair, current_start, current_batch_end))
+        return []
 
+    async def fetch_historical_candles(self, session, pair, start_time, end_time, retries=3, backoff_factor=1.5):
+        """Fetch historical candles with retries and proper interval handling"""
+        all_candles = []
+        for current_start, current_batch_end in self.split_windows(start_time, end_time):
+            all_candles.extend(await self.fetch_window(
+                session, pair, current_start, current_batch_end, retries, backoff_factor
+            ))
         return all_candles if all_candles else None
 
+    def process_candles(self, pair, candles):
+        """Decode a raw Binance payload into typed columns in one step"""
+        return decode_binance(pair, candles)
+
     async def fetch_pair_data(self, session, pair, start_time=None, end_time=None):
         """Process data for a single pair"""
         if not end_time:
@@ -91,31 +163,29 @@ class BinanceDataFetcher:
             )
             
             if candles:
-                processed_data = []
-                for candle in candles:
-                    candle_time = datetime.fromtimestamp(candle[0]/1000, tz=timezone.utc)
-                    processed_candle = {
-                        "market": pair,
-                        "candle_date_time_utc": candle_time.strftime('%Y-%m-%d %H:%M:%S'),
-                        "opening_price": float(candle[1]),
-                        "high_price": float(candle[2]),
-                        "low_price": float(candle[3]),
-                        "close_price": float(candle[4]),
-                        "volume": float(candle[5]),
-                        "quote_volume": float(candle[7]),
-                        "market_type": "spot"
-                    }
-                    processed_data.append(processed_candle)
-                
-                self.all_pairs_data.extend(processed_data)
+                processed_data = self.process_candles(pair, candles)
+                await self.buffer.put(processed_data)
                 return processed_data
 
         except Exception as e:
             print(f"Error processing data for {pair}: {e}")
             return None
 
-    async def fetch_all_pairs(self, start_time=None, end_time=None):
-        """Fetch data for specified pairs"""
+    async def fetch_job(self, session, pair, start_time, end_time):
+        """Scheduler job: fetch one (pair, window) and buffer the candles"""
+        if self.symbols.is_unavailable(pair):
+            return
+        candles = await self.fetch_window(session, pair, start_time, end_time)
+        if candles:
+            await self.buffer.put(self.process_candles(pair, candles))
+
+    def pop_failed_ranges(self):
+        """Return and clear the ranges skipped after max retries"""
+        failed, self.failed_ranges = self.failed_ranges, []
+        return failed
+
+    async def fetch_all_pairs(self, start_time=None, end_time=None, ranges=None):
+        """Fetch data for specified pairs (or only the given {pair: [(start, end)]} ranges)"""
         if not end_time:
             end_time = datetime.now(timezone.utc)
         if not start_time:
@@ -128,37 +198,75 @@ class BinanceDataFetcher:
             print("No target pairs specified")
             return
 
-        async with aiohttp.ClientSession() as session:
-            batch_size = 5
-            for i in range(0, len(self.target_pairs), batch_size):
-                batch = self.target_pairs[i:i + batch_size]
-                tasks = [self.fetch_pair_data(session, pair, start_time, end_time) 
-                        for pair in batch]
-                results = await asyncio.gather(*tasks)
-                await asyncio.sleep(self.batch_delay)
+        async with session_scope(self.session_manager) as session:
+            # Без листинга (ошибка exchangeInfo) пары отсеиваются только негативным кэшем
+            await self.symbols.get(lambda: self.get_available_pairs(session))
+            pairs = self.symbols.filter(self.target_pairs)
+            if ranges is not None:
+                pairs = [pair for pair in pairs if pair in ranges]
+            else:
+                ranges = {pair: [(start_time, end_time)] for pair in pairs}
+
+            # Каждая пара x окно - отдельное задание в общей очереди
+            jobs = [(session, pair, window_start, window_end)
+                    for pair in pairs
+                    for range_start, range_end in ranges[pair]
+                    for window_start, window_end in self.split_windows(range_start, range_end)]
+            scheduler = FetchScheduler('binance', workers=self.max_workers)
+            await scheduler.run(jobs, self.fetch_job)
 
     def save_to_csv(self):
         """Save collected data to CSV"""
-        if self.all_pairs_data:
-            df = pd.DataFrame(self.all_pairs_data)
-            
-            try:
-                existing_df = pd.read_csv("binance_data.csv")
-                combined_df = pd.concat([existing_df, df])
-                combined_df = combined_df.drop_duplicates(
-                    subset=['market', 'candle_date_time_utc', 'market_type'],
-                    keep='last'
-                )
-                combined_df = combined_df.sort_values(['market', 'candle_date_time_utc'])
-                combined_df.to_csv("binance_data.csv", index=False)
-                print(f"Updated data saved: {len(combined_df)} records")
-                
-            except FileNotFoundError:
-                df.to_csv("binance_data.csv", index=False)
-                print(f"New file created with {len(df)} records")
+        df = self.buffer.drain()
+        if not df.empty:
+            with metrics.stage('save_to_csv_binance', rows_in=len(df)) as timer:
+                try:
+                    existing_df = pd.read_csv("binance_data.csv", parse_dates=['candle_date_time_utc'])
+                    combined_df = pd.concat([existing_df, df])
+                    combined_df = combined_df.drop_duplicates(
+                        subset=['market', 'candle_date_time_utc', 'market_type'],
+                        keep='last'
+                    )
+                    combined_df = combined_df.sort_values(['market', 'candle_date_time_utc'])
+                    combined_df.to_csv("binance_data.csv", index=False)
+                    timer.rows_out = len(combined_df)
+                    print(f"Updated data saved: {len(combined_df)} records")
+
+                except FileNotFoundError:
+                    df.to_csv("binance_data.csv", index=False)
+                    timer.rows_out = len(df)
+                    print(f"New file created with {len(df)} records")
+        else:
+            print("No data to save")
+
+    def save_to_store(self, store=None):
+        """Upsert buffered candles into the partitioned candle store and clear the buffer"""
+        self.store_frame(self.buffer.drain(), store)
+
+    def store_frame(self, df, store=None):
+        """Upsert already drained candles; safe to call from a worker thread (ingest pipeline)"""
+        store = store or self.store
+        if not df.empty:
+            with metrics.stage('save_to_store_binance', rows_in=len(df)):
+                written = store.upsert('binance', df)
+            print(f"Stored {len(df)} records, {written} partitions updated")
         else:
             print("No data to save")
 
+    def _flush_to_store(self, df):
+        """Flush handler for a full ingest buffer; runs in a worker thread (IngestBuffer.flush_async)"""
+        written = self.store.upsert('binance', df)
+        # Эти свечи не попадут в пакет цикла - объединение переберёт их из хранилища (CandleJoin.mark_unjoined)
+        with self._flushed_lock:
+            self.flushed_ranges.extend(candle_ranges(df))
+        print(f"Buffer full: stored {len(df)} records, {written} partitions updated")
+
+    def pop_flushed_ranges(self):
+        """Return and clear the (pair, start, end) ranges flushed to the store past the cycle batch"""
+        with self._flushed_lock:
+            flushed, self.flushed_ranges = self.flushed_ranges, []
+        return flushed
+
     async def run(self):
         """Main execution method"""
         await self.fetch_all_pairs()
@@ -1,24 +1,55 @@
-import aiohttp
 import asyncio
+import threading
+import time
 import pandas as pd
+import metrics
 from datetime import datetime, timezone, timedelta
-import time
+from ingest_buffer import IngestBuffer
+from rate_limiter import coinbase_rate_limiter
+from fetch_scheduler import FetchScheduler
+from http_session import session_scope
+from symbol_cache import SymbolCache
+from candle_join import candle_ranges
+from candle_decoder import decode_coinbase, json_loads
+from fetch_planner import empty_ranges
+
+COINBASE_API_URL = "https://api.exchange.coinbase.com"
 
 class CoinbaseDataFetcher:
-    def __init__(self, target_pairs):
-        self.base_url = "https://api.exchange.coinbase.com/products"
-        self.all_pairs_data = []
-        self.request_window = 1.0
-        self.max_requests_per_second = 10
-        self.request_timestamps = []
-        self.batch_delay = 0.6
+    def __init__(self, target_pairs, store=None, max_buffer_rows=None, max_buffer_bytes=None, rate_limiter=None,
+                 session_manager=None, symbol_ttl=3600.0, api_url=None):
+        # api_url - другой адрес API (например, локальный mock-сервер из benchmarks.mock_exchange)
+        self.base_url = f"{(api_url or COINBASE_API_URL).rstrip('/')}/products"
+        self.store = store
+        # Общий пул HTTP-соединений (HttpSessionManager); без него - сессия на каждый вызов
+        self.session_manager = session_manager
+        # Буфер свечей с последнего сохранения; при переполнении сбрасывается в store
+        self.buffer = IngestBuffer(
+            max_rows=max_buffer_rows,
+            max_bytes=max_buffer_bytes,
+            flush_handler=self._flush_to_store if store is not None else None
+        )
+        # Общий токен-бакет на все эндпоинты Coinbase (10 запросов в секунду)
+        self.rate_limiter = rate_limiter or coinbase_rate_limiter()
+        # Число параллельных воркеров очереди заданий и размер окна одного запроса
+        self.max_workers = 10
+        self.request_span = timedelta(days=1)
+        self.failed_ranges = []  # (pair, start, end) интервалы, пропущенные после всех попыток
+        # (pair, start, end) закрытые интервалы без свечей в успешном ответе: свечей без сделок у Coinbase нет
+        self.empty_ranges = []
+        self.flushed_ranges = []  # (pair, start, end) свечи, сброшенные в хранилище при переполнении буфера
+        self._flushed_lock = threading.Lock()  # сброс идёт в потоке IngestBuffer.flush_async
         self.target_pairs = target_pairs  # Список требуемых пар
+        # Список /products перезапрашивается раз в symbol_ttl секунд, а не на каждом цикле
+        self.symbols = SymbolCache('coinbase', ttl=symbol_ttl)
         self.start_time = None
 
     async def get_available_pairs(self, session):
         """Fetch all available spot trading pairs from Coinbase"""
         try:
+            await self.rate_limiter.acquire()
             async with session.get(self.base_url) as response:
+                self.rate_limiter.update(response.status, response.headers)
                 if response.status == 200:
                     products = await response.json()
                     # Filter for USD pairs, status 'online', and not disabled
@@ -37,73 +68,86 @@ class CoinbaseDataFetcher:
             print(f"Error fetching available pairs: {e}")
             return []
 
-    async def check_rate_limit(self):
-        """Rate limit check"""
-        current_time = time.time()
-        self.request_timestamps = [ts for ts in self.request_timestamps 
-                                 if current_time - ts <= self.request_window]
-        
-        if len(self.request_timestamps) >= self.max_requests_per_second:
-            wait_time = self.request_timestamps[0] + self.request_window - current_time
-            if wait_time > 0:
-                print(f"Rate limit reached, waiting {wait_time:.2f} seconds")
-                await asyncio.sleep(wait_time)
-        
-        self.request_timestamps.append(current_time)
+    def split_windows(self, start_time, end_time):
+        """Split a range into request windows of at most one day (288 candles, API limit is 300)"""
+        windows = []
+        current_start = start_time
+        while current_start < end_time:
+            current_end = min(current_start + self.request_span, end_time)
+            windows.append((current_start, current_end))
+            current_start = current_end
+        return windows
 
-    async def fetch_historical_candles(self, session, pair, start_time, end_time, retries=3, backoff_factor=1.5):
-        """Fetch historical candles for a pair with retries and proper interval handling."""
-        all_candles = []
-        current_start = start_time  # Начало интервала
+    async def fetch_window(self, session, pair, current_start, current_end, retries=3, backoff_factor=1.5):
+        """Fetch one window of candles with retries; the window is recorded in failed_ranges if all attempts fail"""
+        attempt = 0  # Счётчик попыток для текущего временного интервала
 
-        while current_start < end_time:
-            current_end = min(current_start + timedelta(days=1), end_time)  # Разбиваем запросы на 1-дневные интервалы
-            attempt = 0  # Счётчик попыток для текущего временного интервала
+        while attempt < retries:
+            status = None
+            try:
+                # Проверка ограничения скорости
+                await self.rate_limiter.acquire()
 
-            while attempt < retries:
+                # Формируем запрос
+                params = {
+                    'start': current_start.isoformat(),
+                    'end': current_end.isoformat(),
+                    'granularity': 300  # 5-минутные свечи
+                }
+                url = f"{self.base_url}/{pair}/candles"
+
+                # Выполнение запроса
+                started = time.perf_counter()
                 try:
-                    # Проверка ограничения скорости
-                    await self.check_rate_limit()
-
-                    # Формируем запрос
-                    params = {
-                        'start': current_start.isoformat(),
-                        'end': current_end.isoformat(),
-                        'granularity': 300  # 5-минутные свечи
-                    }
-                    url = f"{self.base_url}/{pair}/candles"
-
-                    # Выполнение запроса
                     async with session.get(url, params=params) as response:
+                        status = response.status
+                        self.rate_limiter.update(response.status, response.headers)
                         if response.status == 200:
-                            candles = await response.json()
+                            candles = json_loads(await response.read())
+                            metrics.EXCHANGE_CANDLES.inc(len(candles), exchange='coinbase')
+                            self.empty_ranges.extend(empty_ranges(pair, current_start, current_end,
+                                                                  (candle[0] for candle in candles)))
                             if candles:
-                                all_candles.extend(candles)
                                 print(f"Fetched {len(candles)} candles for {pair} from {current_start} to {current_end}")
                             else:
-                                print(candles)
                                 print(f"No data for {pair} from {current_start} to {current_end}")
-                            break  # Успешный запрос, выходим из попыток
+                            return candles  # Успешный запрос, выходим из попыток
+                        elif response.status == 404:
+                            # Неизвестный product_id: ретраи бесполезны
+                            self.symbols.mark_unavailable(pair, f"HTTP {response.status}")
+                            return []
                         else:
                             print(f"Error {response.status} fetching data for {pair}")
                             raise Exception(f"HTTP {response.status}")
+                finally:
+                    metrics.observe_request('coinbase', 'candles', started, status)
 
-                except Exception as e:
-                    print(f"Error fetching data for {pair} from {current_start} to {current_end}: {e}")
-                    attempt += 1
-                    if attempt < retries:
-                        print(f"Retrying... Attempt {attempt}/{retries}")
-                        await asyncio.sleep(backoff_factor ** attempt)  # Экспоненциальная задержка перед следующей попыткой
-                    else:
-                        print(f"Max retries reached for {pair} from {current_start} to {current_end}. Skipping.")
-                        break  # Прекращаем попытки для текущего интервала
-
-            # Обновляем начало интервала
-            current_start = current_end
-            await asyncio.sleep(self.batch_delay)  # Задержка между интервалами
+            except Exception as e:
+                print(f"Error fetching data for {pair} from {current_start} to {current_end}: {e}")
+                attempt += 1
+                if attempt < retries:
+                    metrics.EXCHANGE_RETRIES.inc(exchange='coinbase', endpoint='candles')
+                    print(f"Retrying... Attempt {attempt}/{retries}")
+                    await asyncio.sleep(backoff_factor ** attempt)  # Экспоненциальная задержка перед следующей попыткой
 
+        print(f"Max retries reached for {pair} from {current_start} to {current_end}. Skipping.")
+        metrics.EXCHANGE_FAILED_WINDOWS.inc(exchange='coinbase')
+        self.failed_ranges.append((pair, current_start, current_end))
+        return []
+
+    async def fetch_historical_candles(self, session, pair, start_time, end_time, retries=3, backoff_factor=1.5):
+        """Fetch historical candles for a pair with retries and proper interval handling."""
+        all_candles = []
+        for current_start, current_end in self.split_windows(start_time, end_time):
+            all_candles.extend(await self.fetch_window(
+                session, pair, current_start, current_end, retries, backoff_factor
+            ))
         return all_candles if all_candles else None
 
+    def process_candles(self, pair, candles):
+        """Decode a raw Coinbase payload into typed columns in one step"""
+        return decode_coinbase(pair, candles)
+
     async def fetch_pair_data(self, session, pair, start_time=None, end_time=None):
         """Process data for a single pair"""
         if not end_time:
@@ -116,32 +160,34 @@ class CoinbaseDataFetcher:
                 session, pair, start_time, end_time
             )
             if candles:
-                processed_data = []
-                for candle in candles:
-                    # Убедимся, что временная метка имеет UTC
-                    candle_time = datetime.fromtimestamp(candle[0], tz=timezone.utc)
-                    processed_candle = {
-                        "market": pair,
-                        "candle_date_time_utc": candle_time.strftime('%Y-%m-%d %H:%M:%S'),
-                        "opening_price": float(candle[3]),
-                        "high_price": float(candle[2]),
-                        "low_price": float(candle[1]),
-                        "close_price": float(candle[4]),
-                        "volume": float(candle[5]) * float(candle[4]),
-                        "market_type": "spot"
-                    }
-                    processed_data.append(processed_candle)
-
-                self.all_pairs_data.extend(processed_data)
+                processed_data = self.process_candles(pair, candles)
+                await self.buffer.put(processed_data)
                 return processed_data
 
         except Exception as e:
             print(f"Error processing data for {pair}: {e}")
             return None
 
+    async def fetch_job(self, session, pair, start_time, end_time):
+        """Scheduler job: fetch one (pair, window) and buffer the candles"""
+        if self.symbols.is_unavailable(pair):
+            return
+        candles = await self.fetch_window(session, pair, start_time, end_time)
+        if candles:
+            await self.buffer.put(self.process_candles(pair, candles))
+
+    def pop_failed_ranges(self):
+        """Return and clear the ranges skipped after max retries"""
+        failed, self.failed_ranges = self.failed_ranges, []
+        return failed
 
-    async def fetch_all_pairs(self, start_time=None, end_time=None):
-        """Fetch data for specified pairs"""
+    def pop_empty_ranges(self):
+        """Return and clear the closed ranges Coinbase answered without candles (no trades)"""
+        empty, self.empty_ranges = self.empty_ranges, []
+        return empty
+
+    async def fetch_all_pairs(self, start_time=None, end_time=None, ranges=None):
+        """Fetch data for specified pairs (or only the given {pair: [(start, end)]} ranges)"""
         if not end_time:
             end_time = datetime.now(timezone.utc)
         if not start_time:
@@ -150,51 +196,84 @@ class CoinbaseDataFetcher:
             # Устанавливаем время на начало дня
             start_time = start_time.replace(hour=0, minute=0, second=0, microsecond=0) # Determine start of the historical period (default 365 d)
 
-        async with aiohttp.ClientSession() as session:
-            available_pairs = await self.get_available_pairs(session)
+        async with session_scope(self.session_manager) as session:
+            available_pairs = await self.symbols.get(lambda: self.get_available_pairs(session))
             if not available_pairs:
                 print("No spot trading pairs found")
                 return
             
-            filtered_pairs = [pair for pair in available_pairs if pair in self.target_pairs]
+            filtered_pairs = self.symbols.filter(self.target_pairs)
+            if ranges is not None:
+                filtered_pairs = [pair for pair in filtered_pairs if pair in ranges]
+            else:
+                ranges = {pair: [(start_time, end_time)] for pair in filtered_pairs}
             
             if not filtered_pairs:
                 print("None of the target pairs are available on Coinbase")
                 return
 
             print(f"Starting to fetch data for {len(filtered_pairs)} target pairs")
-            
-            batch_size = 3
-            for i in range(0, len(filtered_pairs), batch_size):
-                batch = filtered_pairs[i:i + batch_size]
-                tasks = [self.fetch_pair_data(session, pair, start_time, end_time) 
-                        for pair in batch]
-                results = await asyncio.gather(*tasks)
-                
-                await asyncio.sleep(self.batch_delay)
+
+            # Каждая пара x окно - отдельное задание в общей очереди
+            jobs = [(session, pair, window_start, window_end)
+                    for pair in filtered_pairs
+                    for range_start, range_end in ranges[pair]
+                    for window_start, window_end in self.split_windows(range_start, range_end)]
+            scheduler = FetchScheduler('coinbase', workers=self.max_workers)
+            await scheduler.run(jobs, self.fetch_job)
 
     def save_to_csv(self):
         """Save collected data to CSV"""
-        if self.all_pairs_data:
-            df = pd.DataFrame(self.all_pairs_data)
-            
-            try:
-                existing_df = pd.read_csv("coinbase_data.csv")
-                combined_df = pd.concat([existing_df, df])
-                combined_df = combined_df.drop_duplicates(
-                    subset=['market', 'candle_date_time_utc', 'market_type'],
-                    keep='last'
-                )
-                combined_df = combined_df.sort_values(['market', 'candle_date_time_utc'])
-                combined_df.to_csv("coinbase_data.csv", index=False)
-                print(f"Updated data saved: {len(combined_df)} records")
-                
-            except FileNotFoundError:
-                df.to_csv("coinbase_data.csv", index=False)
-                print(f"New file created with {len(df)} records")
+        df = self.buffer.drain()
+        if not df.empty:
+            with metrics.stage('save_to_csv_coinbase', rows_in=len(df)) as timer:
+                try:
+                    existing_df = pd.read_csv("coinbase_data.csv", parse_dates=['candle_date_time_utc'])
+                    combined_df = pd.concat([existing_df, df])
+                    combined_df = combined_df.drop_duplicates(
+                        subset=['market', 'candle_date_time_utc', 'market_type'],
+                        keep='last'
+                    )
+                    combined_df = combined_df.sort_values(['market', 'candle_date_time_utc'])
+                    combined_df.to_csv("coinbase_data.csv", index=False)
+                    timer.rows_out = len(combined_df)
+                    print(f"Updated data saved: {len(combined_df)} records")
+
+                except FileNotFoundError:
+                    df.to_csv("coinbase_data.csv", index=False)
+                    timer.rows_out = len(df)
+                    print(f"New file created with {len(df)} records")
         else:
             print("No data to save")
 
+    def save_to_store(self, store=None):
+        """Upsert buffered candles into the partitioned candle store and clear the buffer"""
+        self.store_frame(self.buffer.drain(), store)
+
+    def store_frame(self, df, store=None):
+        """Upsert already drained candles; safe to call from a worker thread (ingest pipeline)"""
+        store = store or self.store
+        if not df.empty:
+            with metrics.stage('save_to_store_coinbase', rows_in=len(df)):
+                written = store.upsert('coinbase', df)
+            print(f"Stored {len(df)} records, {written} partitions updated")
+        else:
+            print("No data to save")
+
+    def _flush_to_store(self, df):
+        """Flush handler for a full ingest buffer; runs in a worker thread (IngestBuffer.flush_async)"""
+        written = self.store.upsert('coinbase', df)
+        # Эти свечи не попадут в пакет цикла - объединение переберёт их из хранилища (CandleJoin.mark_unjoined)
+        with self._flushed_lock:
+            self.flushed_ranges.extend(candle_ranges(df))
+        print(f"Buffer full: stored {len(df)} records, {written} partitions updated")
+
+    def pop_flushed_ranges(self):
+        """Return and clear the (pair, start, end) ranges flushed to the store past the cycle batch"""
+        with self._flushed_lock:
+            flushed, self.flushed_ranges = self.flushed_ranges, []
+        return flushed
+
     async def run(self):
         """Main execution method"""
         await self.fetch_all_pairs()
@@ -0,0 +1,96 @@
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpSessionManager:
+    """
+    Долгоживущая aiohttp-сессия на весь цикл работы main.
+
+    Пул keep-alive соединений с лимитом на хост, DNS-кэш и общие таймауты.
+    Соединения к биржам и к веб-сервису переиспользуются между 45-секундными
+    циклами, поэтому TCP/TLS-рукопожатия и DNS-запросы делаются один раз.
+    Счётчики новых и переиспользованных соединений доступны через stats().
+    """
+
+    def __init__(self, limit: int = 100, limit_per_host: int = 30, dns_ttl: int = 300,
+                 keepalive_timeout: float = 75.0, total_timeout: float = 60.0,
+                 connect_timeout: float = 10.0, read_timeout: float = 30.0):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout,
+                                             sock_read=read_timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.metrics = {
+            'requests': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0,
+        }
+
+    def _trace_config(self) -> aiohttp.TraceConfig:
+        trace_config = aiohttp.TraceConfig()
+
+        def counter(name):
+            async def handler(session, context, params):
+                self.metrics[name] += 1
+            return handler
+
+        trace_config.on_request_start.append(counter('requests'))
+        trace_config.on_connection_create_end.append(counter('connections_created'))
+        trace_config.on_connection_reuseconn.append(counter('connections_reused'))
+        trace_config.on_dns_cache_hit.append(counter('dns_cache_hits'))
+        trace_config.on_dns_cache_miss.append(counter('dns_cache_misses'))
+        return trace_config
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """Общая сессия; создаётся при первом обращении внутри event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                trace_configs=[self._trace_config()],
+            )
+        return self._session
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики запросов и соединений; reuse_ratio - доля запросов без нового соединения"""
+        stats = dict(self.metrics)
+        requests = stats['requests']
+        stats['reuse_ratio'] = stats['connections_reused'] / requests if requests else 0.0
+        return stats
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self) -> 'HttpSessionManager':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.close()
+
+
+@asynccontextmanager
+async def session_scope(manager: Optional[HttpSessionManager] = None):
+    """Сессия менеджера, если он передан, иначе временная сессия на один вызов"""
+    if manager is not None:
+        yield manager.session
+    else:
+        async with aiohttp.ClientSession() as session:
+            yield session
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class IngestBuffer:
+    """
+    Буфер обработанных свечей между фетчером и хранилищем.
+
+    Хранит пачки свечей как DataFrame с типизированными колонками (по одной на ответ API).
+    drain() отдаёт накопленные строки одним DataFrame и очищает буфер, поэтому память зависит
+    только от данных с последнего сброса. При заданных max_rows/max_bytes
+    put() либо сбрасывает буфер через flush_handler, либо (без обработчика)
+    ждёт, пока его не опустошит drain() - обратное давление на фетчер.
+    """
+
+    def __init__(self, max_rows: Optional[int] = None, max_bytes: Optional[int] = None,
+                 flush_handler: Optional[Callable[[pd.DataFrame], None]] = None,
+                 stats_hook: Optional[Callable[[Dict[str, int]], None]] = None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.flush_handler = flush_handler
+        self.stats_hook = stats_hook
+
+        self.chunks: List[pd.DataFrame] = []
+        self.rows = 0
+        self.bytes = 0
+        self.total_rows = 0
+        self.flushes = 0
+        self.backpressure_waits = 0
+        self.peak_rows = 0
+        self._space = asyncio.Event()
+        self._space.set()
+
+    def __len__(self) -> int:
+        return self.rows
+
+    def is_full(self) -> bool:
+        if self.max_rows is not None and self.rows >= self.max_rows:
+            return True
+        if self.max_bytes is not None and self.bytes >= self.max_bytes:
+            return True
+        return False
+
+    async def put(self, chunk: pd.DataFrame) -> None:
+        """Добавляет пачку строк; при заполненном буфере сбрасывает его или ждёт drain()"""
+        if chunk is None or chunk.empty:
+            return
+        while self.is_full():
+            if self.flush_handler is not None:
+                await self.flush_async()
+            else:
+                self.backpressure_waits += 1
+                self._space.clear()
+                logger.info(f"Ingest buffer full ({self.rows} rows), waiting for flush")
+                await self._space.wait()
+
+        self.chunks.append(chunk)
+        self.rows += len(chunk)
+        self.bytes += int(chunk.memory_usage(index=False, deep=True).sum())
+        self.total_rows += len(chunk)
+        self.peak_rows = max(self.peak_rows, self.rows)
+        self._report()
+
+    def drain(self) -> pd.DataFrame:
+        """Забирает все строки одним DataFrame и очищает буфер"""
+        chunks, self.chunks = self.chunks, []
+        self.rows = 0
+        self.bytes = 0
+        if chunks:
+            self.flushes += 1
+        self._space.set()
+        self._report()
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
+    def flush(self) -> int:
+        """Сбрасывает буфер через flush_handler, возвращает число строк"""
+        df = self.drain()
+        if not df.empty and self.flush_handler is not None:
+            self.flush_handler(df)
+        return len(df)
+
+    async def flush_async(self) -> int:
+        """
+        flush() из put(): обработчик (запись Parquet в хранилище) выполняется в потоке,
+        event loop тем временем обслуживает остальные запросы. Буфер опустошается сразу,
+        поэтому другие задачи продолжают класть в него свечи, пока идёт запись.
+        """
+        df = self.drain()
+        if not df.empty and self.flush_handler is not None:
+            await asyncio.to_thread(self.flush_handler, df)
+        return len(df)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'buffered_rows': self.rows,
+            'buffered_bytes': self.bytes,
+            'peak_rows': self.peak_rows,
+            'total_rows': self.total_rows,
+            'flushes': self.flushes,
+            'backpressure_waits': self.backpressure_waits,
+        }
+
+    def _report(self) -> None:
+        if self.stats_hook is not None:
+            self.stats_hook(self.stats())
@@ -0,0 +1,225 @@
+import asyncio
+import inspect
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+class IngestBatch:
+    """Пакет одного цикла сбора, который проходит по стадиям конвейера"""
+
+    def __init__(self, frames: Dict[str, Any], combine_start, end, cycle_started: float,
+                 unjoined: Optional[Dict[str, list]] = None):
+        self.frames = frames                  # exchange -> свечи, снятые с буфера фетчера
+        self.unjoined = unjoined or {}        # exchange -> (pair, start, end) свечей, сброшенных в хранилище мимо пакета
+        self.combine_start = combine_start    # начало интервала (полное объединение при старте - с начала истории)
+        self.end = end
+        self.cycle_started = cycle_started
+        self.indicators = None
+        self.latest = None
+
+    def merge_earlier(self, earlier: 'IngestBatch') -> None:
+        """Добавляет свечи более раннего пакета, который стадия не смогла обработать"""
+        for exchange, frame in earlier.frames.items():
+            if exchange in self.frames:
+                frame = pd.concat([frame, self.frames[exchange]], ignore_index=True)
+            self.frames[exchange] = frame
+        self.combine_start = min(self.combine_start, earlier.combine_start)
+
+
+class PipelineStage:
+    """
+    Стадия конвейера: handler(item) -> item для следующей стадии (None - дальше не передавать).
+
+    Корутины выполняются в event loop; обычные функции (pandas, запись файлов) - в отдельном
+    потоке стадии, поэтому цикл продолжает обслуживать HTTP-запросы, таймауты и лимитер.
+    Поток у стадии один: элементы обрабатываются по порядку, а разные стадии работают
+    одновременно над соседними циклами.
+    """
+
+    def __init__(self, name: str, handler: Callable[..., Any], retries: int = 0, retry_delay: float = 1.0,
+                 on_error: Optional[Callable[[Any], None]] = None):
+        self.name = name
+        self.handler = handler
+        # Ошибка обработчика - повтор того же элемента (до retries раз, пауза retry_delay с удвоением);
+        # повторы не помогли - on_error(item), например вернуть свечи пакета в следующий цикл
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.on_error = on_error
+        self.offload = not inspect.iscoroutinefunction(handler)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.processed = 0
+        self.errors = 0
+        self.retried = 0
+        self.busy_seconds = 0.0
+        self.idle_seconds = 0.0       # ожидание входа
+        self.blocked_seconds = 0.0    # ожидание места в очереди следующей стадии (обратное давление)
+        self.last_seconds = 0.0
+        self.running = False
+        self._done = asyncio.Condition()
+
+    async def call(self, *args):
+        started = time.perf_counter()
+        self.running = True
+        try:
+            if self.offload:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"pipeline-{self.name}")
+                return await asyncio.get_running_loop().run_in_executor(self.executor, self.handler, *args)
+            return await self.handler(*args)
+        finally:
+            self.running = False
+            self.last_seconds = time.perf_counter() - started
+            self.busy_seconds += self.last_seconds
+
+    async def finished(self) -> None:
+        """Элемент обработан (успешно или с ошибкой) - будит wait_processed"""
+        async with self._done:
+            self.processed += 1
+            self._done.notify_all()
+
+    async def wait_processed(self, count: int) -> None:
+        async with self._done:
+            await self._done.wait_for(lambda: self.processed >= count)
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'processed': self.processed,
+            'errors': self.errors,
+            'retried': self.retried,
+            'running': int(self.running),
+            'busy_seconds': round(self.busy_seconds, 3),
+            'idle_seconds': round(self.idle_seconds, 3),
+            'blocked_seconds': round(self.blocked_seconds, 3),
+            'last_seconds': round(self.last_seconds, 3),
+        }
+
+
+class IngestPipeline:
+    """
+    Конвейер сбора: источник (fetch) -> стадии, соединённые ограниченными asyncio.Queue.
+
+    Источник - корутина без аргументов, которая ждёт следующего цикла, собирает свечи и
+    возвращает пакет (None - пропустить цикл). Очереди размером queue_size: если стадия
+    отстаёт, предыдущая ждёт места (blocked_seconds), и сбор не уходит вперёд больше чем
+    на queue_size пакетов. Ошибка стадии - повтор пакета (PipelineStage.retries), затем
+    PipelineStage.on_error, и конвейер продолжает работу; ошибка источника - пауза error_delay секунд.
+
+    sync_stage - первая стадия, которую источник дожидается перед следующим вызовом: планировщик
+    читает high-water mark хранилища, поэтому новый сбор начинается после записи
+    предыдущего пакета, но одновременно с расчётом индикаторов и отправкой.
+    """
+
+    def __init__(self, source: Callable[[], Awaitable[Any]], stages: List[PipelineStage],
+                 queue_size: int = 1, error_delay: float = 60.0, sync_stage: Optional[str] = None):
+        self.source = PipelineStage('fetch', source)
+        self.stages = stages
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+        self.error_delay = error_delay
+        # Только первая стадия видит каждый пакет источника - иначе счётчики не сойдутся
+        if sync_stage is not None and sync_stage != stages[0].name:
+            raise ValueError(f"sync_stage must be the first stage, got {sync_stage}")
+        self.sync_stage = stages[0] if sync_stage else None
+        self.emitted = 0
+
+    def stage(self, name: str) -> PipelineStage:
+        for stage in [self.source] + self.stages:
+            if stage.name == name:
+                return stage
+        raise KeyError(name)
+
+    async def _put(self, stage: PipelineStage, queue: asyncio.Queue, item) -> None:
+        started = time.perf_counter()
+        await queue.put(item)
+        stage.blocked_seconds += time.perf_counter() - started
+
+    async def _run_source(self) -> None:
+        while True:
+            if self.sync_stage is not None:
+                started = time.perf_counter()
+                await self.sync_stage.wait_processed(self.emitted)
+                self.source.blocked_seconds += time.perf_counter() - started
+            try:
+                item = await self.source.call()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.source.errors += 1
+                logger.error(f"Pipeline stage fetch failed: {e}")
+                await self.source.finished()
+                await asyncio.sleep(self.error_delay)
+                continue
+            await self.source.finished()
+            if item is not None:
+                self.emitted += 1
+                await self._put(self.source, self.queues[0], item)
+
+    async def _call_with_retries(self, stage: PipelineStage, item):
+        """Результат стадии по элементу; None - элемент не обработан и после повторов"""
+        delay = stage.retry_delay
+        for attempt in range(stage.retries + 1):
+            try:
+                return await stage.call(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                stage.errors += 1
+                if attempt < stage.retries:
+                    stage.retried += 1
+                    logger.warning(f"Pipeline stage {stage.name} failed, retrying in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay *= 2
+                else:
+                    logger.error(f"Pipeline stage {stage.name} failed: {e}")
+        if stage.on_error is not None:
+            try:
+                stage.on_error(item)
+            except Exception as e:
+                logger.error(f"Pipeline stage {stage.name} error handler failed: {e}")
+        return None
+
+    async def _run_stage(self, index: int) -> None:
+        stage = self.stages[index]
+        queue = self.queues[index]
+        output = self.queues[index + 1] if index + 1 < len(self.queues) else None
+        while True:
+            started = time.perf_counter()
+            item = await queue.get()
+            stage.idle_seconds += time.perf_counter() - started
+            try:
+                result = await self._call_with_retries(stage, item)
+            finally:
+                queue.task_done()
+            await stage.finished()
+            if result is not None and output is not None:
+                await self._put(stage, output, result)
+
+    async def run(self) -> None:
+        """Работает до отмены; потоки стадий останавливаются после текущего элемента"""
+        tasks = [asyncio.create_task(self._run_source())]
+        tasks += [asyncio.create_task(self._run_stage(i)) for i in range(len(self.stages))]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for stage in [self.source] + self.stages:
+                stage.close()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Счётчики стадий и глубина очереди перед каждой стадией"""
+        stats = {'fetch': self.source.stats()}
+        for stage, queue in zip(self.stages, self.queues):
+            stats[stage.name] = dict(stage.stats(), queue_depth=queue.qsize(), queue_size=queue.maxsize)
+        return stats
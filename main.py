@@ -2,20 +2,191 @@ import asyncio
 from get_data_coinbase import CoinbaseDataFetcher
 from get_data_binance import BinanceDataFetcher
 from data_combiner import DataCombiner
+from candle_store import CandleStore
+from candle_join import CandleJoin, candle_ranges
+from premium_history import PremiumHistoryStore
+from fetch_planner import FetchPlanner
+from candle_clock import CandleClock
+from ingest_pipeline import IngestBatch, IngestPipeline, PipelineStage
+from http_session import HttpSessionManager
+from candle_stream import BinanceKlineStream, CoinbaseMatchStream
 from datetime import datetime, timezone, timedelta
+from typing import Optional
 import logging
-import pandas as pd
+import time
+import metrics
+
+# Этап 2: опрос REST по закрытию свечей или свечи по WebSocket (REST только для пропусков)
+USE_STREAMING = False
+# Пауза после закрытия свечи, чтобы дождаться её с обеих бирж
+STREAM_SETTLE_DELAY = 5.0
+# Опрос REST по закрытию свечей (candle_clock.py): тик через POLL_SETTLE_DELAY секунд после
+# границы 5m, поздние рынки - повторными тиками через POLL_FOLLOW_UP_DELAY (не больше
+# POLL_FOLLOW_UPS раз), весь цикл сбора - не дольше POLL_CYCLE_DEADLINE секунд от границы
+POLL_SETTLE_DELAY = 3.0
+POLL_FOLLOW_UP_DELAY = 10.0
+POLL_FOLLOW_UPS = 3
+POLL_CYCLE_DEADLINE = 90.0
+# Допустимая ошибка медиан 1M/1Y по рангу (доля окна, например 0.01): окна, которые в неё
+# укладываются, считаются по скетчам часовых/дневных корзин (см. rollup.py); None - точно
+INDICATOR_RANK_ERROR = None
+# Процессы для объединения и полного расчёта индикаторов (шарды по рынкам); 1 - в основном процессе.
+# Больше 1 - только если python -m benchmarks.run --workers N показывает ускорение на этой машине
+INDICATOR_WORKERS = 1
+# Адреса REST API бирж; None - боевые. Для офлайн-прогона - адрес python -m benchmarks.mock_exchange
+# (WebSocket у него нет, поэтому только с USE_STREAMING = False)
+COINBASE_API_URL = None
+BINANCE_API_URL = None
+# Порт /metrics процесса сбора (Prometheus); None - не поднимать. У веб-сервера свой /metrics
+METRICS_PORT = 9108
+# Интерфейс /metrics; '0.0.0.0' - только если Prometheus опрашивает с другой машины
+METRICS_HOST = '127.0.0.1'
+# Таблица индикаторов по дням (<YYYY-MM-DD>.csv); каждый цикл дописывает только пересчитанные строки
+COMBINED_DATA_DIR = 'combined_data'
+# Пакетов в очереди перед каждой стадией конвейера Этапа 2: сбор следующей свечи идёт
+# параллельно с расчётом предыдущей, но не уходит вперёд отстающей стадии больше чем на столько
+PIPELINE_QUEUE_SIZE = 1
+# Повторы пакета после ошибки стадий store и compute (пауза 1 с, удваивается); пакет, который
+# compute так и не обработал, объединяется заново вместе со следующим
+PIPELINE_STAGE_RETRIES = 2
+
+
+class UpdateSource:
+    """
+    Источник конвейера (стадия fetch): ждёт следующего цикла - тика CandleClock при опросе
+    REST или закрытия свечи в WebSocket-потоках, - догружает хвосты и пропуски и снимает
+    свечи с буферов фетчеров в IngestBatch. Запись, индикаторы и отправка идут дальше по
+    конвейеру, пока источник уже ждёт следующую свечу.
+    """
+
+    def __init__(self, fetchers, planner, store, history_start, streaming=USE_STREAMING):
+        self.fetchers = fetchers
+        self.planner = planner
+        self.store = store
+        self.history_start = history_start
+        self.streaming = streaming
+        self.streams = []
+        self.tasks = []
+        self.clock = CandleClock(settle_delay=POLL_SETTLE_DELAY, follow_up_delay=POLL_FOLLOW_UP_DELAY,
+                                 follow_ups=POLL_FOLLOW_UPS, deadline=POLL_CYCLE_DEADLINE)
+
+    async def backfill(self, end_time) -> IngestBatch:
+        """Этап 1: всё, чего нет в хранилище, с начала истории; индикаторы - полный расчёт"""
+        cycle_started = time.perf_counter()
+        if not self.streaming:
+            # При опросе в хранилище попадают только закрытые свечи (см. FetchPlanner.plan(closed_only))
+            end_time = self.clock.closed_end(self.clock.last_boundary(end_time))
+        await asyncio.gather(*(
+            fetcher.fetch_all_pairs(ranges=self.planner.plan(exchange, fetcher.target_pairs,
+                                                             self.history_start, end_time))
+            for exchange, fetcher in self.fetchers.items()
+        ))
+        metrics.observe_stage('backfill', cycle_started)
+        return self._batch(self.history_start, end_time, cycle_started)
+
+    def _batch(self, combine_start, end_time, cycle_started) -> IngestBatch:
+        frames, unjoined = {}, {}
+        for exchange, fetcher in self.fetchers.items():
+            self.planner.add_gaps(exchange, fetcher.pop_failed_ranges())
+            if exchange == 'coinbase':
+                # Для 5m без сделок Coinbase не отдаёт свечу: такие интервалы - не пропуски
+                self.planner.mark_empty(exchange, fetcher.pop_empty_ranges())
+            frames[exchange] = fetcher.buffer.drain()
+            unjoined[exchange] = fetcher.pop_flushed_ranges()
+        return IngestBatch(frames, combine_start, end_time, cycle_started, unjoined)
+
+    async def _wait_for_candle(self) -> None:
+        if not self.streams:
+            # Потоки стартуют после бэкфилла: seed_from_store берёт последние свечи из хранилища
+            self.streams = [BinanceKlineStream(self.fetchers['binance']),
+                            CoinbaseMatchStream(self.fetchers['coinbase'])]
+            for stream in self.streams:
+                stream.seed_from_store(self.store)
+            self.tasks = [asyncio.create_task(stream.run()) for stream in self.streams]
+        # Ждём закрытия свечи; таймаут - чтобы пропуски догружались и при молчащих потоках
+        waiters = [asyncio.create_task(stream.closed.wait()) for stream in self.streams]
+        await asyncio.wait(waiters, timeout=600, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in waiters:
+            waiter.cancel()
+        await asyncio.sleep(STREAM_SETTLE_DELAY)
+        for stream in self.streams:
+            stream.closed.clear()
+
+    async def __call__(self) -> Optional[IngestBatch]:
+        markets = {exchange: fetcher.target_pairs for exchange, fetcher in self.fetchers.items()}
+        if self.streaming:
+            await self._wait_for_candle()
+            update_end_time = datetime.now(timezone.utc)
+            timeout = None
+        else:
+            if not await self.clock.wait():
+                # Повторный тик: только рынки, по которым закрытая свеча ещё не пришла
+                markets = dict(self.clock.late)
+            update_end_time = self.clock.closed_end()
+            timeout = self.clock.remaining()
+
+        logging.info("Stage 2 - Fetching current data")
+        cycle_started = time.perf_counter()
+        starts = []
+        planned = {}
+        # Опрос: хвост с последней сохранённой свечи до закрытой на границе плюс известные пропуски,
+        # окно пересчёта - от хвоста; стриминг: только пропуски (хвост приходит из потока),
+        # окно - от самого раннего пропуска
+        window = 0 if self.streaming else -1
+        for exchange, exchange_markets in markets.items():
+            ranges = self.planner.plan(exchange, exchange_markets, self.history_start, update_end_time,
+                                       include_tail=not self.streaming, closed_only=not self.streaming)
+            if ranges:
+                starts.extend(market_ranges[window][0] for market_ranges in ranges.values())
+                planned[exchange] = ranges
+        update_start_time = max(min(starts, default=update_end_time), update_end_time - timedelta(days=1))
+        logging.info(f"Fetching data from {update_start_time} to {update_end_time}")
+
+        fetch_started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.gather(*(
+                self.fetchers[exchange].fetch_all_pairs(ranges=ranges) for exchange, ranges in planned.items()
+            )), timeout)
+        except asyncio.TimeoutError:
+            # Дедлайн цикла: прерванные окна догружаются в следующем цикле (повтор идемпотентен)
+            logging.warning(f"Cycle deadline reached while fetching {update_end_time}, rescheduling ranges")
+            for exchange, ranges in planned.items():
+                self.planner.add_gaps(exchange, [(market, start, end) for market, market_ranges in ranges.items()
+                                                 for start, end in market_ranges])
+        metrics.observe_stage('fetch', fetch_started)
+
+        batch = self._batch(update_start_time, update_end_time, cycle_started)
+        logging.info(f"Ingest buffers: {[fetcher.buffer.stats() for fetcher in self.fetchers.values()]}")
+        if self.streams:
+            logging.info(f"Streams: {[stream.stats() for stream in self.streams]}")
+        if not self.streaming:
+            for exchange in markets:
+                requested = self.fetchers[exchange].symbols.filter(planned.get(exchange, {}))
+                self.clock.update_late(exchange, requested, batch.frames[exchange])
+            logging.info(f"Candle clock: {self.clock.stats()}")
+        if all(frame.empty for frame in batch.frames.values()):
+            # Новых свечей нет - пересчитывать и отправлять нечего
+            return None
+        return batch
+
+    async def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 
 async def fetch_data_in_stages():
     """
     Основная функция для поэтапного сбора и обработки данных.
     """
+    # Пул HTTP-соединений живёт весь цикл: keep-alive к биржам и веб-сервису между итерациями
+    http = HttpSessionManager()
+    combiner = None
+    source = None
+    metrics_runner = None
     try:
+        if METRICS_PORT is not None:
+            metrics_runner = await metrics.serve(METRICS_PORT, METRICS_HOST)
         current_time = datetime.now(timezone.utc)
         # Получаем дату ровно год назад
         start_time = current_time - timedelta(days=365)
@@ -27,91 +198,123 @@ async def fetch_data_in_stages():
         coinbase_pairs = [pair.replace('/USDT', '-USD') for pair in binance_pairs]
 
         # Инициализация фетчеров
-        coinbase_fetcher = CoinbaseDataFetcher(target_pairs=coinbase_pairs)
-        binance_fetcher = BinanceDataFetcher(target_pairs=binance_pairs)
-        combiner = DataCombiner()
+        store = CandleStore('candle_store')
+        # Буферы сбрасываются в хранилище при переполнении, память не растёт за время бэкфилла
+        coinbase_fetcher = CoinbaseDataFetcher(target_pairs=coinbase_pairs, store=store, max_buffer_rows=500_000,
+                                               session_manager=http, api_url=COINBASE_API_URL)
+        binance_fetcher = BinanceDataFetcher(target_pairs=binance_pairs, store=store, max_buffer_rows=500_000,
+                                             session_manager=http, api_url=BINANCE_API_URL)
+        # Объединённая серия Coinbase x Binance по (market, 5m bucket) - своё хранилище рядом со свечами
+        join = CandleJoin(store, CandleStore('joined_candles'))
+        combiner = DataCombiner(session_manager=http, history=PremiumHistoryStore('premium_history'),
+                                rank_error=INDICATOR_RANK_ERROR, workers=INDICATOR_WORKERS, join=join)
+        planner = FetchPlanner(store)
+        history_start = start_time
 
-        # Этап 1: Получение исторических данных
-        logging.info(f"Stage 1 - Fetching historical data from {start_time} to {current_time}")
+        fetchers = {'coinbase': coinbase_fetcher, 'binance': binance_fetcher}
+        source = UpdateSource(fetchers, planner, store, history_start)
+        pipeline = None
 
-        try:
-            # Параллельный сбор данных с обеих бирж
-            await asyncio.gather(
-                coinbase_fetcher.fetch_all_pairs(start_time=start_time, end_time=current_time),
-                binance_fetcher.fetch_all_pairs(start_time=start_time, end_time=current_time)
-            )
-
-            # Сохранение данных
-            coinbase_fetcher.save_to_csv()
-            binance_fetcher.save_to_csv()
-            
-            # Комбинирование данных и расчет индикаторов
-            combined_data = combiner.combine_data('coinbase_data.csv', 'binance_data.csv')
-            if not combined_data.empty:
-                processed_data = combiner._calculate_indicators(combined_data)
-                combiner.processed_data = processed_data
-                combiner.save_combined_data("combined_data.csv")
-                await combiner.send_to_web_service()
+        def collect_stats():
+            for exchange, fetcher in fetchers.items():
+                metrics.export_stats(f"{exchange}_buffer", fetcher.buffer.stats())
+                metrics.export_stats(f"{exchange}_rate_limiter", fetcher.rate_limiter.stats())
+            metrics.export_stats('http', http.stats())
+            metrics.export_stats('candle_clock', source.clock.stats())
+            metrics.export_stats('candle_join', join.stats())
+            if pipeline is not None:
+                for stage, stats in pipeline.stats().items():
+                    metrics.export_stats(f"pipeline_{stage}", stats)
+
+        metrics.REGISTRY.add_collector(collect_stats)
 
+        # Стадии конвейера; store и compute - обычные функции и выполняются в потоках стадий,
+        # event loop тем временем опрашивает биржи и отвечает по /metrics
+        def store_batch(batch):
+            # Сохранение (перезаписываются только затронутые партиции). До записи - отметка в журнале
+            # объединения: сброшенные мимо пакета свечи и свечи старше окна объединения в памяти
+            # (бэкфилл, пропуски), чтобы после сбоя или перезапуска они объединились из хранилища
+            window_start = join.window_start()
+            for exchange, df in batch.frames.items():
+                join.mark_unjoined(exchange, batch.unjoined.get(exchange, []) + candle_ranges(df, window_start))
+                fetchers[exchange].store_frame(df)
+            return batch
+
+        # Пакеты, которые стадия compute не обработала и после повторов: их свечи уже в хранилище
+        # (high-water mark сдвинут) и заново не скачаются, поэтому уходят в следующий пакет
+        failed_batches = []
+
+        def compute_batch(batch, full=False):
+            # Объединяются только свечи пакета (и корзины, которые они дополнили), движку
+            # индикаторов нужны только новые строки; full - вся история для первого расчёта
+            while failed_batches:
+                batch.merge_earlier(failed_batches.pop())
+            if full:
+                combined_data = combiner.combine_from_store(store, start=batch.combine_start, end=batch.end)
+            else:
+                combined_data = combiner.combine_batch(batch.frames['coinbase'], batch.frames['binance'])
+            if combined_data.empty:
+                metrics.observe_stage('cycle', batch.cycle_started)
+                return None
+            # Только пересчитанные строки цикла: дописываются в дневные файлы, а не всей таблицей
+            batch.indicators = combiner.update_indicators(combined_data)
+            combiner.save_indicator_rows(COMBINED_DATA_DIR, batch.indicators, append=not full)
+            # Снимок дашборда - из последних строк рынков в IndicatorEngine, без прохода по таблице
+            batch.latest = combiner._latest_rows()
+            batch.frames = None
+            return batch
+
+        async def push_batch(batch):
+            combiner.processed_data = batch.indicators
+            await combiner.send_to_web_service(latest=batch.latest)
+            # Цикл заметно длиннее паузы между циклами - признак того, что конвейер не успевает
+            metrics.observe_stage('cycle', batch.cycle_started)
+            if pipeline is not None:
+                logging.info(f"Pipeline: {pipeline.stats()}")
+            logging.info(f"HTTP connections: {http.stats()}")
+
+        # Этап 1: Получение исторических данных - один раз и последовательно:
+        # ошибка здесь фатальна, без полного расчёта инкрементальный движок не запустится
+        logging.info(f"Stage 1 - Fetching historical data from {start_time} to {current_time}")
+        try:
+            batch = await source.backfill(current_time)
+            batch = await asyncio.to_thread(store_batch, batch)
+            batch = await asyncio.to_thread(compute_batch, batch, True)
+            if batch is not None:
+                await push_batch(batch)
         except Exception as e:
             logging.error(f"Error in Stage 1: {str(e)}")
             raise
 
-        # Этап 2: Непрерывный сбор текущих данных
-        while True:
-            try:
-                logging.info("Stage 2 - Fetching current data")
-                
-                try:
-                    df = pd.read_csv("combined_data.csv")
-                    current_time = datetime.now(timezone.utc)
-                    start_time = current_time - timedelta(hours=20)
-
-                    # В Stage 2
-                    if len(df) >= 167:
-                        last_106 = df.tail(167)
-                        update_start_time = pd.to_datetime(last_106['DateTime'].min()).tz_localize('UTC')
-                        update_end_time = datetime.now(timezone.utc)
-                        logging.info(f"Fetching data from {update_start_time} to {update_end_time}")
-                    else:
-                        update_end_time = datetime.now(timezone.utc)
-                        update_start_time = update_end_time - timedelta(minutes=2)
-                        
-                    # Сбор новых данных
-                    await asyncio.gather(
-                        coinbase_fetcher.fetch_all_pairs(start_time=update_start_time, end_time=update_end_time),
-                        binance_fetcher.fetch_all_pairs(start_time=update_start_time, end_time=update_end_time)
-                    )
-
-                    # Сохранение новых данных
-                    coinbase_fetcher.save_to_csv()
-                    binance_fetcher.save_to_csv()
-
-                    # Обработка и комбинирование данных
-                    combined_data = combiner.combine_data('coinbase_data.csv', 'binance_data.csv')
-                    if not combined_data.empty:
-                        processed_data = combiner._calculate_indicators(combined_data)
-                        combiner.processed_data = processed_data
-                        combiner.save_combined_data("combined_data.csv")
-                        await combiner.send_to_web_service()
-                
-                except Exception as e:
-                    logging.error(f"Error in data processing: {e}")
-                    await asyncio.sleep(60)
-                    continue
-
-                await asyncio.sleep(45)
-                
-            except Exception as e:
-                logging.error(f"Error in Stage 2: {str(e)}")
-                await asyncio.sleep(60)
-                continue
+        # Этап 2: Непрерывный сбор текущих данных - конвейер fetch -> store -> compute -> push
+        pipeline = IngestPipeline(
+            source,
+            [PipelineStage('store', store_batch, retries=PIPELINE_STAGE_RETRIES),
+             PipelineStage('compute', compute_batch, retries=PIPELINE_STAGE_RETRIES,
+                           on_error=failed_batches.append),
+             PipelineStage('push', push_batch)],
+            queue_size=PIPELINE_QUEUE_SIZE, sync_stage='store',
+        )
+        await pipeline.run()
 
     except Exception as e:
         logging.error(f"Critical error in fetch_data_in_stages: {str(e)}")
         raise
+    finally:
+        if source is not None:
+            await source.close()
+        if combiner is not None:
+            combiner.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await http.close()
 
 if __name__ == "__main__":
+    # Не на уровне модуля: spawn-воркеры ShardPool импортируют __main__ заново
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
     try:
         asyncio.run(fetch_data_in_stages())
     except KeyboardInterrupt:
@@ -0,0 +1,329 @@
+import functools
+import logging
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Content-Type текстового формата Prometheus
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы гистограмм по умолчанию (секунды): от быстрых HTTP-ответов до долгих пересчётов
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+# Задержка от закрытия свечи до дашборда: цикл опроса 45 с, стриминг - секунды
+LAG_BUCKETS = (1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0, 300.0, 600.0, 1800.0)
+
+
+_INF_BOUND = ('le="+Inf"',)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: Tuple = ()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple, object] = {}
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    """Гистограмма с накопительными корзинами (_bucket{le=...}, _sum, _count)"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                le = ('le="' + _format_value(bound) + '"',)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, _INF_BOUND)} {state['count']}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {state['count']}")
+        return lines
+
+
+class Registry:
+    """
+    Метрики процесса. collectors вызываются перед каждой выдачей и обновляют gauge
+    из stats() компонентов (буферы, лимитеры, пул соединений) - без фоновых задач.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered differently")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        for collector in list(self._collectors):
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {e}")
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Запросы к биржам (fetch_window сборщиков)
+EXCHANGE_REQUEST_SECONDS = REGISTRY.histogram(
+    'exchange_request_seconds', 'Latency of exchange REST requests', ['exchange', 'endpoint'])
+EXCHANGE_RESPONSES = REGISTRY.counter(
+    'exchange_responses_total', 'Exchange REST responses by HTTP status (error - no response)',
+    ['exchange', 'endpoint', 'status'])
+EXCHANGE_RETRIES = REGISTRY.counter(
+    'exchange_retries_total', 'Retried exchange requests', ['exchange', 'endpoint'])
+EXCHANGE_FAILED_WINDOWS = REGISTRY.counter(
+    'exchange_failed_windows_total', 'Candle windows skipped after all retries', ['exchange'])
+EXCHANGE_CANDLES = REGISTRY.counter(
+    'exchange_candles_total', 'Candles received from exchange REST APIs', ['exchange'])
+
+# Стадии конвейера
+STAGE_SECONDS = REGISTRY.histogram(
+    'pipeline_stage_seconds', 'Duration of pipeline stages', ['stage'])
+STAGE_ERRORS = REGISTRY.counter(
+    'pipeline_stage_errors_total', 'Pipeline stages that raised an exception', ['stage'])
+STAGE_ROWS = REGISTRY.counter(
+    'pipeline_stage_rows_total', 'Rows consumed (in) and produced (out) by pipeline stages',
+    ['stage', 'direction'])
+STAGE_LAST_ROWS = REGISTRY.gauge(
+    'pipeline_stage_last_rows', 'Rows in and out of the last run of a pipeline stage', ['stage', 'direction'])
+STAGE_LAST_RUN = REGISTRY.gauge(
+    'pipeline_stage_last_run_timestamp_seconds', 'Unix time the stage last finished', ['stage'])
+
+# Задержка от закрытия свечи: pushed - отправка в веб-сервис, dashboard - применение на веб-сервере
+CANDLE_LAG_SECONDS = REGISTRY.histogram(
+    'candle_close_lag_seconds', 'Time from the close of the newest candle to the given point',
+    ['point'], buckets=LAG_BUCKETS)
+LAST_CANDLE_LAG = REGISTRY.gauge(
+    'candle_close_last_lag_seconds', 'Lag of the last update from candle close', ['point'])
+
+# stats() компонентов, собранные collectors
+COMPONENT_STATS = REGISTRY.gauge(
+    'component_stat', 'Numeric stats() of pipeline components', ['component', 'stat'])
+
+
+class StageTimer:
+    """
+    Замер стадии: длительность, ошибки, строки на входе и выходе.
+
+        with metrics.stage('save_to_csv_coinbase') as timer:
+            timer.rows_in = len(df)
+            ...
+            timer.rows_out = len(merged)
+    """
+
+    def __init__(self, name: str, rows_in: Optional[int] = None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out: Optional[int] = None
+        self.elapsed: Optional[float] = None
+        self._started = None
+
+    def __enter__(self) -> 'StageTimer':
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.elapsed = time.perf_counter() - self._started
+        STAGE_SECONDS.observe(self.elapsed, stage=self.name)
+        STAGE_LAST_RUN.set(time.time(), stage=self.name)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.name)
+        for direction, rows in (('in', self.rows_in), ('out', self.rows_out)):
+            if rows is not None:
+                STAGE_ROWS.inc(rows, stage=self.name, direction=direction)
+                STAGE_LAST_ROWS.set(rows, stage=self.name, direction=direction)
+        return False
+
+
+def stage(name: str, rows_in: Optional[int] = None) -> StageTimer:
+    return StageTimer(name, rows_in)
+
+
+def observe_stage(name: str, started: float) -> float:
+    """Стадия без обёртки в with: started - perf_counter() в начале; возвращает длительность"""
+    elapsed = time.perf_counter() - started
+    STAGE_SECONDS.observe(elapsed, stage=name)
+    STAGE_LAST_RUN.set(time.time(), stage=name)
+    return elapsed
+
+
+def timed_stage(name: str):
+    """
+    Декоратор стадии над функцией DataFrame -> DataFrame: rows_in - сумма длин
+    позиционных аргументов-таблиц, rows_out - длина результата.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name) as timer:
+                timer.rows_in = sum(len(arg) for arg in args if hasattr(arg, 'columns')) or None
+                result = func(*args, **kwargs)
+                if hasattr(result, '__len__'):
+                    timer.rows_out = len(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def observe_request(exchange: str, endpoint: str, started: float, status: Optional[int]) -> None:
+    """Запрос к бирже, начатый в started (perf_counter); status None - ответа не было"""
+    EXCHANGE_REQUEST_SECONDS.observe(time.perf_counter() - started, exchange=exchange, endpoint=endpoint)
+    EXCHANGE_RESPONSES.inc(exchange=exchange, endpoint=endpoint, status=status if status is not None else 'error')
+
+
+def observe_candle_lag(point: str, candle_open, interval: float = 300.0) -> Optional[float]:
+    """Задержка от закрытия свечи с временем открытия candle_open (UTC) до текущего момента"""
+    try:
+        opened = pd.Timestamp(candle_open)
+        opened = opened.tz_localize('UTC') if opened.tz is None else opened.tz_convert('UTC')
+    except (ValueError, TypeError):
+        return None
+    lag = time.time() - (opened.timestamp() + interval)
+    CANDLE_LAG_SECONDS.observe(max(lag, 0.0), point=point)
+    LAST_CANDLE_LAG.set(lag, point=point)
+    return lag
+
+
+def export_stats(component: str, stats: Dict) -> None:
+    """Числовые поля stats() компонента в component_stat{component, stat}"""
+    for key, value in stats.items():
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        COMPONENT_STATS.set(value, component=component, stat=key)
+
+
+async def serve(port: int, host: str = '127.0.0.1', registry: Registry = REGISTRY):
+    """
+    /metrics на отдельном порту для процесса без веб-сервера (main.py); возвращает AppRunner.
+    По умолчанию только локальный интерфейс, как у web_server; host='0.0.0.0' - явный выбор.
+    """
+    from aiohttp import web
+
+    async def handler(request):
+        return web.Response(body=registry.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,262 @@
+import os
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+import numpy as np
+import pandas as pd
+
+from rollup import ROLLUP_TIERS, bucket_means, bucket_sums, coarsen_buckets
+
+logger = logging.getLogger(__name__)
+
+# Колонки ряда по монете (кроме времени)
+SERIES_COLUMNS = ['premium_pct', 'price_coinbase', 'price_binance', 'volume_coinbase', 'volume_binance']
+
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+# Точность истории: уровень агрегации подходит, если в запрошенном периоде у него
+# не меньше points * HISTORY_OVERSAMPLE корзин (иначе прореживаются 5-минутные точки)
+HISTORY_OVERSAMPLE = 4
+
+
+class PremiumHistoryStore:
+    """
+    История премии по монетам для графиков: <root>/<Coin>/<YYYY-MM>.parquet.
+
+    Пишет DataCombiner после объединения свечей (upsert по времени, перезаписываются
+    только затронутые месяцы). Веб-сервер читает ряд монеты в память один раз
+    (numpy-массивы, отсортированные по времени) и перечитывает только изменившиеся
+    месячные партиции, поэтому запрос за год - это searchsorted и прореживание.
+    Вместе с рядом строятся средние по часовым и дневным корзинам (rollup.ROLLUP_TIERS):
+    длинный период читается из самого крупного уровня, которого хватает для points точек.
+    Корзины не пересекают границу месяца, поэтому уровни считаются по каждой партиции
+    (дни - из сумм часов) и пересчитываются только для перечитанных партиций.
+    """
+
+    def __init__(self, root: str = 'premium_history', oversample: int = HISTORY_OVERSAMPLE):
+        self.root = root
+        self.oversample = oversample
+        self.lock = threading.Lock()
+        # Coin -> {month: (mtime, DataFrame)} и собранные массивы ряда
+        self._partitions: Dict[str, Dict[str, Tuple[float, pd.DataFrame]]] = {}
+        self._series: Dict[str, Dict[str, np.ndarray]] = {}
+        # Coin -> {уровень: ряды средних по корзинам}, от мелкого к крупному
+        self._tiers: Dict[str, Dict[str, Dict[str, np.ndarray]]] = {}
+        # Coin -> {month: {уровень: средние по корзинам партиции}}
+        self._partition_tiers: Dict[str, Dict[str, Dict[str, Dict[str, np.ndarray]]]] = {}
+
+    def _coin_dir(self, coin: str) -> str:
+        return os.path.join(self.root, quote(coin, safe=''))
+
+    def coins(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(unquote(name) for name in os.listdir(self.root))
+
+    def upsert(self, combined: pd.DataFrame) -> int:
+        """
+        Добавляет строки объединённой таблицы DataCombiner (market, timestamp_coinbase,
+        close_price_*, volume_*). Возвращает число перезаписанных партиций.
+        """
+        if combined.empty:
+            return 0
+
+        frame = pd.DataFrame({
+            'timestamp': pd.to_datetime(combined['timestamp_coinbase'], utc=True),
+            'coin': combined['market'],
+            'price_coinbase': combined['close_price_coinbase'].astype('float64'),
+            'price_binance': combined['close_price_binance'].astype('float64'),
+            'volume_coinbase': combined['volume_coinbase'].astype('float64'),
+            'volume_binance': combined['volume_binance'].astype('float64'),
+        })
+        # Та же формула, что и в DataCombiner._calculate_indicators
+        frame.insert(1, 'premium_pct',
+                     (frame['price_coinbase'] - frame['price_binance']) / frame['price_binance'] * 100)
+        # Без пары с Binance премии нет - на графике такие точки не нужны
+        frame = frame.dropna(subset=['premium_pct'])
+        frame['month'] = frame['timestamp'].dt.strftime('%Y-%m')
+        written = 0
+
+        for (coin, month), part in frame.groupby(['coin', 'month'], sort=False):
+            part = part[['timestamp'] + SERIES_COLUMNS]
+            path = os.path.join(self._coin_dir(coin), f"{month}.parquet")
+
+            if os.path.exists(path):
+                existing = pd.read_parquet(path)
+                merged = pd.concat([existing, part], ignore_index=True)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                existing = None
+                merged = part
+
+            merged = (merged.drop_duplicates(subset=['timestamp'], keep='last')
+                      .sort_values('timestamp')
+                      .reset_index(drop=True))
+            if existing is not None and merged.equals(existing.reset_index(drop=True)):
+                continue
+
+            tmp_path = f"{path}.tmp"
+            merged.to_parquet(tmp_path, index=False)
+            os.replace(tmp_path, path)
+            written += 1
+
+        logger.info(f"Premium history: upserted {len(frame)} rows, {written} partitions rewritten")
+        return written
+
+    def _load(self, coin: str) -> Optional[Dict[str, np.ndarray]]:
+        """Массивы ряда монеты; перечитываются только партиции с новым mtime"""
+        coin_dir = self._coin_dir(coin)
+        if not os.path.isdir(coin_dir):
+            return None
+
+        current = {}
+        for entry in os.scandir(coin_dir):
+            if entry.name.endswith('.parquet'):
+                current[entry.name[:-len('.parquet')]] = entry.stat().st_mtime
+
+        cached = self._partitions.get(coin, {})
+        if coin in self._series and {month: mtime for month, (mtime, _) in cached.items()} == current:
+            return self._series[coin]
+
+        partitions = {}
+        month_tiers = self._partition_tiers.get(coin, {})
+        tiers = {}
+        for month, mtime in current.items():
+            if month in cached and cached[month][0] == mtime:
+                partitions[month] = cached[month]
+                tiers[month] = month_tiers[month]
+            else:
+                partitions[month] = (mtime, pd.read_parquet(os.path.join(coin_dir, f"{month}.parquet")))
+                tiers[month] = _partition_tiers(partitions[month][1])
+        self._partitions[coin] = partitions
+        self._partition_tiers[coin] = tiers
+
+        months = [month for month in sorted(partitions) if len(partitions[month][1])]
+        if not months:
+            return None
+        df = pd.concat([partitions[month][1] for month in months], ignore_index=True)
+        series = {'time': _time_ns(df['timestamp'])}
+        for col in SERIES_COLUMNS:
+            series[col] = df[col].to_numpy(dtype=np.float64)
+        self._series[coin] = series
+        self._tiers[coin] = {name: {key: np.concatenate([tiers[month][name][key] for month in months])
+                                    for key in ['time'] + SERIES_COLUMNS}
+                             for name in ROLLUP_TIERS}
+        return series
+
+    def _select(self, coin: str, start_ns: Optional[int], end_ns: Optional[int], points: int):
+        """(уровень, ряды, lo, hi): самый крупный уровень с достаточным числом корзин в периоде"""
+        levels = [('5m', self._series[coin])] + list(self._tiers[coin].items())
+        for name, series in reversed(levels):
+            times = series['time']
+            lo = 0 if start_ns is None else int(np.searchsorted(times, start_ns, side='left'))
+            hi = len(times) if end_ns is None else int(np.searchsorted(times, end_ns, side='right'))
+            if name == '5m' or hi - lo >= points * self.oversample:
+                return name, series, lo, hi
+
+    def query(self, coin: str, start: Optional[pd.Timestamp] = None, end: Optional[pd.Timestamp] = None,
+              points: int = 1000, method: str = 'lttb') -> Optional[Dict]:
+        """
+        Ряд монеты за [start, end], прореженный до points точек по премии:
+        lttb - Largest-Triangle-Three-Buckets, minmax - минимум и максимум в каждом интервале.
+        Остальные ряды берутся в тех же точках. None - монеты нет в истории.
+        Для длинных периодов читаются средние по корзинам (tier в ответе), total - число
+        прочитанных точек выбранного уровня.
+        """
+        if method not in DOWNSAMPLE_METHODS:
+            raise ValueError(f"Unknown downsampling method {method}, expected one of {DOWNSAMPLE_METHODS}")
+
+        with self.lock:
+            if self._load(coin) is None:
+                return None
+            tier, series, lo, hi = self._select(coin, None if start is None else _to_ns(start),
+                                                None if end is None else _to_ns(end), points)
+
+        times = series['time']
+        window = slice(lo, hi)
+
+        if method == 'lttb':
+            indices = lttb_indices(times[window], series['premium_pct'][window], points)
+        else:
+            indices = minmax_indices(series['premium_pct'][window], points)
+
+        result = {'time': times[window][indices] // 1_000_000}  # мс для JS Date
+        for col in SERIES_COLUMNS:
+            result[col] = series[col][window][indices]
+        return {'total': hi - lo, 'tier': tier, 'series': result}
+
+
+def _time_ns(timestamps: pd.Series) -> np.ndarray:
+    return timestamps.dt.tz_convert('UTC').dt.tz_localize(None).to_numpy().view(np.int64)
+
+
+def _partition_tiers(part: pd.DataFrame) -> Dict[str, Dict[str, np.ndarray]]:
+    """Средние партиции по уровням ROLLUP_TIERS; каждый следующий уровень - из сумм предыдущего"""
+    if part.empty:
+        return {}
+    sums = None
+    tiers = {}
+    for name, resolution in ROLLUP_TIERS.items():
+        if sums is None:
+            sums = bucket_sums(_time_ns(part['timestamp']),
+                               {col: part[col].to_numpy(dtype=np.float64) for col in SERIES_COLUMNS}, resolution)
+        else:
+            sums = coarsen_buckets(sums, resolution)
+        tiers[name] = bucket_means(sums)
+    return tiers
+
+
+def _to_ns(value) -> int:
+    ts = pd.Timestamp(value)
+    ts = ts.tz_localize('UTC') if ts.tz is None else ts.tz_convert('UTC')
+    return ts.value
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Индексы точек Largest-Triangle-Three-Buckets (первая и последняя точки сохраняются)"""
+    n = len(y)
+    if points >= n:
+        return np.arange(n)
+    if points < 3:
+        return np.linspace(0, n - 1, points, dtype=np.int64)
+
+    x = x.astype(np.float64)
+    # Границы points-2 внутренних корзин
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    # Третья вершина треугольника - среднее следующей корзины (для последней - последняя точка).
+    # Суммы только по внутренним корзинам: последняя точка в них не входит
+    counts = np.diff(edges)
+    avg_x = np.append(np.add.reduceat(x[:edges[-1]], edges[:-1]) / counts, x[-1])[1:]
+    avg_y = np.append(np.add.reduceat(y[:edges[-1]], edges[:-1]) / counts, y[-1])[1:]
+
+    indices = np.empty(points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    selected = 0
+    for i in range(points - 2):
+        start, stop = edges[i], edges[i + 1]
+        px, py = x[selected], y[selected]
+        area = np.abs((px - avg_x[i]) * (y[start:stop] - py) - (px - x[start:stop]) * (avg_y[i] - py))
+        selected = start + int(np.argmax(area))
+        indices[i + 1] = selected
+    return indices
+
+
+def minmax_indices(y: np.ndarray, points: int) -> np.ndarray:
+    """Индексы минимума и максимума в каждом из points/2 равных интервалов, по возрастанию"""
+    n = len(y)
+    if points >= n:
+        return np.arange(n)
+    buckets = max(points // 2, 1)
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    starts = edges[:-1]
+    lengths = np.diff(edges)
+    # Корзины одинаковой длины (±1): дополняем до прямоугольной матрицы
+    width = int(lengths.max())
+    offsets = np.minimum(np.arange(width), (lengths - 1)[:, None])
+    grid = y[starts[:, None] + offsets]
+    mins = starts + np.argmin(grid, axis=1)
+    maxs = starts + np.argmax(grid, axis=1)
+    return np.unique(np.concatenate([mins, maxs]))
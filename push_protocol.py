@@ -0,0 +1,50 @@
+import json
+from typing import Dict, List, Optional
+
+try:
+    import msgpack
+except ImportError:  # msgpack необязателен, без него используется только JSON
+    msgpack = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Версия формата сообщений /update_data
+PROTOCOL_VERSION = 1
+
+
+def supported_formats() -> List[str]:
+    """Форматы в порядке предпочтения"""
+    return ([MSGPACK] if msgpack is not None else []) + [JSON]
+
+
+def encode(message: dict, content_type: str = JSON) -> bytes:
+    if content_type == MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message).encode('utf-8')
+
+
+def decode(body: bytes, content_type: Optional[str] = JSON):
+    content_type = (content_type or JSON).split(';')[0].strip()
+    if content_type == MSGPACK:
+        if msgpack is None:
+            raise ValueError("msgpack is not installed")
+        return msgpack.unpackb(body, raw=False)
+    return json.loads(body)
+
+
+def make_message(seq: int, base_seq: int, rows: List[dict], removed: List[str] = (),
+                 full: bool = False) -> Dict:
+    """
+    Обновление дашборда: rows - последние строки изменившихся монет (по ключу Coin),
+    removed - монеты, которые нужно убрать. Дельта применяется, только если состояние
+    сервера находится на base_seq; full=True заменяет состояние целиком.
+    """
+    return {
+        'version': PROTOCOL_VERSION,
+        'seq': seq,
+        'base_seq': base_seq,
+        'full': full,
+        'rows': rows,
+        'removed': list(removed),
+    }
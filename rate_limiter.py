@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Токен-бакет с резервированием: acquire() списывает токены сразу (баланс может уйти
+    в минус) и ждёт, пока долг не восполнится. Между проверкой и списанием нет await,
+    поэтому параллельные задачи выстраиваются в очередь, а не ждут одно и то же время.
+
+    Скорость адаптивная: на 429 она уменьшается вдвое, после успешных ответов
+    постепенно возвращается к исходной (AIMD).
+    """
+
+    def __init__(self, rate: float, capacity: float, min_rate_factor: float = 0.1,
+                 recovery_step: float = 0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.pause_until = 0.0
+        self.min_rate = rate * min_rate_factor
+        self.recovery_step = rate * recovery_step
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        """Списывает токены и возвращает, сколько секунд нужно подождать"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= tokens
+        wait_time = max(0.0, self.pause_until - now)
+        if self.tokens < 0:
+            wait_time = max(wait_time, -self.tokens / self.rate)
+        return wait_time
+
+    async def acquire(self, tokens: float = 1) -> None:
+        wait_time = self.reserve(tokens)
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+
+    def penalize(self, retry_after: Optional[float] = None) -> None:
+        """Ответ 429/418: пауза на Retry-After и снижение скорости"""
+        now = time.monotonic()
+        self._refill(now)
+        if retry_after is not None:
+            self.pause_until = max(self.pause_until, now + retry_after)
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0)
+
+    def reward(self) -> None:
+        """Успешный ответ: скорость понемногу возвращается к исходной"""
+        if self.rate < self.max_rate:
+            self._refill(time.monotonic())
+            self.rate = min(self.max_rate, self.rate + self.recovery_step)
+
+    def sync_used(self, used: float) -> None:
+        """Сверка с расходом, который сообщила биржа (например, X-MBX-USED-WEIGHT-1M)"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, self.capacity - used)
+
+
+class RateLimiter:
+    """
+    Лимитер запросов одной биржи: один бакет на биржу (публичные лимиты Coinbase и вес
+    запросов Binance общие для всех эндпоинтов). acquire(cost) ждёт свою очередь в бакете.
+    """
+
+    def __init__(self, exchange: str, rate: float, capacity: Optional[float] = None,
+                 weight_limit: Optional[float] = None, weight_header: Optional[str] = None):
+        self.exchange = exchange
+        self.bucket = TokenBucket(rate, capacity if capacity is not None else rate)
+        # Лимит веса за минуту и заголовок, в котором биржа сообщает израсходованный вес
+        self.weight_limit = weight_limit
+        self.weight_header = weight_header.lower() if weight_header else None
+        self.throttled = 0
+
+    async def acquire(self, cost: float = 1) -> None:
+        wait_time = self.bucket.reserve(cost)
+        if wait_time > 0:
+            if wait_time > 1:
+                logger.info(f"{self.exchange}: rate limit reached, waiting {wait_time:.2f} seconds")
+            await asyncio.sleep(wait_time)
+
+        # Пауза по 429 могла начаться, пока мы ждали своей очереди
+        while self.bucket.pause_until > time.monotonic():
+            await asyncio.sleep(self.bucket.pause_until - time.monotonic())
+
+    def update(self, status: int, headers) -> None:
+        """Учитывает ответ биржи: заголовки расхода веса, 429/418 и Retry-After"""
+        if self.weight_header and self.weight_limit:
+            for name, value in headers.items():
+                if name.lower() == self.weight_header:
+                    self.bucket.sync_used(float(value))
+
+        if status in (418, 429):
+            self.throttled += 1
+            retry_after = headers.get('Retry-After')
+            retry_after = float(retry_after) if retry_after is not None else None
+            logger.warning(f"{self.exchange}: HTTP {status}, backing off"
+                           + (f" for {retry_after:.0f} seconds" if retry_after else ""))
+            self.bucket.penalize(retry_after)
+        elif status < 400:
+            self.bucket.reward()
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'rate': self.bucket.rate,
+            'tokens': self.bucket.tokens,
+            'throttled': self.throttled,
+        }
+
+
+def coinbase_rate_limiter(rate: float = 10) -> RateLimiter:
+    """Публичные эндпоинты Coinbase Exchange: 10 запросов в секунду на IP"""
+    return RateLimiter('coinbase', rate=rate, capacity=rate)
+
+
+def binance_rate_limiter(weight_limit_per_minute: float = 6000, safety_margin: float = 0.9) -> RateLimiter:
+    """Binance: бакет в единицах веса запросов (REQUEST_WEIGHT за минуту) с запасом safety_margin"""
+    budget = weight_limit_per_minute * safety_margin
+    return RateLimiter('binance', rate=budget / 60, capacity=budget,
+                       weight_limit=weight_limit_per_minute, weight_header='X-MBX-USED-WEIGHT-1M')
@@ -0,0 +1,337 @@
+import logging
+import math
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Уровни агрегации над 5-минутными свечами, от мелкого к крупному
+ROLLUP_TIERS = {
+    '1h': pd.Timedelta('1h').value,
+    '1d': pd.Timedelta('1D').value,
+}
+
+# Длительность свечи, из которых строятся корзины
+CANDLE_INTERVAL = pd.Timedelta('5min').value
+
+
+class TierPlan:
+    """Как считается одно окно: уровень агрегации и квантильный скетч его корзин"""
+
+    def __init__(self, tier: str, resolution: int, buckets: int, sketch: 'BucketSketch'):
+        self.tier = tier
+        self.resolution = resolution
+        self.buckets = buckets
+        self.sketch = sketch
+
+    @property
+    def rank_error(self) -> float:
+        """
+        Граница ошибки медианы по рангу (доля окна): ошибка скетча плюс одна корзина
+        на сдвиг границ окна к границам корзин.
+        """
+        return self.sketch.rank_error + 1 / self.buckets
+
+    def describe(self) -> str:
+        return f"{self.buckets} x {self.tier} sketches, rank error <= {self.rank_error:.2%}"
+
+
+def plan_window(period, rank_error: float) -> Optional[TierPlan]:
+    """
+    Самый крупный уровень, на котором медиана окна period укладывается в rank_error:
+    часть ошибки уходит на границы окна (1 / число корзин), остаток - скетчу корзин.
+    None - точнее не сжать (скетч хранил бы все свечи), окно считается по свечам.
+    """
+    period = pd.Timedelta(period).value
+    for name, resolution in reversed(list(ROLLUP_TIERS.items())):
+        buckets = period // resolution
+        # Запас rank_error скетча покрывает неполную открытую корзину, если корзин в окне хотя бы 10
+        if buckets < 10 or rank_error <= 1 / buckets:
+            continue
+        sketch = BucketSketch(resolution, rank_error - 1 / buckets)
+        if sketch.step > 1:
+            return TierPlan(name, resolution, buckets, sketch)
+    return None
+
+
+def plan_windows(intervals: Dict[str, str], rank_error: Optional[float] = None) -> Dict[str, Optional[TierPlan]]:
+    """
+    Окно -> TierPlan или None (точная медиана по свечам).
+    rank_error - допустимая ошибка медианы по рангу (доля окна, например 0.01);
+    None - все окна точные.
+    """
+    if rank_error is None:
+        return {label: None for label in intervals}
+    if not 0 < rank_error < 0.5:
+        raise ValueError(f"rank error must be in (0, 0.5), got {rank_error}")
+    return {label: plan_window(period, rank_error) for label, period in intervals.items()}
+
+
+class BucketSketch:
+    """
+    Параметры квантильного скетча корзины уровня.
+
+    Скетч корзины - отсортированные значения, прореженные с шагом step: каждая точка -
+    середина своей группы из step соседних значений, все точки одного веса. Скетчи
+    корзин сливаются простым объединением, медиана окна - медиана точек всех его
+    корзин. step - делитель числа свечей в полной корзине (candles), поэтому все группы
+    полной корзины одного размера и вес точки точный: в каждой корзине ошибка счёта
+    значений ниже медианы - только от одной разрезанной группы, не больше step / 2.
+    rank_error = (step - 1) / candles - граница с запасом вдвое на неполную открытую
+    корзину окна и чётность числа точек; step = 1 - точный результат.
+    """
+
+    def __init__(self, resolution: int, error: float):
+        if not 0 < error < 0.5:
+            raise ValueError(f"sketch error must be in (0, 0.5), got {error}")
+        self.candles = max(1, resolution // CANDLE_INTERVAL)
+        self.step = max(step for step in range(1, self.candles + 1)
+                        if self.candles % step == 0 and (step - 1) / self.candles <= error)
+        # Точек в полной корзине; в корзине с лишними свечами шаг увеличивается
+        self.slots = self.candles // self.step
+        self.rank_error = (self.step - 1) / self.candles
+
+    def summarize(self, values) -> np.ndarray:
+        values = np.sort(np.asarray(values, dtype=np.float64))
+        values = values[~np.isnan(values)]
+        n = len(values)
+        if n == 0:
+            return values
+        step = max(self.step, math.ceil(n / self.slots))
+        starts = np.arange(0, n, step)
+        ends = np.minimum(starts + step, n)
+        return values[(starts + ends - 1) // 2]
+
+    def grid_points(self, codes: np.ndarray, buckets: np.ndarray, values: np.ndarray):
+        """Векторный summarize для всех корзин: (codes, buckets, slots, values) точек"""
+        present = ~np.isnan(values)
+        codes, buckets, values = codes[present], buckets[present], values[present]
+        order = np.lexsort((values, buckets, codes))
+        codes, buckets, values = codes[order], buckets[order], values[order]
+        if len(values) == 0:
+            return codes, buckets, buckets, values
+
+        first = np.ones(len(values), dtype=bool)
+        first[1:] = (codes[1:] != codes[:-1]) | (buckets[1:] != buckets[:-1])
+        starts = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+        sizes = np.diff(np.append(starts, len(values)))
+        pos = np.arange(len(values)) - starts[group]
+        n = sizes[group]
+        step = np.maximum(self.step, -(-n // self.slots))
+        slot = pos // step
+        slot_start = slot * step
+        slot_end = np.minimum(slot_start + step, n)
+        chosen = pos == (slot_start + slot_end - 1) // 2
+        return codes[chosen], buckets[chosen], slot[chosen], values[chosen]
+
+
+def rolling_bucket_medians(keys: np.ndarray, codes: np.ndarray, values: Dict[str, np.ndarray],
+                           period, resolution: int, sketch: BucketSketch) -> Dict[str, np.ndarray]:
+    """
+    Медиана по точкам скетчей корзин окна для каждой строки (векторно, по всем рынкам сразу).
+
+    Значение с ключом keys[i] попадает в корзину keys[i] // resolution. Для строки
+    в корзине b окно - корзины [b - W + 1, b], W = period / resolution, то есть
+    period, как у точного rolling(period), с открытой корзиной строки. Открытая
+    корзина берётся со всеми свечами из истории (у последней строки рынка - ровно
+    до неё, как в TierWindow); сдвиг границ учтён в TierPlan.rank_error.
+    codes - номер рынка строки, строки одного рынка идут подряд и отсортированы по времени.
+    """
+    window = pd.Timedelta(period).value // resolution
+    buckets = keys // resolution
+    slots = sketch.slots
+
+    # Полная сетка корзин каждого рынка (по slots точек на корзину): пропуски - NaN
+    markets, row_market = np.unique(codes, return_inverse=True)
+    first = pd.Series(buckets).groupby(row_market).min().to_numpy()
+    last = pd.Series(buckets).groupby(row_market).max().to_numpy()
+    sizes = last - first + 1
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    grid_codes = np.repeat(np.arange(len(markets)), sizes * slots)
+
+    # Строка берёт значение окна, закончившегося на последней точке своей корзины
+    row_pos = (offsets[row_market] + buckets - first[row_market]) * slots + slots - 1
+
+    result = {}
+    for name, series in values.items():
+        point_market, point_bucket, point_slot, point_values = sketch.grid_points(row_market, buckets, series)
+        grid = np.full(int(sizes.sum()) * slots, np.nan)
+        grid[(offsets[point_market] + point_bucket - first[point_market]) * slots + point_slot] = point_values
+        rolled = (pd.Series(grid).groupby(grid_codes, sort=True)
+                  .rolling(window=int(window) * slots, min_periods=1).median()
+                  .to_numpy())
+        result[name] = rolled[row_pos]
+    return result
+
+
+class TierWindow:
+    """
+    Инкрементальное окно по корзинам уровня: медиана по точкам скетчей корзин
+    [b - W + 1, b] для строки в корзине b. Последняя (открытая) корзина хранится
+    сырыми значениями и входит в окно теми свечами, что уже пришли.
+    """
+
+    def __init__(self, period, resolution: int, window_factory, sketch: BucketSketch):
+        self.resolution = resolution
+        self.size = pd.Timedelta(period).value // resolution
+        self.sketch = sketch
+        # (корзина, точки premium_pct, точки volume) закрытых корзин
+        self.buckets = deque()
+        self.premium_pct = window_factory()
+        self.volume = window_factory()
+        self.pending: Optional[int] = None
+        self.pending_premium_pct = []
+        self.pending_volume = []
+
+    def _add(self, premium_pct: np.ndarray, volume: np.ndarray) -> None:
+        for value in premium_pct:
+            self.premium_pct.insert(value)
+        for value in volume:
+            self.volume.insert(value)
+
+    def _discard(self, premium_pct: np.ndarray, volume: np.ndarray) -> None:
+        for value in premium_pct:
+            self.premium_pct.remove(value)
+        for value in volume:
+            self.volume.remove(value)
+
+    def _close(self) -> None:
+        entry = (self.pending, self.sketch.summarize(self.pending_premium_pct),
+                 self.sketch.summarize(self.pending_volume))
+        self.buckets.append(entry)
+        self._add(entry[1], entry[2])
+        self.pending_premium_pct = []
+        self.pending_volume = []
+
+    def push(self, key: int, premium_pct: float, volume: float) -> None:
+        bucket = key // self.resolution
+        if self.pending is not None and bucket != self.pending:
+            self._close()
+        self.pending = bucket
+        self.pending_premium_pct.append(premium_pct)
+        self.pending_volume.append(volume)
+
+    def pop(self) -> None:
+        """Убирает последнее добавленное значение (оно всегда в незакрытой корзине)"""
+        self.pending_premium_pct.pop()
+        self.pending_volume.pop()
+
+    def _lowest(self, t: int) -> int:
+        """Самая старая корзина окна строки со временем t"""
+        return t // self.resolution - self.size + 1
+
+    def evict(self, t: int) -> None:
+        lowest = self._lowest(t)
+        while self.buckets and self.buckets[0][0] < lowest:
+            _, premium_pct, volume = self.buckets.popleft()
+            self._discard(premium_pct, volume)
+
+    def medians(self, t: int) -> Tuple[float, float]:
+        """Медианы для строки со временем t: корзины [b - W + 1, b], открытая - по пришедшим свечам"""
+        bucket = t // self.resolution
+        lowest = self._lowest(t)
+        excluded = []
+        for entry in self.buckets:
+            if entry[0] >= lowest:
+                break
+            excluded.append(entry)
+        included = self.pending is not None and lowest <= self.pending <= bucket
+        pending = (self.sketch.summarize(self.pending_premium_pct),
+                   self.sketch.summarize(self.pending_volume)) if included else None
+
+        for _, premium_pct, volume in excluded:
+            self._discard(premium_pct, volume)
+        if pending is not None:
+            self._add(*pending)
+
+        medians = (self.premium_pct.median(), self.volume.median())
+
+        if pending is not None:
+            self._discard(*pending)
+        for _, premium_pct, volume in excluded:
+            self._add(premium_pct, volume)
+        return medians
+
+    def load(self, keys: np.ndarray, premium_pct: np.ndarray, volume: np.ndarray, t: int) -> None:
+        """Состояние из истории рынка (ключи по возрастанию) после вытеснения по времени t"""
+        self.buckets = deque()
+        self.pending = None
+        self.pending_premium_pct = []
+        self.pending_volume = []
+        self.premium_pct.load(np.empty(0))
+        self.volume.load(np.empty(0))
+        if len(keys) == 0:
+            return
+
+        buckets = keys // self.resolution
+        last = buckets[-1]
+        closed = np.flatnonzero((buckets < last) & (buckets >= self._lowest(t)))
+        if len(closed):
+            bounds = np.flatnonzero(np.diff(buckets[closed])) + 1
+            for group in np.split(closed, bounds):
+                self.buckets.append((int(buckets[group[0]]), self.sketch.summarize(premium_pct[group]),
+                                     self.sketch.summarize(volume[group])))
+            self.premium_pct.load(np.concatenate([entry[1] for entry in self.buckets]))
+            self.volume.load(np.concatenate([entry[2] for entry in self.buckets]))
+        self.pending = int(last)
+        self.pending_premium_pct = premium_pct[buckets == last].tolist()
+        self.pending_volume = volume[buckets == last].tolist()
+
+
+def _regroup(times: np.ndarray, sums: Dict[str, np.ndarray], filled: Dict[str, np.ndarray],
+             resolution: int) -> Dict:
+    buckets = times // resolution
+    starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+    return {'time': buckets[starts] * resolution,
+            'sum': {name: np.add.reduceat(series, starts) for name, series in sums.items()},
+            'filled': {name: np.add.reduceat(series, starts) for name, series in filled.items()}}
+
+
+def bucket_sums(times: np.ndarray, values: Dict[str, np.ndarray], resolution: int) -> Dict:
+    """Суммы и число значений (без NaN) по корзинам для рядов истории (times - int64 нс по возрастанию)"""
+    present = {name: ~np.isnan(series) for name, series in values.items()}
+    return _regroup(times, {name: np.where(present[name], series, 0.0) for name, series in values.items()},
+                    {name: mask.astype(np.int64) for name, mask in present.items()}, resolution)
+
+
+def coarsen_buckets(sums: Dict, resolution: int) -> Dict:
+    """bucket_sums более крупного уровня из сумм мелкого (например, дни из часов), без исходных строк"""
+    return _regroup(sums['time'], sums['sum'], sums['filled'], resolution)
+
+
+def bucket_means(sums: Dict) -> Dict[str, np.ndarray]:
+    """Средние по корзинам из bucket_sums; NaN - в корзине нет значений"""
+    result = {'time': sums['time']}
+    for name, total in sums['sum'].items():
+        filled = sums['filled'][name]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            result[name] = np.where(filled > 0, total / filled, np.nan)
+    return result
+
+
+def window_rank_errors(keys: np.ndarray, codes: np.ndarray, values: np.ndarray, estimates: np.ndarray,
+                       period, rows: np.ndarray) -> np.ndarray:
+    """
+    Фактическая ошибка по рангу оценок медианы estimates[rows] (доля окна): расстояние от 0.5
+    до долей значений точного окна (t - period, t], которые меньше оценки и не больше её.
+    keys и codes - как у rolling_bucket_medians; NaN - пустое окно или нет оценки.
+    """
+    period = pd.Timedelta(period).value
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    market_starts = starts[np.searchsorted(starts, rows, side='right') - 1]
+    errors = np.full(len(rows), np.nan)
+    for j, (row, start) in enumerate(zip(rows, market_starts)):
+        estimate = estimates[row]
+        lowest = start + np.searchsorted(keys[start:row + 1], keys[row] - period, side='right')
+        window = values[lowest:row + 1]
+        window = window[~np.isnan(window)]
+        if len(window) == 0 or np.isnan(estimate):
+            continue
+        below = np.count_nonzero(window < estimate) / len(window)
+        upto = np.count_nonzero(window <= estimate) / len(window)
+        errors[j] = max(0.0, below - 0.5, 0.5 - upto)
+    return errors
@@ -0,0 +1,162 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# Меньше строк - считаем в текущем процессе: сериализация и запуск задач дороже выигрыша
+SHARD_MIN_ROWS = 200_000
+
+
+def write_shared(df: pd.DataFrame) -> Tuple[str, int]:
+    """DataFrame -> Arrow IPC в разделяемой памяти; возвращает (имя сегмента, размер)"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Размер потока считается без записи данных, затем поток пишется прямо в сегмент
+    sink = pa.MockOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    size = sink.size()
+
+    shm = SharedMemory(create=True, size=max(size, 1))
+    try:
+        _write_ipc(shm.buf, table)
+        return shm.name, size
+    finally:
+        shm.close()
+
+
+def _write_ipc(memory: memoryview, table: pa.Table) -> None:
+    # Все ссылки на буфер сегмента живут только внутри функции, иначе shm.close() не пройдёт
+    stream = pa.FixedSizeBufferWriter(pa.py_buffer(memory))
+    with pa.ipc.new_stream(stream, table.schema) as writer:
+        writer.write_table(table)
+    stream.close()
+
+
+def _read_ipc(memory: memoryview, size: int) -> pd.DataFrame:
+    table = pa.ipc.open_stream(pa.py_buffer(memory)[:size]).read_all()
+    return table.to_pandas()
+
+
+def read_shared(name: str, size: int, unlink: bool = True) -> pd.DataFrame:
+    """Читает Arrow IPC из сегмента в DataFrame (данные копируются, сегмент можно удалить)"""
+    shm = SharedMemory(name=name)
+    try:
+        return _read_ipc(shm.buf, size)
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+
+
+# Комбайнер воркера: создаётся один раз на процесс и конфигурацию
+_worker_combiners: Dict[tuple, object] = {}
+
+
+def _worker_combiner(config: dict):
+    from data_combiner import DataCombiner
+
+    key = tuple(sorted(config.items()))
+    if key not in _worker_combiners:
+        _worker_combiners[key] = DataCombiner(**config)
+    return _worker_combiners[key]
+
+
+def _run_shard(task: str, inputs: List[Tuple[str, int]], config: dict, options: dict) -> Tuple[str, int]:
+    """Задача воркера: входы и результат передаются через разделяемую память"""
+    frames = [read_shared(name, size, unlink=False) for name, size in inputs]
+    combiner = _worker_combiner(config)
+    if task == 'combine':
+        result = combiner.combine_frames(*frames)
+    elif task == 'indicators':
+        result = combiner._calculate_indicators(frames[0], **options)
+    else:
+        raise ValueError(f"Unknown shard task {task}")
+    return write_shared(result)
+
+
+class ShardPool:
+    """
+    Пул процессов для расчётов, независимых по рынкам (combine_frames, _calculate_indicators).
+
+    Рынки раскладываются по шардам с выравниванием по числу строк, каждый шард
+    передаётся воркеру как Arrow IPC в разделяемой памяти (без pickle DataFrame),
+    результат возвращается тем же способом и собирается в исходную схему.
+    """
+
+    def __init__(self, workers: int, min_rows: int = SHARD_MIN_ROWS):
+        self.workers = workers
+        self.min_rows = min_rows
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: воркеры не наследуют состояние event loop и потоков родителя
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def should_shard(self, rows: int, markets: int) -> bool:
+        return self.workers > 1 and markets > 1 and rows >= self.min_rows
+
+    def assign(self, keys: pd.Series) -> np.ndarray:
+        """Номер шарда для каждой строки: рынки по убыванию размера в наименее загруженный шард"""
+        counts = keys.value_counts()
+        shards = min(self.workers, len(counts))
+        loads = np.zeros(shards, dtype=np.int64)
+        assignment = {}
+        for market, count in counts.items():
+            shard = int(np.argmin(loads))
+            assignment[market] = shard
+            loads[shard] += count
+        return keys.map(assignment).to_numpy()
+
+    def run(self, task: str, frames: List[pd.DataFrame], shard_ids: List[np.ndarray], config: dict,
+            options: Optional[dict] = None) -> List[pd.DataFrame]:
+        """Выполняет задачу по шардам; frames[i] делится по shard_ids[i]"""
+        shards = sorted(set().union(*(np.unique(ids).tolist() for ids in shard_ids)))
+        inputs = {shard: [] for shard in shards}
+        segments = []
+        try:
+            for frame, ids in zip(frames, shard_ids):
+                for shard in shards:
+                    segment = write_shared(frame[ids == shard])
+                    segments.append(segment)
+                    inputs[shard].append(segment)
+
+            futures = [self.executor.submit(_run_shard, task, inputs[shard], config, options or {})
+                       for shard in shards]
+            results, error = [], None
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    error = error or e
+            if error is not None:
+                for name, _ in results:
+                    _unlink(name)
+                raise error
+            return [read_shared(name, size) for name, size in results]
+        finally:
+            for name, _ in segments:
+                _unlink(name)
+
+
+def _unlink(name: str) -> None:
+    try:
+        shm = SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
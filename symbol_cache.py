@@ -0,0 +1,79 @@
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class SymbolCache:
+    """
+    Кэш списка торгуемых пар биржи с TTL и негативный кэш недоступных пар.
+
+    Список (Coinbase /products, Binance exchangeInfo) загружается не чаще раза в ttl
+    секунд; при ошибке загрузки остаётся прежний. Пары, которых нет в списке или на
+    которые биржа ответила "нет такого символа", попадают в негативный кэш на
+    negative_ttl секунд, и задания по ним пропускаются без запросов и ретраев.
+    """
+
+    def __init__(self, exchange: str, ttl: float = 3600.0, negative_ttl: float = 6 * 3600.0):
+        self.exchange = exchange
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.symbols: Optional[Set[str]] = None
+        self.loaded_at = 0.0
+        self.unavailable: Dict[str, float] = {}  # пара -> момент истечения записи
+        self.refreshes = 0
+
+    def is_fresh(self) -> bool:
+        return self.symbols is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    async def get(self, loader: Callable[[], Awaitable[Optional[Iterable[str]]]]) -> Optional[Set[str]]:
+        """Список пар из кэша; loader вызывается, только если TTL истёк"""
+        if self.is_fresh():
+            return self.symbols
+
+        symbols = await loader()
+        if symbols:
+            self.symbols = set(symbols)
+            self.loaded_at = time.monotonic()
+            self.refreshes += 1
+            # Пары, снова появившиеся в листинге, убираются из негативного кэша
+            for pair in [pair for pair in self.unavailable if pair in self.symbols]:
+                del self.unavailable[pair]
+        elif self.symbols is not None:
+            logger.warning(f"{self.exchange}: failed to refresh symbol list, using cached one")
+        return self.symbols
+
+    def mark_unavailable(self, pair: str, reason: str = 'not listed') -> None:
+        if pair not in self.unavailable:
+            logger.warning(f"{self.exchange}: {pair} is unavailable ({reason}), skipping")
+        self.unavailable[pair] = time.monotonic() + self.negative_ttl
+
+    def is_unavailable(self, pair: str) -> bool:
+        expires = self.unavailable.get(pair)
+        if expires is None:
+            return False
+        if expires <= time.monotonic():
+            del self.unavailable[pair]
+            return False
+        return True
+
+    def filter(self, pairs: Iterable[str]) -> List[str]:
+        """Оставляет пары, которые есть в листинге и не в негативном кэше"""
+        available = []
+        for pair in pairs:
+            if self.is_unavailable(pair):
+                continue
+            if self.symbols is not None and pair not in self.symbols:
+                self.mark_unavailable(pair)
+                continue
+            available.append(pair)
+        return available
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'symbols': len(self.symbols) if self.symbols is not None else 0,
+            'unavailable': len(self.unavailable),
+            'refreshes': self.refreshes,
+            'age_seconds': time.monotonic() - self.loaded_at if self.symbols is not None else None,
+        }
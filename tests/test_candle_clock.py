@@ -0,0 +1,197 @@
+import asyncio
+import types
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+import candle_clock
+from benchmarks.mock_exchange import MockExchange, SyntheticCandles
+from candle_clock import CandleClock
+from candle_store import CandleStore
+from fetch_planner import FetchPlanner
+from get_data_binance import BinanceDataFetcher
+from get_data_coinbase import CoinbaseDataFetcher
+from main import UpdateSource
+
+INTERVAL = timedelta(minutes=5)
+REAL_SLEEP = asyncio.sleep
+
+
+class FakeTime:
+    """Часы candle_clock: datetime.now() и asyncio.sleep() двигают виртуальное время"""
+
+    def __init__(self, monkeypatch, now: datetime):
+        self.now = now
+        self.slept = []
+        fake = self
+
+        class FakeDatetime(datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return fake.now
+
+        async def sleep(seconds):
+            fake.slept.append(seconds)
+            fake.now += timedelta(seconds=seconds)
+            await REAL_SLEEP(0)
+
+        monkeypatch.setattr(candle_clock, 'datetime', FakeDatetime)
+        monkeypatch.setattr(candle_clock, 'asyncio', types.SimpleNamespace(sleep=sleep))
+
+
+class LateCandles(SyntheticCandles):
+    """Синтетические свечи, где у части рынков свеча с open time >= hold_from приходит не с первого запроса"""
+
+    def __init__(self, hold_from: datetime, late: dict, **kwargs):
+        super().__init__(**kwargs)
+        self.hold_from = int(hold_from.timestamp())
+        self.late = dict(late)  # (exchange, pair) -> сколько запросов свеча ещё не готова
+
+    def candles(self, exchange, pair, start, end):
+        candles = super().candles(exchange, pair, start, end)
+        if candles is not None and self.late.get((exchange, pair), 0) > 0 and end >= self.hold_from:
+            self.late[(exchange, pair)] -= 1
+            keep = candles['time'] < self.hold_from
+            candles = {column: values[keep] for column, values in candles.items()}
+        return candles
+
+
+def boundary_before(moment: datetime) -> datetime:
+    return datetime.fromtimestamp(int(moment.timestamp()) // 300 * 300, tz=timezone.utc)
+
+
+def test_clock_follow_ups_then_next_boundary(monkeypatch):
+    boundary = boundary_before(datetime.now(timezone.utc))
+    time = FakeTime(monkeypatch, boundary + timedelta(seconds=200))
+    clock = CandleClock(settle_delay=3.0, follow_up_delay=10.0, follow_ups=3, deadline=90.0)
+
+    async def scenario():
+        assert await clock.wait() is True
+        assert clock.boundary == boundary + INTERVAL
+        assert time.now == boundary + INTERVAL + timedelta(seconds=3)
+
+        frame = pd.DataFrame({'market': ['A'], 'candle_date_time_utc': [clock.target()]})
+        assert clock.update_late('binance', ['A', 'B'], frame) == ['B']
+        # Не больше follow_ups повторных тиков через follow_up_delay
+        for tick in range(2, 5):
+            assert await clock.wait() is False
+            assert clock.ticks == tick
+        assert time.slept[-3:] == [10.0, 10.0, 10.0]
+        # Поздний рынок так и не пришёл - следующий основной тик, late сброшен
+        assert await clock.wait() is True
+        assert clock.boundary == boundary + 2 * INTERVAL
+        assert clock.late == {} and clock.ticks == 1
+
+    asyncio.run(scenario())
+    assert clock.stats() == {'cycles': 2, 'missed_cycles': 0, 'late_markets': 1, 'pending_late': 0, 'tick': 1}
+
+
+def test_clock_deadline_cuts_follow_ups_and_counts_missed_cycles(monkeypatch):
+    boundary = boundary_before(datetime.now(timezone.utc))
+    time = FakeTime(monkeypatch, boundary + timedelta(seconds=200))
+    clock = CandleClock(settle_delay=3.0, follow_up_delay=10.0, follow_ups=3, deadline=25.0)
+
+    async def scenario():
+        await clock.wait()
+        empty = pd.DataFrame({'market': [], 'candle_date_time_utc': []})
+        clock.update_late('coinbase', ['A-USD'], empty)
+        # Дедлайн 25 с: после тика в +3 с остаётся время на повторы в +13 и +23 с, третьего нет
+        assert await clock.wait() is False
+        assert await clock.wait() is False
+        assert clock.remaining() < clock.follow_up_delay
+        assert await clock.wait() is True
+        assert clock.boundary == boundary + 2 * INTERVAL
+
+        # Цикл затянулся на две свечи: следующий тик - ближайшая граница, пропущенные считаются
+        time.now += 2 * INTERVAL
+        assert await clock.wait() is True
+        assert clock.boundary == boundary + 5 * INTERVAL
+        assert clock.missed_cycles == 2
+
+    asyncio.run(scenario())
+
+
+def _source(tmp_path, url, clock, coinbase_pairs, binance_pairs, start):
+    store = CandleStore(str(tmp_path / 'candles'))
+    fetchers = {
+        'coinbase': CoinbaseDataFetcher(target_pairs=coinbase_pairs, store=store, api_url=url),
+        'binance': BinanceDataFetcher(target_pairs=binance_pairs, store=store, api_url=url),
+    }
+    source = UpdateSource(fetchers, FetchPlanner(store), store, start, streaming=False)
+    source.clock = clock
+    return source
+
+
+def _store(source, batch):
+    for exchange, frame in batch.frames.items():
+        source.fetchers[exchange].store_frame(frame)
+
+
+def test_update_source_polls_late_markets_on_follow_up_ticks(monkeypatch, tmp_path):
+    boundary = boundary_before(datetime.now(timezone.utc))
+    FakeTime(monkeypatch, boundary + timedelta(seconds=200))
+    clock = CandleClock(settle_delay=3.0, follow_up_delay=10.0, follow_ups=3, deadline=90.0)
+    # Свеча, закрывающаяся на следующей границе, у SYN001/USDT появляется только со второго запроса
+    candles = LateCandles(boundary, {('binance', 'SYN001/USDT'): 1}, markets=3, gap_rate=0.0)
+    exchange = MockExchange(candles)
+
+    async def scenario():
+        url = await exchange.start()
+        source = _source(tmp_path, url, clock, ['SYN000-USD', 'SYN001-USD'], ['SYN000/USDT', 'SYN001/USDT'],
+                         boundary - timedelta(hours=1))
+        batch = await source()
+        assert clock.ticks == 1
+        assert clock.late == {'binance': ['SYN001/USDT']}
+        _store(source, batch)
+        requests = {name: counters['requests'] for name, counters in exchange.counters.items()}
+
+        # Повторный тик: один запрос хвоста по опоздавшему рынку, Coinbase не опрашивается
+        batch = await source()
+        assert clock.ticks == 2 and clock.late == {}
+        assert exchange.counters['coinbase']['requests'] == requests['coinbase']
+        assert exchange.counters['binance']['requests'] == requests['binance'] + 1
+        assert batch.frames['coinbase'].empty
+        assert set(batch.frames['binance']['market']) == {'SYN001/USDT'}
+        assert batch.frames['binance']['candle_date_time_utc'].max() == clock.target()
+        _store(source, batch)
+
+        # Поздних рынков нет - следующий основной тик с новой свечой по всем рынкам
+        batch = await source()
+        assert clock.ticks == 1 and clock.cycles == 2
+        assert clock.target() == pd.Timestamp(boundary + INTERVAL).tz_localize(None)
+        for frame in batch.frames.values():
+            assert set(frame.loc[frame['candle_date_time_utc'] == clock.target(), 'market']) == set(frame['market'])
+            assert frame['market'].nunique() == 2
+        await exchange.stop()
+
+    asyncio.run(scenario())
+
+
+def test_update_source_reschedules_ranges_after_cycle_deadline(monkeypatch, tmp_path):
+    boundary = boundary_before(datetime.now(timezone.utc))
+    FakeTime(monkeypatch, boundary + timedelta(seconds=200))
+    # До дедлайна после основного тика остаётся 0.3 с, сервер отвечает через 1 с
+    clock = CandleClock(settle_delay=3.0, follow_up_delay=10.0, follow_ups=3, deadline=3.3)
+    exchange = MockExchange(SyntheticCandles(markets=2, gap_rate=0.0), latency=1.0)
+    start = boundary - timedelta(hours=1)
+
+    async def scenario():
+        url = await exchange.start()
+        source = _source(tmp_path, url, clock, ['SYN000-USD'], ['SYN000/USDT'], start)
+        assert await source() is None
+        # Прерванные окна - в пропусках планировщика, рынки - поздние
+        for name, pair in (('coinbase', 'SYN000-USD'), ('binance', 'SYN000/USDT')):
+            assert source.planner.pending[(name, pair)]
+            assert clock.late[name] == [pair]
+        assert clock.remaining() < clock.follow_up_delay
+
+        # Повторных тиков после дедлайна нет: следующий основной тик догружает всё с начала
+        exchange.latency = 0.0
+        batch = await source()
+        assert clock.ticks == 1 and clock.cycles == 2 and clock.late == {}
+        for frame in batch.frames.values():
+            assert frame['candle_date_time_utc'].min() == pd.Timestamp(start).tz_localize(None)
+            assert frame['candle_date_time_utc'].max() == clock.target()
+        await exchange.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,77 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from candle_decoder import BINANCE_COLUMNS, COINBASE_COLUMNS, decode_binance, decode_coinbase
+
+START = int(datetime(2024, 3, 1, tzinfo=timezone.utc).timestamp())
+
+
+def per_row_coinbase(pair, candles):
+    """Разбор ответа Coinbase по строкам, как в фетчере до candle_decoder"""
+    rows = []
+    for candle in candles:
+        candle_time = datetime.fromtimestamp(candle[0], tz=timezone.utc)
+        rows.append({
+            "market": pair,
+            "candle_date_time_utc": candle_time.strftime('%Y-%m-%d %H:%M:%S'),
+            "opening_price": float(candle[3]),
+            "high_price": float(candle[2]),
+            "low_price": float(candle[1]),
+            "close_price": float(candle[4]),
+            "volume": float(candle[5]) * float(candle[4]),
+            "market_type": "spot"
+        })
+    return pd.DataFrame(rows)
+
+
+def per_row_binance(pair, candles):
+    """Разбор ответа Binance klines по строкам, как в фетчере до candle_decoder"""
+    rows = []
+    for candle in candles:
+        candle_time = datetime.fromtimestamp(candle[0] / 1000, tz=timezone.utc)
+        rows.append({
+            "market": pair,
+            "candle_date_time_utc": candle_time.strftime('%Y-%m-%d %H:%M:%S'),
+            "opening_price": float(candle[1]),
+            "high_price": float(candle[2]),
+            "low_price": float(candle[3]),
+            "close_price": float(candle[4]),
+            "volume": float(candle[5]),
+            "quote_volume": float(candle[7]),
+            "market_type": "spot"
+        })
+    return pd.DataFrame(rows)
+
+
+def assert_same_rows(decoded, expected, columns):
+    assert list(decoded.columns) == columns
+    assert decoded['candle_date_time_utc'].dtype == 'datetime64[ns]'
+    expected = expected.assign(candle_date_time_utc=pd.to_datetime(expected['candle_date_time_utc']))
+    pd.testing.assert_frame_equal(decoded, expected[columns], check_exact=True)
+
+
+def test_coinbase_matches_per_row_parsing():
+    rng = np.random.default_rng(0)
+    # Coinbase отдаёт свечи от новых к старым, числа - JSON float/int
+    candles = [[START + 300 * i, *np.round(rng.lognormal(0, 1, 4), 8).tolist(), float(rng.integers(0, 10**6)) / 7]
+               for i in reversed(range(500))]
+    candles[3][5] = 0
+    assert_same_rows(decode_coinbase('BTC-USD', candles), per_row_coinbase('BTC-USD', candles), COINBASE_COLUMNS)
+
+
+def test_binance_matches_per_row_parsing():
+    rng = np.random.default_rng(1)
+    # Цены и объёмы у Binance - строки
+    candles = [[(START + 300 * i) * 1000, *[f"{value:.8f}" for value in rng.lognormal(0, 1, 5)],
+                (START + 300 * i) * 1000 + 299_999, f"{rng.lognormal(5, 1):.8f}", 10, '0', '0', '0']
+               for i in range(500)]
+    assert_same_rows(decode_binance('BTC/USDT', candles), per_row_binance('BTC/USDT', candles), BINANCE_COLUMNS)
+
+
+def test_empty_payloads_keep_the_schema():
+    for decode, columns in ((decode_coinbase, COINBASE_COLUMNS), (decode_binance, BINANCE_COLUMNS)):
+        frame = decode('X', [])
+        assert frame.empty and list(frame.columns) == columns
+        assert frame['candle_date_time_utc'].dtype == 'datetime64[ns]'
@@ -0,0 +1,124 @@
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import SyntheticConfig, generate
+from candle_join import CandleJoin, candle_ranges
+from candle_store import CandleStore
+from data_combiner import DataCombiner
+
+
+@pytest.fixture(scope='module')
+def candles(tmp_path_factory):
+    paths = generate(SyntheticConfig(markets=2, days=4), str(tmp_path_factory.mktemp('synthetic')))
+    return {exchange: pd.read_csv(paths[exchange], parse_dates=['candle_date_time_utc'])
+            for exchange in ('coinbase', 'binance')}
+
+
+def split_hole(candles, start, end):
+    """Свечи SYN000 обеих бирж за [start, end] - дыра, остальное - уже в хранилище"""
+    stored, hole = {}, {}
+    for exchange, df in candles.items():
+        mask = (df['market'].str.startswith('SYN000') & (df['candle_date_time_utc'] >= start)
+                & (df['candle_date_time_utc'] <= end))
+        stored[exchange], hole[exchange] = df[~mask], df[mask]
+    return stored, hole
+
+
+def make_join(tmp_path, frames):
+    store = CandleStore(str(tmp_path / 'candles'))
+    for exchange, df in frames.items():
+        store.upsert(exchange, df)
+    return store, CandleJoin(store, CandleStore(str(tmp_path / 'joined')))
+
+
+def fill_hole(join, store, hole):
+    """Как сброс переполненного буфера: свечи пишутся в хранилище мимо update() и отмечаются в журнале"""
+    for exchange, df in hole.items():
+        store.upsert(exchange, df)
+        join.mark_unjoined(exchange, candle_ranges(df))
+
+
+def expected_series(tmp_path, candles, start, end):
+    store, join = make_join(tmp_path / 'expected', candles)
+    return join.load(start, end)
+
+
+def test_holes_older_than_the_window_are_rejoined(candles, tmp_path):
+    end = candles['coinbase']['candle_date_time_utc'].max()
+    start = candles['coinbase']['candle_date_time_utc'].min()
+    # Дыра на двое суток раньше конца - за окном объединения в памяти (1 день)
+    stored, hole = split_hole(candles, end - pd.Timedelta(days=2), end - pd.Timedelta(days=2) + pd.Timedelta(hours=2))
+    store, join = make_join(tmp_path, stored)
+    assert len(join.load(start, end)) == len(stored['coinbase'])
+
+    # В работе: следующий update() переобъединяет дыру из хранилища
+    fill_hole(join, store, hole)
+    assert join.stats()['unjoined_ranges'] == 2
+    rejoined = join.update(None, None)
+    assert len(rejoined) == len(hole['coinbase'])
+    assert join.stats()['unjoined_ranges'] == 0 and join.unjoined == {}
+
+    # После перезапуска: журнал лежит в объединённом хранилище, _catch_up берёт его диапазоны
+    stored, hole = split_hole(candles, end - pd.Timedelta(days=3), end - pd.Timedelta(days=3) + pd.Timedelta(hours=1))
+    fill_hole(join, store, hole)
+    restarted = CandleJoin(store, CandleStore(str(tmp_path / 'joined')))
+    assert restarted.stats()['unjoined_ranges'] == 2
+    expected = expected_series(tmp_path, candles, start, end)
+    pd.testing.assert_frame_equal(restarted.load(start, end), expected)
+    assert restarted.unjoined == {}
+
+
+def test_late_buckets_recompute_the_market(candles, tmp_path):
+    end = candles['coinbase']['candle_date_time_utc'].max()
+    start = candles['coinbase']['candle_date_time_utc'].min()
+    stored, hole = split_hole(candles, end - pd.Timedelta(days=2), end - pd.Timedelta(days=2) + pd.Timedelta(hours=3))
+    store, join = make_join(tmp_path, stored)
+    combiner = DataCombiner(join=join)
+    combiner.update_indicators(combiner.combine_from_store(store, start=start, end=end))
+
+    fill_hole(join, store, hole)
+    rows = combiner.combine_batch(pd.DataFrame(), pd.DataFrame())
+    assert set(rows['market']) == {'SYN000USDT'}
+    updated = combiner.update_indicators(rows)
+    # Пересчитан рынок с дырой - от строки перед ней до конца, другой рынок не тронут
+    assert set(updated['Coin']) == {'SYN000USDT'}
+    assert updated['DateTime'].max() == str(end)[:16]
+
+    expected = DataCombiner()._calculate_indicators(expected_series(tmp_path, candles, start, end))
+    pd.testing.assert_frame_equal(combiner.indicator_history(), expected.reset_index(drop=True))
+    assert combiner._latest_rows() == combiner._latest_rows(expected)
+
+
+def test_incremental_candles_with_a_late_one_match_the_full_calculation(candles, tmp_path):
+    start = candles['coinbase']['candle_date_time_utc'].min()
+    end = candles['coinbase']['candle_date_time_utc'].max()
+    times = sorted(candles['coinbase']['candle_date_time_utc'].unique())
+    cutoff, late_time = times[-8], times[-5]
+
+    def select(df, mask):
+        return df[mask(df)].sort_values(['market', 'candle_date_time_utc'])
+
+    def is_late(df):
+        return df['market'].str.startswith('SYN000') & (df['candle_date_time_utc'] == late_time)
+
+    stored = {exchange: select(df, lambda d: d['candle_date_time_utc'] < cutoff) for exchange, df in candles.items()}
+    store, join = make_join(tmp_path, stored)
+    combiner = DataCombiner(join=join)
+    combiner.update_indicators(combiner.combine_from_store(store, start=start, end=cutoff))
+
+    # Новые свечи по одной корзине; свеча SYN000 за late_time приходит последней
+    for time in times[times.index(cutoff):]:
+        frames = {exchange: select(df, lambda d: (d['candle_date_time_utc'] == time) & ~is_late(d))
+                  for exchange, df in candles.items()}
+        for exchange, df in frames.items():
+            store.upsert(exchange, df)
+        combiner.update_indicators(combiner.combine_batch(frames['coinbase'], frames['binance']))
+    late = {exchange: select(df, is_late) for exchange, df in candles.items()}
+    for exchange, df in late.items():
+        store.upsert(exchange, df)
+    updated = combiner.update_indicators(combiner.combine_batch(late['coinbase'], late['binance']))
+    assert set(updated['Coin']) == {'SYN000USDT'}
+
+    expected = DataCombiner()._calculate_indicators(expected_series(tmp_path, candles, start, end))
+    pd.testing.assert_frame_equal(combiner.indicator_history(), expected.reset_index(drop=True))
+    assert combiner._latest_rows() == combiner._latest_rows(expected)
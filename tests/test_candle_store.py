@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from candle_decoder import decode_binance
+from candle_store import CandleStore
+
+
+def klines(start, periods, price=1.0):
+    """Ответ Binance klines: 5m свечи с start"""
+    times = pd.date_range(start, periods=periods, freq='5min', tz='UTC')
+    return [[t.value // 10**6, str(price), str(price + 1), str(price - 1), str(price + i), '2.5',
+             t.value // 10**6 + 299_999, '10.0'] for i, t in enumerate(times)]
+
+
+def test_upsert_read_round_trip(tmp_path):
+    store = CandleStore(str(tmp_path))
+    # Двое суток: свечи раскладываются по дневным партициям
+    df = decode_binance('BTC/USDT', klines('2024-01-01 22:00', 48))
+    assert store.upsert('binance', df) == 2
+    assert store.partitions('binance', 'BTC/USDT') == ['2024-01-01', '2024-01-02']
+    assert store.markets('binance') == ['BTC/USDT']
+
+    read = store.read('binance', start='2024-01-01', end='2024-01-03')
+    pd.testing.assert_frame_equal(read, df.reset_index(drop=True), check_like=True)
+
+    window = store.read('binance', start='2024-01-02 00:00', end='2024-01-02 00:30')
+    assert len(window) == 7 and window['candle_date_time_utc'].min() == pd.Timestamp('2024-01-02')
+
+    # Повтор тех же свечей не переписывает файлы; изменённая свеча - только свою партицию
+    mtimes = {day: os.path.getmtime(os.path.join(tmp_path, 'binance', 'BTC%2FUSDT', f'{day}.parquet'))
+              for day in ('2024-01-01', '2024-01-02')}
+    assert store.upsert('binance', df) == 0
+    changed = df.tail(1).copy()
+    changed['close_price'] = 123.0
+    assert store.upsert('binance', changed) == 1
+    assert store.read('binance')['close_price'].iloc[-1] == 123.0
+    assert len(store.read('binance')) == 48
+    assert os.path.getmtime(os.path.join(tmp_path, 'binance', 'BTC%2FUSDT', '2024-01-01.parquet')) == \
+        mtimes['2024-01-01']
+
+
+def test_high_water_mark(tmp_path):
+    store = CandleStore(str(tmp_path))
+    assert store.last_timestamp('binance', 'BTC/USDT') is None
+    store.upsert('binance', decode_binance('BTC/USDT', klines('2024-01-01 00:00', 12)))
+    assert store.last_timestamp('binance', 'BTC/USDT') == pd.Timestamp('2024-01-01 00:55', tz='UTC')
+
+    # Новые свечи двигают отметку, опоздавшие старые - нет
+    store.upsert('binance', decode_binance('BTC/USDT', klines('2024-01-02 10:00', 3)))
+    assert store.last_timestamp('binance', 'BTC/USDT') == pd.Timestamp('2024-01-02 10:10', tz='UTC')
+    store.upsert('binance', decode_binance('BTC/USDT', klines('2023-12-31 12:00', 1)))
+    assert store.last_timestamp('binance', 'BTC/USDT') == pd.Timestamp('2024-01-02 10:10', tz='UTC')
+
+    # Новый экземпляр восстанавливает отметку по последней партиции
+    assert CandleStore(str(tmp_path)).last_timestamp('binance', 'BTC/USDT') == \
+        pd.Timestamp('2024-01-02 10:10', tz='UTC')
+    assert np.array_equal(store.timestamps('binance', 'BTC/USDT', start='2024-01-02').asi8,
+                          pd.date_range('2024-01-02 10:00', periods=3, freq='5min', tz='UTC').asi8)
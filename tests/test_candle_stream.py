@@ -0,0 +1,134 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+from benchmarks.mock_stream import MockStreamServer, binance_kline, coinbase_match
+from candle_stream import BinanceKlineStream, CandleStream, CoinbaseMatchStream
+from get_data_binance import BinanceDataFetcher
+from get_data_coinbase import CoinbaseDataFetcher
+
+INTERVAL = timedelta(minutes=5)
+
+
+async def wait_until(condition, timeout: float = 5.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("condition not reached before timeout")
+        await asyncio.sleep(0.01)
+
+
+def current_bucket() -> datetime:
+    now = int(datetime.now(timezone.utc).timestamp())
+    return datetime.fromtimestamp(now // 300 * 300, tz=timezone.utc)
+
+
+def test_candle_stream_is_abstract():
+    with pytest.raises(TypeError):
+        CandleStream(None, 'ws://localhost')
+
+
+def test_binance_kline_stream_parses_closed_klines_and_resubscribes():
+    async def scenario():
+        server = MockStreamServer()
+        await server.start()
+        fetcher = BinanceDataFetcher(['BTC/USDT', 'ETH/USDT'])
+        stream = BinanceKlineStream(fetcher, url=server.stream_url('binance'), reconnect_delay=0.05)
+        task = asyncio.create_task(stream.run())
+        try:
+            await server.wait_subscribed('binance', 1)
+            assert server.subscriptions['binance'][0] == {
+                'method': 'SUBSCRIBE', 'params': ['btcusdt@kline_5m', 'ethusdt@kline_5m'], 'id': 1}
+
+            start = current_bucket() - 3 * INTERVAL
+            # Незакрытая свеча (x = false) не отдаётся
+            await server.publish('binance', binance_kline('BTC/USDT', start, 100, 110, 95, 105, 2.0, closed=False))
+            await server.publish('binance', {'stream': 'btcusdt@kline_5m',
+                                             'data': binance_kline('BTC/USDT', start, 100, 112, 94, 106, 3.0)})
+            await wait_until(lambda: stream.candles == 1)
+            candles = fetcher.buffer.drain()
+            assert len(candles) == 1
+            row = candles.iloc[0]
+            assert row['market'] == 'BTC/USDT'
+            assert row['candle_date_time_utc'] == pd.Timestamp(start).tz_localize(None)
+            assert (row['opening_price'], row['high_price'], row['low_price'], row['close_price']) == (100, 112, 94, 106)
+            assert row['volume'] == 3.0 and row['quote_volume'] == 318.0
+
+            # Пропущенные события между закрытыми свечами уходят в REST-догрузку
+            await server.publish('binance', binance_kline('BTC/USDT', start + 2 * INTERVAL, 106, 107, 105, 107, 1.0))
+            await wait_until(lambda: stream.candles == 2)
+            assert fetcher.failed_ranges == [('BTC/USDT', start + INTERVAL, start + 2 * INTERVAL)]
+
+            # Обрыв со стороны сервера: переподключение и та же подписка
+            await server.drop('binance')
+            await server.wait_subscribed('binance', 2)
+            assert stream.connects == 2 and server.connects['binance'] == 2
+            assert server.subscriptions['binance'][1]['params'] == server.subscriptions['binance'][0]['params']
+            assert server.subscriptions['binance'][1]['id'] == 2
+
+            await server.publish('binance', binance_kline('ETH/USDT', start + 2 * INTERVAL, 10, 11, 9, 10.5, 4.0))
+            await wait_until(lambda: stream.candles == 3)
+            assert list(fetcher.buffer.drain()['market']) == ['BTC/USDT', 'ETH/USDT']
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.stop()
+
+    asyncio.run(scenario())
+
+
+def test_coinbase_match_stream_builds_candles_and_resubscribes():
+    async def scenario():
+        server = MockStreamServer()
+        await server.start()
+        fetcher = CoinbaseDataFetcher(['BTC-USD'])
+        stream = CoinbaseMatchStream(fetcher, url=server.stream_url('coinbase'), reconnect_delay=0.05)
+        task = asyncio.create_task(stream.run())
+        try:
+            await server.wait_subscribed('coinbase', 1)
+            assert server.subscriptions['coinbase'][0] == {
+                'type': 'subscribe', 'product_ids': ['BTC-USD'], 'channels': ['matches']}
+            await wait_until(lambda: stream.connected_at is not None)
+
+            # Сделки свечи, начавшейся до подключения, не используются (свеча неполная)
+            partial = current_bucket()
+            await server.publish('coinbase', coinbase_match('BTC-USD', 1.0, 100.0, partial + timedelta(seconds=1)))
+
+            # Первая полная свеча - следующий интервал; её закрывает первая сделка интервала после неё
+            start = partial + INTERVAL
+            trades = [(100.0, 1.0, 10), (110.0, 2.0, 60), (95.0, 0.5, 120), (98.0, 0.5, 200)]
+            for trade_id, (price, size, offset) in enumerate(trades):
+                await server.publish('coinbase', coinbase_match('BTC-USD', price, size,
+                                                                start + timedelta(seconds=offset), trade_id))
+            await server.publish('coinbase', coinbase_match('BTC-USD', 105.0, 1.0, start + INTERVAL, 10))
+            await wait_until(lambda: stream.candles == 1)
+
+            candles = fetcher.buffer.drain()
+            assert len(candles) == 1
+            row = candles.iloc[0]
+            assert row['market'] == 'BTC-USD'
+            assert row['candle_date_time_utc'] == pd.Timestamp(start).tz_localize(None)
+            assert (row['opening_price'], row['high_price'], row['low_price'], row['close_price']) == (100, 110, 95, 98)
+            # volume в котируемой валюте, как у REST: объём * close
+            assert row['volume'] == pytest.approx(4.0 * 98.0)
+
+            await server.drop('coinbase')
+            await server.wait_subscribed('coinbase', 2)
+            assert stream.connects == 2 and server.connects['coinbase'] == 2
+            assert server.subscriptions['coinbase'][1] == server.subscriptions['coinbase'][0]
+            # Свеча, начатая до обрыва, сброшена вместе с соединением
+            assert stream.buckets == {}
+
+            later = start + 2 * INTERVAL
+            await server.publish('coinbase', coinbase_match('BTC-USD', 120.0, 1.0, later, 20))
+            await server.publish('coinbase', coinbase_match('BTC-USD', 121.0, 1.0, later + INTERVAL, 21))
+            await wait_until(lambda: stream.candles == 2)
+            assert fetcher.buffer.drain().iloc[0]['close_price'] == 120.0
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await server.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,65 @@
+import glob
+import os
+
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import SyntheticConfig, generate
+from data_combiner import DataCombiner
+
+
+@pytest.fixture(scope='module')
+def combined(tmp_path_factory):
+    paths = generate(SyntheticConfig(markets=3, days=3), str(tmp_path_factory.mktemp('synthetic')))
+    return DataCombiner().combine_data(paths['coinbase'], paths['binance'])
+
+
+def test_update_indicators_returns_only_recalculated_rows(combined):
+    combiner = DataCombiner()
+    tail = combined.groupby('market').tail(4)
+    first = combiner.update_indicators(combined.drop(tail.index))
+    assert len(first) == len(combined) - len(tail)
+
+    for _, candles in tail.groupby('timestamp_coinbase'):
+        updated = combiner.update_indicators(candles)
+        # Новая свеча и пересчитанная предыдущая строка по каждому рынку
+        assert len(updated) == 2 * combined['market'].nunique()
+    assert len(combiner.indicator_chunks) == 1 + tail['timestamp_coinbase'].nunique()
+
+    expected = DataCombiner()._calculate_indicators(combined).reset_index(drop=True)
+    pd.testing.assert_frame_equal(combiner.indicator_history(), expected)
+
+
+def test_latest_rows_come_from_the_engine(combined):
+    combiner = DataCombiner()
+    tail = combined.groupby('market').tail(3)
+    combiner.update_indicators(combined.drop(tail.index))
+    assert combiner._latest_rows() == combiner._latest_rows(combiner.indicator_history())
+
+    for _, candles in tail.groupby('timestamp_coinbase'):
+        combiner.update_indicators(candles)
+        # Снимок из IndicatorEngine.latest совпадает с проходом по всей таблице
+        assert combiner._latest_rows() == combiner._latest_rows(combiner.indicator_history())
+    assert len(combiner._latest_rows()) == combined['market'].nunique()
+
+
+def test_indicator_rows_are_appended_by_day(combined, tmp_path):
+    combiner = DataCombiner()
+    directory = str(tmp_path / 'combined_data')
+    tail = combined.groupby('market').tail(3)
+    first = combiner.update_indicators(combined.drop(tail.index))
+    assert combiner.save_indicator_rows(directory, first, append=False) == first['DateTime'].str[:10].nunique()
+    sizes = {path: os.path.getsize(path) for path in glob.glob(os.path.join(directory, '*.csv'))}
+
+    for _, candles in tail.groupby('timestamp_coinbase'):
+        # Только последний день получает новые строки, остальные файлы не переписываются
+        assert combiner.save_indicator_rows(directory, combiner.update_indicators(candles)) == 1
+    changed = [path for path, size in sizes.items() if os.path.getsize(path) != size]
+    assert len(changed) == 1
+
+    saved = pd.concat([pd.read_csv(path, dtype=str) for path in sorted(glob.glob(os.path.join(directory, '*.csv')))],
+                      ignore_index=True)
+    saved = saved.drop_duplicates(subset=['Coin', 'DateTime'], keep='last').reset_index(drop=True)
+    expected = combiner.indicator_history()
+    assert saved[['DateTime', 'Coin']].equals(expected[['DateTime', 'Coin']])
+    assert list(saved['Avg 1H Volume']) == list(expected['Avg 1H Volume'])
@@ -0,0 +1,46 @@
+from datetime import datetime, timedelta, timezone
+
+from candle_decoder import decode_coinbase
+from candle_store import CandleStore
+from fetch_planner import FetchPlanner, empty_ranges
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+FIVE_MINUTES = timedelta(minutes=5)
+
+
+def payload(times):
+    """Ответ Coinbase /candles: [time, low, high, open, close, volume]"""
+    return [[int(t.timestamp()), 1.0, 1.0, 1.0, 1.0, 1.0] for t in times]
+
+
+def test_empty_ranges_of_a_window():
+    times = [START + i * FIVE_MINUTES for i in (0, 1, 4, 5, 9)]
+    now = START + timedelta(days=1)
+    ranges = empty_ranges('BTC-USD', START, START + 12 * FIVE_MINUTES, [row[0] for row in payload(times)], now=now)
+    assert ranges == [('BTC-USD', START + 2 * FIVE_MINUTES, START + 4 * FIVE_MINUTES),
+                      ('BTC-USD', START + 6 * FIVE_MINUTES, START + 9 * FIVE_MINUTES),
+                      ('BTC-USD', START + 10 * FIVE_MINUTES, START + 12 * FIVE_MINUTES)]
+
+    # Свечи моложе EMPTY_SETTLE могли ещё не появиться - пустыми не считаются
+    now = START + 12 * FIVE_MINUTES
+    assert empty_ranges('BTC-USD', START, now, [], now=now) == [('BTC-USD', START, now - timedelta(minutes=15))]
+
+
+def test_known_empty_ranges_are_not_refetched_after_restart(tmp_path):
+    store = CandleStore(str(tmp_path / 'candles'))
+    times = [START + i * FIVE_MINUTES for i in range(48) if not 10 <= i < 14 and not 30 <= i < 33]
+    store.upsert('coinbase', decode_coinbase('BTC-USD', payload(times)))
+    end = START + 48 * FIVE_MINUTES
+
+    planner = FetchPlanner(store)
+    plan = planner.plan('coinbase', ['BTC-USD'], START, end, include_tail=False)
+    assert plan == {'BTC-USD': [(START + 10 * FIVE_MINUTES, START + 14 * FIVE_MINUTES),
+                                (START + 30 * FIVE_MINUTES, START + 33 * FIVE_MINUTES)]}
+
+    # Первую дыру биржа вернула пустой: свечей без сделок нет
+    planner.mark_empty('coinbase', [('BTC-USD', START + 10 * FIVE_MINUTES, START + 14 * FIVE_MINUTES)])
+
+    restarted = FetchPlanner(store)
+    plan = restarted.plan('coinbase', ['BTC-USD'], START, end, include_tail=False)
+    assert plan == {'BTC-USD': [(START + 30 * FIVE_MINUTES, START + 33 * FIVE_MINUTES)]}
+    assert restarted.plan('binance', ['BTC-USD'], START, end, include_tail=False) == {}
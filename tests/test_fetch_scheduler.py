@@ -0,0 +1,48 @@
+import asyncio
+
+from fetch_scheduler import FetchScheduler
+
+
+def test_slow_job_does_not_block_other_workers():
+    async def scenario():
+        done = []
+        slow = asyncio.Event()
+
+        async def handler(session, pair, start, end):
+            if pair == 'SLOW':
+                await slow.wait()
+            elif pair == 'BAD':
+                raise RuntimeError('boom')
+            done.append((pair, start))
+            # Все быстрые задания выполнены, пока медленное ещё ждёт
+            if len(done) == 8:
+                slow.set()
+
+        jobs = [(None, 'SLOW', 0, 1), (None, 'BAD', 0, 1)] + [(None, f'P{i}', w, w + 1)
+                                                              for i in range(4) for w in range(2)]
+        scheduler = FetchScheduler('test', workers=3)
+        progress = await asyncio.wait_for(scheduler.run(jobs, handler), timeout=5)
+        assert done[-1] == ('SLOW', 0) and len(done) == 9
+        assert progress['total'] == progress['completed'] == 10 and progress['failed'] == 1
+        assert progress['eta_seconds'] == 0.0
+
+        assert (await scheduler.run([], handler))['total'] == 0
+
+    asyncio.run(scenario())
+
+
+def test_workers_run_jobs_concurrently():
+    async def scenario():
+        running, peak = 0, 0
+
+        async def handler(session, pair, start, end):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await FetchScheduler('test', workers=4).run([(None, f'P{i}', 0, 1) for i in range(12)], handler)
+        assert peak == 4
+
+    asyncio.run(scenario())
@@ -0,0 +1,25 @@
+import numpy as np
+
+from indicator_engine import SortedWindow
+
+
+def test_sorted_window_median_matches_numpy():
+    rng = np.random.default_rng(3)
+    values = rng.normal(0, 1, 3000).round(2)  # с повторами
+    values[::17] = np.nan
+    # Маленькие блоки - чтобы блоки делились и исчезали
+    window = SortedWindow(block_size=8)
+    window.load(values[:100])
+    for i in range(100, len(values)):
+        window.insert(values[i])
+        window.remove(values[i - 100])
+        expected = np.nanmedian(values[i - 99:i + 1])
+        assert len(window) == np.count_nonzero(~np.isnan(values[i - 99:i + 1]))
+        assert window.median() == expected
+
+    empty = SortedWindow()
+    empty.load(np.array([np.nan]))
+    assert np.isnan(empty.median())
+    empty.insert(2.0)
+    empty.insert(1.0)
+    assert empty.median() == 1.5
@@ -0,0 +1,54 @@
+import asyncio
+
+import pandas as pd
+
+from ingest_pipeline import IngestBatch, IngestPipeline, PipelineStage
+
+
+def test_failed_stage_is_retried_then_handed_to_on_error():
+    async def scenario():
+        items = iter(range(1, 4))
+        failures = {1: 2, 2: 5}  # элемент -> сколько раз стадия падает на нём
+        calls, pushed, failed = [], [], []
+
+        async def source():
+            try:
+                return next(items)
+            except StopIteration:
+                await asyncio.Event().wait()
+
+        def compute(item):
+            calls.append(item)
+            if failures.get(item, 0) > 0:
+                failures[item] -= 1
+                raise RuntimeError(f"compute failed on {item}")
+            return item
+
+        async def push(item):
+            pushed.append(item)
+
+        compute_stage = PipelineStage('compute', compute, retries=2, retry_delay=0.0, on_error=failed.append)
+        pipeline = IngestPipeline(source, [compute_stage, PipelineStage('push', push)])
+        task = asyncio.create_task(pipeline.run())
+        await compute_stage.wait_processed(3)
+        while len(pushed) < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+        # 1 - обработан со второго повтора, 2 - три попытки и on_error, 3 - с первой
+        assert calls == [1, 1, 1, 2, 2, 2, 3]
+        assert pushed == [1, 3] and failed == [2]
+        assert compute_stage.stats()['errors'] == 5 and compute_stage.stats()['retried'] == 4
+
+    asyncio.run(scenario())
+
+
+def test_merge_earlier_prepends_unprocessed_candles():
+    earlier = IngestBatch({'coinbase': pd.DataFrame({'market': ['A'], 'close_price': [1.0]})}, 10, 20, 0.0)
+    batch = IngestBatch({'coinbase': pd.DataFrame({'market': ['A'], 'close_price': [2.0]}),
+                         'binance': pd.DataFrame({'market': ['A'], 'close_price': [3.0]})}, 20, 30, 1.0)
+    batch.merge_earlier(earlier)
+    assert list(batch.frames['coinbase']['close_price']) == [1.0, 2.0]
+    assert len(batch.frames['binance']) == 1
+    assert batch.combine_start == 10 and batch.end == 30
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import premium_history
+from premium_history import SERIES_COLUMNS, PremiumHistoryStore, lttb_indices, minmax_indices
+from rollup import ROLLUP_TIERS, bucket_means, bucket_sums
+
+
+def reference_lttb(x, y, points):
+    """LTTB по исходному описанию (Steinarsson, 2013): цикл по корзинам, средние считаются заново"""
+    n = len(y)
+    bounds = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = [0]
+    for i in range(points - 2):
+        start, stop = bounds[i], bounds[i + 1]
+        if i + 2 < len(bounds):
+            next_x = np.mean(x[bounds[i + 1]:bounds[i + 2]])
+            next_y = np.mean(y[bounds[i + 1]:bounds[i + 2]])
+        else:
+            next_x, next_y = x[n - 1], y[n - 1]
+        a = selected[-1]
+        best, best_area = start, -1.0
+        for j in range(start, stop):
+            area = abs((x[a] - next_x) * (y[j] - y[a]) - (x[a] - x[j]) * (next_y - y[a]))
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+    selected.append(n - 1)
+    return np.array(selected)
+
+
+@pytest.mark.parametrize('n,points', [(10, 6), (1000, 100), (5000, 37), (288 * 30, 1000)])
+def test_lttb_matches_reference(n, points):
+    rng = np.random.default_rng(n)
+    # Время в наносекундах, как у ряда истории: ошибка в среднем по x здесь заметнее всего
+    x = pd.Timestamp('2024-01-01').value + np.arange(n, dtype=np.int64) * 300 * 10**9
+    y = np.cumsum(rng.normal(0, 1, n))
+    indices = lttb_indices(x, y, points)
+    assert len(indices) == points
+    assert indices[0] == 0 and indices[-1] == n - 1
+    assert np.all(np.diff(indices) > 0)
+    assert np.array_equal(indices, reference_lttb(x.astype(np.float64), y, points))
+
+
+def test_lttb_last_bucket_average_excludes_the_endpoint():
+    # Выбор в предпоследней корзине зависит от среднего последней внутренней корзины (без конечной точки)
+    x = np.arange(10, dtype=np.float64)
+    y = np.array([0, 0, 0, 0, 0, 0, 0, 5, 1, 0], dtype=np.float64)
+    assert np.array_equal(lttb_indices(x, y, 6), reference_lttb(x, y, 6))
+
+
+def test_lttb_short_series():
+    x = np.arange(5)
+    assert np.array_equal(lttb_indices(x, x.astype(float), 10), np.arange(5))
+    assert np.array_equal(lttb_indices(x, x.astype(float), 2), [0, 4])
+
+
+def test_minmax_keeps_extremes_of_every_interval():
+    y = np.cumsum(np.random.default_rng(1).normal(0, 1, 1003))
+    points = 100
+    indices = minmax_indices(y, points)
+    assert len(indices) <= points
+    assert np.all(np.diff(indices) > 0)
+    assert np.argmin(y) in indices and np.argmax(y) in indices
+    edges = np.linspace(0, len(y), points // 2 + 1).astype(np.int64)
+    for start, stop in zip(edges[:-1], edges[1:]):
+        assert start + np.argmin(y[start:stop]) in indices
+        assert start + np.argmax(y[start:stop]) in indices
+
+
+def combined_rows(coin, start, periods):
+    times = pd.date_range(start, periods=periods, freq='5min', tz='UTC')
+    rng = np.random.default_rng(7)
+    binance = 100 + np.cumsum(rng.normal(0, 0.1, periods))
+    return pd.DataFrame({
+        'market': coin,
+        'timestamp_coinbase': times,
+        'close_price_coinbase': binance * (1 + rng.normal(0.001, 0.0005, periods)),
+        'close_price_binance': binance,
+        'volume_coinbase': rng.lognormal(3, 1, periods),
+        'volume_binance': rng.lognormal(4, 1, periods),
+    })
+
+
+def test_api_history_downsamples(tmp_path, monkeypatch):
+    import web_server
+
+    store = PremiumHistoryStore(str(tmp_path / 'history'))
+    store.upsert(combined_rows('BTCUSDT', '2024-01-01', 288 * 3))
+    monkeypatch.setattr(web_server, 'history', store)
+    client = web_server.app.test_client()
+
+    response = client.get('/api/history?coin=BTCUSDT&from=2024-01-01&to=2024-01-02&points=50&method=lttb')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['tier'] == '5m' and body['total'] == 289 and body['points'] == 50
+    times = body['series']['time']
+    assert times[0] == pd.Timestamp('2024-01-01', tz='UTC').value // 10**6
+    assert times[-1] == pd.Timestamp('2024-01-02', tz='UTC').value // 10**6
+    assert all(a < b for a, b in zip(times, times[1:]))
+    assert set(body['series']) == {'time', 'premium_pct', 'price_coinbase', 'price_binance',
+                                   'volume_coinbase', 'volume_binance'}
+
+    response = client.get('/api/history?coin=BTCUSDT&points=50&method=minmax')
+    assert response.status_code == 200 and response.get_json()['points'] <= 50
+
+    assert client.get('/api/history?coin=ETHUSDT').status_code == 404
+    assert client.get('/api/history?coin=BTCUSDT&method=mean').status_code == 400
+    assert client.get('/api/history').status_code == 400
+
+
+def test_tiers_are_rebuilt_only_for_changed_partitions(tmp_path, monkeypatch):
+    store = PremiumHistoryStore(str(tmp_path / 'history'))
+    rows = combined_rows('BTCUSDT', '2024-01-20', 288 * 20)
+    store.upsert(rows[rows['timestamp_coinbase'] < '2024-02-03'])
+    store.query('BTCUSDT')
+
+    rebuilt = []
+    original = premium_history._partition_tiers
+    monkeypatch.setattr(premium_history, '_partition_tiers', lambda part: rebuilt.append(part) or original(part))
+    store.upsert(rows[rows['timestamp_coinbase'] >= '2024-02-03'])
+    store.query('BTCUSDT')
+    # Январь не менялся - его корзины не пересчитываются
+    assert len(rebuilt) == 1 and rebuilt[0]['timestamp'].min() == pd.Timestamp('2024-02-01', tz='UTC')
+
+    # Уровни (1d - из сумм 1h) совпадают с корзинами, посчитанными по всем 5-минутным строкам
+    series = store._series['BTCUSDT']
+    for name, resolution in ROLLUP_TIERS.items():
+        expected = bucket_means(bucket_sums(series['time'], {col: series[col] for col in SERIES_COLUMNS},
+                                            resolution))
+        tier = store._tiers['BTCUSDT'][name]
+        assert np.array_equal(tier['time'], expected['time'])
+        for col in SERIES_COLUMNS:
+            np.testing.assert_allclose(tier[col], expected[col], rtol=1e-12)
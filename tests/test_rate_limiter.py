@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+import rate_limiter
+from rate_limiter import TokenBucket, binance_rate_limiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock)
+    return clock
+
+
+def test_penalize_halves_the_rate_and_reward_recovers_it(clock):
+    bucket = TokenBucket(rate=10, capacity=10, min_rate_factor=0.1, recovery_step=0.05)
+    bucket.penalize(retry_after=30)
+    assert bucket.rate == 5 and bucket.tokens <= 0
+    # Пауза по Retry-After входит в ожидание следующего запроса
+    assert bucket.reserve() == pytest.approx(30)
+
+    for _ in range(10):
+        bucket.penalize()
+    assert bucket.rate == 1  # не ниже min_rate_factor * rate
+
+    for _ in range(5):
+        bucket.reward()
+    assert bucket.rate == pytest.approx(1 + 5 * 0.5)
+    for _ in range(100):
+        bucket.reward()
+    assert bucket.rate == 10
+
+
+def test_reserve_queues_concurrent_requests(clock):
+    bucket = TokenBucket(rate=2, capacity=2)
+    waits = [bucket.reserve() for _ in range(4)]
+    assert waits == [0, 0, pytest.approx(0.5), pytest.approx(1.0)]
+    clock.now += 1.0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_binance_weight_header_syncs_tokens(clock, monkeypatch):
+    limiter = binance_rate_limiter(weight_limit_per_minute=6000, safety_margin=0.9)
+    assert limiter.bucket.tokens == 5400
+    limiter.update(200, {'x-mbx-used-weight-1m': '5000'})
+    # Биржа посчитала больше, чем мы: токены урезаются до её остатка
+    assert limiter.bucket.tokens == pytest.approx(400)
+    limiter.update(200, {'X-MBX-USED-WEIGHT-1M': '10'})
+    assert limiter.bucket.tokens == pytest.approx(400)
+
+    limiter.update(429, {'Retry-After': '2'})
+    assert limiter.stats()['throttled'] == 1 and limiter.bucket.rate == pytest.approx(45)
+    slept = []
+
+    async def fake_sleep(seconds):
+        slept.append(seconds)
+        clock.now += seconds
+
+    monkeypatch.setattr(rate_limiter.asyncio, 'sleep', fake_sleep)
+    asyncio.run(limiter.acquire(cost=2))
+    # Запрос после 429 ждёт Retry-After
+    assert sum(slept) >= 2
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import SyntheticConfig, generate
+from data_combiner import DataCombiner
+from indicator_engine import ROLLING_INTERVALS
+from rollup import BucketSketch, plan_windows
+
+RANK_ERROR = 0.05
+
+
+@pytest.fixture(scope='module')
+def combined(tmp_path_factory):
+    # Больше года свечей: у 1Y есть строки с полным окном
+    paths = generate(SyntheticConfig(markets=2, days=400), str(tmp_path_factory.mktemp('synthetic')))
+    return DataCombiner().combine_data(paths['coinbase'], paths['binance'])
+
+
+def test_indicators_are_exact_by_default():
+    assert all(plan is None for plan in DataCombiner().window_plans.values())
+    assert all(plan is None for plan in plan_windows(ROLLING_INTERVALS).values())
+
+
+def test_plans_fit_the_requested_rank_error():
+    for rank_error in (0.005, 0.01, RANK_ERROR):
+        for label, plan in plan_windows(ROLLING_INTERVALS, rank_error).items():
+            if plan is not None:
+                assert plan.rank_error <= rank_error
+                assert plan.sketch.candles % plan.sketch.step == 0 and plan.sketch.step > 1
+    assert plan_windows(ROLLING_INTERVALS, 0.01)['1Y'] is not None
+    with pytest.raises(ValueError):
+        plan_windows(ROLLING_INTERVALS, 0.5)
+
+
+def test_sketch_points_have_equal_weight():
+    sketch = BucketSketch(pd.Timedelta('1D').value, 0.01)
+    values = np.random.default_rng(0).lognormal(3, 1, sketch.candles)
+    points = np.sort(sketch.summarize(values))
+    assert len(points) == sketch.slots
+    # Каждая точка - середина своей группы из step значений
+    ranks = np.searchsorted(np.sort(values), points)
+    assert np.array_equal(ranks, np.arange(sketch.slots) * sketch.step + (sketch.step - 1) // 2)
+
+
+def test_approximate_medians_stay_within_rank_error(combined):
+    combiner = DataCombiner(rank_error=RANK_ERROR)
+    approximated = {label for label, plan in combiner.window_plans.items() if plan is not None}
+    assert approximated == {'1M', '1Y'}
+
+    report = combiner.compare_with_exact(combined, sample=500)
+    assert set(report) == {f'Avg {label} {kind}' for label in approximated for kind in ('Premium %', 'Volume')}
+    for column, stats in report.items():
+        assert stats['rows_checked'] > 0, column
+        assert stats['max_rank_error'] <= stats['rank_error_bound'] <= RANK_ERROR, (column, stats)
+
+
+def test_incremental_latest_rows_match_full_calculation(combined):
+    combiner = DataCombiner(rank_error=RANK_ERROR)
+    full = combiner._calculate_indicators(combined, raw=True)
+
+    # Последние полчаса каждого рынка приходят по одной свече через IndicatorEngine
+    tail = combined.groupby('market').tail(6)
+    engine = combiner.indicator_engine
+    engine.prime(combined.drop(tail.index))
+    for _, candles in tail.groupby('timestamp_coinbase'):
+        updated = engine.update(candles)
+
+    columns = [column for column in full.columns if column.startswith('Avg ')]
+    expected = full.groupby('Coin').tail(1).set_index('Coin')[columns]
+    actual = updated.groupby('Coin').tail(1).set_index('Coin')[columns]
+    pd.testing.assert_frame_equal(actual.astype(float), expected.astype(float), check_exact=False)
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+import symbol_cache
+from symbol_cache import SymbolCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(symbol_cache.time, 'monotonic', clock)
+    return clock
+
+
+def test_symbol_list_is_reloaded_only_after_ttl(clock):
+    cache = SymbolCache('coinbase', ttl=60)
+    listings = [['BTC-USD', 'ETH-USD'], None, ['BTC-USD']]
+    calls = []
+
+    async def loader():
+        calls.append(clock.now)
+        return listings[len(calls) - 1]
+
+    assert asyncio.run(cache.get(loader)) == {'BTC-USD', 'ETH-USD'}
+    clock.now += 59
+    asyncio.run(cache.get(loader))
+    assert len(calls) == 1
+
+    # Ошибка загрузки после TTL - остаётся прежний список
+    clock.now += 1
+    assert asyncio.run(cache.get(loader)) == {'BTC-USD', 'ETH-USD'}
+    assert asyncio.run(cache.get(loader)) == {'BTC-USD'}
+    assert len(calls) == 3 and cache.stats()['refreshes'] == 2
+
+
+def test_unavailable_pairs_expire_after_negative_ttl(clock):
+    cache = SymbolCache('binance', ttl=60, negative_ttl=600)
+
+    async def loader():
+        return ['BTC/USDT']
+
+    asyncio.run(cache.get(loader))
+    assert cache.filter(['BTC/USDT', 'NEW/USDT']) == ['BTC/USDT']
+    assert cache.is_unavailable('NEW/USDT')
+
+    cache.mark_unavailable('BTC/USDT', 'invalid symbol')
+    clock.now += 599
+    assert cache.filter(['BTC/USDT']) == []
+    clock.now += 1
+    assert not cache.is_unavailable('BTC/USDT') and 'BTC/USDT' not in cache.unavailable
+
+    # Пара появилась в листинге - снимается из негативного кэша при обновлении
+    async def listed():
+        return ['BTC/USDT', 'NEW/USDT']
+
+    cache.mark_unavailable('NEW/USDT')
+    clock.now += 60
+    asyncio.run(cache.get(listed))
+    assert cache.filter(['NEW/USDT']) == ['NEW/USDT']
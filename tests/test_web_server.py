@@ -0,0 +1,142 @@
+import asyncio
+import contextlib
+import json
+
+import pytest
+
+import push_protocol
+import web_server
+from benchmarks.synthetic import SyntheticConfig, generate
+from data_combiner import DataCombiner
+
+
+class FlaskSession:
+    """aiohttp-подобная сессия, которая отправляет POST в тестовый клиент Flask"""
+
+    def __init__(self, client):
+        self.client = client
+        self.sent = []
+
+    @contextlib.asynccontextmanager
+    async def post(self, url, data, headers):
+        response = self.client.post('/update_data', data=data, headers=headers)
+        self.sent.append((push_protocol.decode(data, headers['Content-Type']), response.status_code))
+        yield type('Response', (), {'status': response.status_code})()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(web_server, 'state', web_server.DashboardState())
+    monkeypatch.setattr(web_server, 'views', None)
+    monkeypatch.setattr(web_server, 'live', web_server.LiveUpdates())
+    return web_server.app.test_client()
+
+
+@pytest.fixture(scope='module')
+def latest(tmp_path_factory):
+    paths = generate(SyntheticConfig(markets=3, days=1), str(tmp_path_factory.mktemp('synthetic')))
+    combiner = DataCombiner()
+    combiner.update_indicators(combiner.combine_data(paths['coinbase'], paths['binance']))
+    return combiner._latest_rows()
+
+
+def test_delta_on_a_stale_base_seq_is_resynced_with_full_state(server, latest, monkeypatch):
+    combiner = DataCombiner()
+    session = FlaskSession(server)
+    combiner.session_manager = type('Manager', (), {'session': session})()
+
+    asyncio.run(combiner.send_to_web_service(latest))
+    coin = sorted(latest)[0]
+    changed = dict(latest, **{coin: dict(latest[coin], **{'Coinbase Premium %': 9.99})})
+    asyncio.run(combiner.send_to_web_service(changed))
+    assert [(message['seq'], message['base_seq'], message['full'], len(message['rows']), status)
+            for message, status in session.sent] == [(1, 0, True, 3, 200), (2, 1, False, 1, 200)]
+    assert web_server.state.seq == 2 and web_server.state.rows[coin]['Coinbase Premium %'] == 9.99
+
+    # Сервер перезапущен: дельта от seq 2 отклоняется (409), следом уходит полное состояние
+    monkeypatch.setattr(web_server, 'state', web_server.DashboardState())
+    removed = {key: row for key, row in changed.items() if key != coin}
+    asyncio.run(combiner.send_to_web_service(removed))
+    assert [(message['seq'], message['base_seq'], message['full'], status)
+            for message, status in session.sent[2:]] == [(3, 2, False, 409), (3, 2, True, 200)]
+    assert session.sent[2][0]['removed'] == [coin]
+    assert web_server.state.seq == 3 and set(web_server.state.rows) == set(removed)
+    assert combiner.push_seq == 3 and combiner.pushed_rows == removed
+
+
+def test_update_with_wrong_base_seq_returns_409(server, latest):
+    rows = list(latest.values())
+    body = push_protocol.encode(push_protocol.make_message(1, 0, rows, full=True))
+    assert server.post('/update_data', data=body, content_type=push_protocol.JSON).status_code == 200
+
+    stale = push_protocol.encode(push_protocol.make_message(5, 4, rows[:1]))
+    response = server.post('/update_data', data=stale, content_type=push_protocol.JSON)
+    assert response.status_code == 409 and response.get_json() == {'status': 'resync', 'seq': 1}
+    assert web_server.state.seq == 1
+
+    assert server.post('/update_data', data=b'x', content_type='text/plain').status_code == 415
+
+
+def test_matching_etag_gets_304_until_data_changes(server, latest):
+    rows = list(latest.values())
+    server.post('/update_data', data=push_protocol.encode(push_protocol.make_message(1, 0, rows, full=True)),
+                content_type=push_protocol.JSON)
+
+    for path in ('/', '/api/latest'):
+        first = server.get(path)
+        etag = first.headers['ETag']
+        assert first.status_code == 200 and first.data
+        cached = server.get(path, headers={'If-None-Match': etag})
+        assert cached.status_code == 304 and cached.data == b''
+        assert server.get(path, headers={'If-None-Match': '"other"'}).status_code == 200
+
+    etag = server.get('/api/latest').headers['ETag']
+    delta = push_protocol.make_message(2, 1, [dict(rows[0], **{'Coinbase Premium %': 9.99})])
+    server.post('/update_data', data=push_protocol.encode(delta), content_type=push_protocol.JSON)
+    # Новая версия данных - новый ETag и полный ответ
+    response = server.get('/api/latest', headers={'If-None-Match': etag})
+    assert response.status_code == 200 and response.headers['ETag'] != etag
+    assert response.get_json()['seq'] == 2
+
+
+def read_events(response, count):
+    """Первые count событий SSE (без retry и keepalive) - словари data"""
+    events = []
+    chunks = iter(response.response)
+    while len(events) < count:
+        chunk = next(chunks)
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        if chunk.startswith('id: '):
+            event_id, _, data = chunk.strip().split('\n')
+            events.append((int(event_id[len('id: '):]), json.loads(data[len('data: '):])))
+    return events
+
+
+def test_stream_replays_missed_events_or_sends_a_snapshot(server, latest):
+    rows = list(latest.values())
+    server.post('/update_data', data=push_protocol.encode(push_protocol.make_message(1, 0, rows, full=True)),
+                content_type=push_protocol.JSON)
+    version = web_server.state.version
+    delta = push_protocol.make_message(2, 1, [dict(rows[0], **{'Coinbase Premium %': 9.99})])
+    server.post('/update_data', data=push_protocol.encode(delta), content_type=push_protocol.JSON)
+
+    # Переподключение с известной версией: только пропущенная дельта
+    response = server.get('/api/stream', headers={'Last-Event-ID': str(version)}, buffered=False)
+    [(event_id, event)] = read_events(response, 1)
+    assert event_id == version + 1 and not event['full']
+    assert list(event['rows']) == [rows[0]['Coin']] and '9.99' in event['rows'][rows[0]['Coin']]
+
+    # Новое событие приходит подписчику без повторов
+    server.post('/update_data', data=push_protocol.encode(push_protocol.make_message(3, 2, [], [rows[1]['Coin']])),
+                content_type=push_protocol.JSON)
+    [(event_id, event)] = read_events(response, 1)
+    assert event_id == version + 2 and event['removed'] == [rows[1]['Coin']]
+    response.close()
+    assert web_server.live.stats()['subscribers'] == 0
+
+    # Версия не из этого процесса (или без since) - полный снимок
+    response = server.get('/api/stream?since=999', buffered=False)
+    [(event_id, event)] = read_events(response, 1)
+    assert event['full'] and event_id == web_server.state.version
+    assert set(event['rows']) == set(latest) - {rows[1]['Coin']}
+    response.close()
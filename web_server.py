@@ -1,9 +1,18 @@
-from flask import Flask, render_template, request, jsonify
+from flask import (Flask, render_template, request, jsonify, make_response, Response,
+                   get_template_attribute, stream_with_context)
 import pandas as pd
+import json
+import queue
 import threading
 import time
+import uuid
+from collections import deque
 from datetime import datetime
 import logging
+import numpy as np
+import push_protocol
+import metrics
+from premium_history import PremiumHistoryStore, DOWNSAMPLE_METHODS
 
 app = Flask(__name__)
 
@@ -13,35 +22,281 @@ logger = logging.getLogger(__name__)
 
 latest_data = None
 
+
+class DashboardState:
+    """
+    Состояние дашборда: последняя строка по каждой монете и номер последнего
+    применённого обновления (seq). Дельты применяются по ключу Coin; если base_seq
+    дельты не совпадает с текущим seq, клиент должен прислать полное состояние.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.seq = 0
+        self.frame = None  # DataFrame для рендера, пересобирается только после изменений
+        # Номер версии данных (растёт при каждом изменении) и время последнего обновления
+        self.version = 0
+        self.updated_at = None
+
+    def _changed(self):
+        self.frame = None
+        self.version += 1
+        self.updated_at = datetime.now()
+
+    def replace(self, rows, seq=None):
+        with self.lock:
+            self.rows = {row['Coin']: row for row in rows}
+            if seq is not None:
+                self.seq = seq
+            self._changed()
+
+    def apply(self, message):
+        """Применяет сообщение протокола; False - нужна полная пересинхронизация"""
+        with self.lock:
+            if not message.get('full') and message.get('base_seq') != self.seq:
+                return False
+            if message.get('full'):
+                self.rows = {}
+            for row in message.get('rows', []):
+                self.rows[row['Coin']] = row
+            for coin in message.get('removed', []):
+                self.rows.pop(coin, None)
+            self.seq = message['seq']
+            self._changed()
+            return True
+
+    def snapshot(self):
+        """(DataFrame, version, updated_at) текущего состояния"""
+        with self.lock:
+            if self.frame is None and self.rows:
+                # DateTime приходит строкой 'YYYY-MM-DD HH:MM': лексикографический порядок = хронологический
+                self.frame = (pd.DataFrame(list(self.rows.values()))
+                              .sort_values('DateTime', ascending=False, kind='mergesort'))
+            return self.frame, self.version, self.updated_at
+
+
+state = DashboardState()
+
+# История премии по монетам (пишет DataCombiner) для /api/history
+history = PremiumHistoryStore('premium_history')
+HISTORY_MAX_POINTS = 10000
+
+# Отрендеренные ответы текущей версии данных: строятся один раз на обновление,
+# а не на каждый GET. ETag включает идентификатор процесса, чтобы после
+# перезапуска сервера старые ETag клиентов не совпали с новыми данными.
+views_lock = threading.Lock()
+views = None
+instance_id = uuid.uuid4().hex[:8]
+
+
+class LiveUpdates:
+    """
+    Рассылка изменений дашборда подписчикам /api/stream (Server-Sent Events).
+
+    Каждое изменение состояния публикуется один раз уже отрендеренными строками
+    изменившихся монет; у каждого подписчика своя очередь. Последние события
+    хранятся в истории, чтобы переподключившийся клиент (Last-Event-ID) получил
+    только пропущенное; если история не покрывает разрыв, клиенту уходит полный снимок.
+    Отстающий клиент отключается и при переподключении догоняет тем же способом.
+    """
+
+    def __init__(self, history=256, max_pending=256, keepalive=15.0):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.history = deque(maxlen=history)
+        self.max_pending = max_pending
+        self.keepalive = keepalive
+        self.published = 0
+        self.dropped = 0
+
+    @staticmethod
+    def encode(event):
+        return f"id: {event['version']}\nevent: update\ndata: {json.dumps(event)}\n\n"
+
+    def publish(self, event):
+        message = (event['version'], self.encode(event))
+        with self.lock:
+            self.history.append(message)
+            self.published += 1
+            for subscriber in list(self.subscribers):
+                if subscriber.qsize() >= self.max_pending:
+                    self.subscribers.discard(subscriber)
+                    self.dropped += 1
+                    subscriber.put(None)
+                else:
+                    subscriber.put(message)
+
+    def subscribe(self, since):
+        """(очередь, пропущенные события); вместо событий None - нужен полный снимок"""
+        subscriber = queue.Queue()
+        with self.lock:
+            self.subscribers.add(subscriber)
+            if since is None:
+                return subscriber, None
+            missed = [message for message in self.history if message[0] > since]
+            if missed and missed[0][0] != since + 1:
+                return subscriber, None
+            if not missed and since != state.version:
+                # Версия из другого процесса (сервер перезапущен) или старше истории
+                return subscriber, None
+            return subscriber, missed
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def stats(self):
+        with self.lock:
+            return {'subscribers': len(self.subscribers), 'published': self.published,
+                    'dropped': self.dropped}
+
+
+live = LiveUpdates()
+# Изменение состояния и публикация события выполняются атомарно, чтобы версии событий шли по порядку
+updates_lock = threading.Lock()
+
+UPDATES = metrics.REGISTRY.counter('dashboard_updates_total', 'Updates received on /update_data', ['result'])
+
+
+def collect_stats():
+    metrics.export_stats('live_updates', live.stats())
+    metrics.export_stats('dashboard', {'coins': len(state.rows), 'version': state.version, 'seq': state.seq})
+
+
+metrics.REGISTRY.add_collector(collect_stats)
+
+
+def observe_dashboard_lag(rows):
+    """Задержка от закрытия самой свежей свечи в обновлении до его применения"""
+    times = [row['DateTime'] for row in rows if row.get('DateTime')]
+    if times:
+        metrics.observe_candle_lag('dashboard', max(pd.to_datetime(times)))
+
+
+def display_frame(frame):
+    """Строки в том виде, в котором они показываются на дашборде"""
+    display_data = frame.copy()
+    display_data['DateTime'] = pd.to_datetime(display_data['DateTime']).dt.strftime('%Y-%m-%d %H:%M')
+
+    # Округляем числовые колонки для лучшего отображения
+    numeric_columns = [
+        'Price @ Upbit', 'Price @ Binance', 
+    ]
+
+    for col in numeric_columns:
+        if col in display_data.columns:
+            display_data[col] = display_data[col].round(7)
+    return display_data
+
+
+def render_rows(frame):
+    """{Coin: HTML строки таблицы} - тот же шаблон, что и при полном рендере страницы"""
+    if frame is None or frame.empty:
+        return {}
+    render_row = get_template_attribute('_row.html', 'render_row')
+    return {row['Coin']: str(render_row(row)) for row in display_frame(frame).to_dict('records')}
+
+
+def build_views():
+    """HTML дашборда и JSON /api/latest для текущей версии (из кэша, если она не изменилась)"""
+    global views, latest_data
+    with views_lock:
+        if views is not None and views['version'] == state.version:
+            return views
+
+        frame, version, updated_at = state.snapshot()
+        if frame is None:
+            return None
+
+        with metrics.stage('render_dashboard', rows_in=len(frame)):
+            latest_data = frame
+            display_data = display_frame(frame)
+
+            last_update = updated_at.strftime('%Y-%m-%d %H:%M:%S')
+            html = render_template('data.html',
+                                   data=display_data.to_dict('records'),
+                                   last_update=last_update,
+                                   version=version)
+        api = (f'{{"seq": {state.seq}, "version": {version}, "last_update": "{last_update}", '
+               f'"rows": {display_data.to_json(orient="records")}}}')
+
+        views = {
+            'version': version,
+            'etag': f"{instance_id}-{version}",
+            'html': html.encode('utf-8'),
+            'json': api.encode('utf-8'),
+        }
+        logger.info(f"Rendered dashboard version {version} ({len(display_data)} coins)")
+        return views
+
+
+def publish_update(rows, removed=(), full=False):
+    """Отправляет подписчикам /api/stream изменившиеся строки (вызывается под updates_lock)"""
+    if full:
+        frame, version, updated_at = state.snapshot()
+    else:
+        frame = pd.DataFrame(rows) if rows else None
+        version, updated_at = state.version, state.updated_at
+    live.publish({
+        'version': version,
+        'last_update': updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+        'full': full,
+        'rows': render_rows(frame),
+        'removed': list(removed),
+    })
+
+
+def cached_response(body, etag, mimetype):
+    """Ответ с ETag; клиенту с актуальной версией (If-None-Match) уходит 304 без тела"""
+    response = make_response(body)
+    response.mimetype = mimetype
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
 @app.route('/update_data', methods=['POST'])
 def update_data_endpoint():
     try:
         logger.info("Received POST request on /update_data")
-        
-        # Проверяем тип данных
-        if isinstance(request.json, list):
-            data = request.json
-        elif isinstance(request.json, dict) and 'data' in request.json:
-            data = request.json['data']
+
+        content_type = (request.mimetype or push_protocol.JSON)
+        if content_type not in push_protocol.supported_formats():
+            return jsonify({"status": "error", "message": f"Unsupported content type {content_type}",
+                            "accept": push_protocol.supported_formats()}), 415
+        payload = push_protocol.decode(request.get_data(), content_type)
+
+        # Дельта-протокол: {"seq", "base_seq", "full", "rows", "removed"}
+        if isinstance(payload, dict) and 'seq' in payload:
+            with updates_lock, metrics.stage('apply_update', rows_in=len(payload.get('rows', []))):
+                if not state.apply(payload):
+                    logger.info(f"Version gap: state at {state.seq}, update based on {payload.get('base_seq')}")
+                    UPDATES.inc(result='resync')
+                    return jsonify({"status": "resync", "seq": state.seq}), 409
+                publish_update(payload.get('rows', []), payload.get('removed', []), bool(payload.get('full')))
+            UPDATES.inc(result='full' if payload.get('full') else 'delta')
+            observe_dashboard_lag(payload.get('rows', []))
+            logger.info(f"Applied {'full state' if payload.get('full') else 'delta'} #{payload['seq']} "
+                        f"with {len(payload.get('rows', []))} rows")
+            return jsonify({"status": "success", "seq": state.seq})
+
+        # Старый формат: полный список строк
+        if isinstance(payload, list):
+            data = payload
+        elif isinstance(payload, dict) and 'data' in payload:
+            data = payload['data']
         else:
             raise ValueError("Invalid JSON format: expected a list or dictionary with 'data' key.")
-        
+
         if data:
-            logger.info("Data received. Converting to DataFrame...")
-            
-            global latest_data
-            latest_data = pd.DataFrame(data)
-            
-            logger.debug(f"Raw DataFrame:\n{latest_data}")
-            
-            # Обработка данных
-            latest_data['DateTime'] = pd.to_datetime(latest_data['DateTime'])
-            latest_data = latest_data.sort_values('DateTime', ascending=False)
-            
-            logger.debug(f"Processed DataFrame:\n{latest_data}")
-            
+            with updates_lock, metrics.stage('apply_update', rows_in=len(data)):
+                state.replace(data)
+                publish_update(data, full=True)
+            UPDATES.inc(result='full')
+            observe_dashboard_lag(data)
             return jsonify({"status": "success"})
-        
+
         logger.warning("No data received in POST request.")
         return jsonify({"status": "error", "message": "No data received"}), 400
     except Exception as e:
@@ -50,35 +305,140 @@ def update_data_endpoint():
 
 @app.route('/')
 def index():
-    logger.info("GET request on /")
-    
-    if latest_data is None:
-        logger.info("No data available yet.")
-        return "Loading data... Please refresh in a few moments."
-    
+    logger.debug("GET request on /")
+
     try:
-        logger.info("Preparing data for rendering...")
-        display_data = latest_data.copy()
-        display_data['DateTime'] = display_data['DateTime'].dt.strftime('%Y-%m-%d %H:%M')
-        
-        # Округляем числовые колонки для лучшего отображения
-        numeric_columns = [
-            'Price @ Upbit', 'Price @ Binance', 
-        ]
-        
-        for col in numeric_columns:
-            if col in display_data.columns:
-                display_data[col] = display_data[col].round(7)
-        
-        data = display_data.to_dict('records')
-        logger.debug(f"Data passed to template:\n{data}")
-        
-        return render_template('data.html', 
-                               data=data, 
-                               last_update=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        current = build_views()
+        if current is None:
+            logger.info("No data available yet.")
+            return "Loading data... Please refresh in a few moments."
+        return cached_response(current['html'], current['etag'], 'text/html')
     except Exception as e:
         logger.error(f"Error in index route: {str(e)}", exc_info=True)
         return f"Error processing data: {str(e)}"
 
+@app.route('/api/latest')
+def api_latest():
+    """Последняя строка по каждой монете в JSON (тот же снимок, что и на дашборде)"""
+    try:
+        current = build_views()
+        if current is None:
+            return jsonify({"status": "error", "message": "No data available yet"}), 503
+        return cached_response(current['json'], current['etag'], 'application/json')
+    except Exception as e:
+        logger.error(f"Error in /api/latest: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/api/stream')
+def api_stream():
+    """
+    Server-Sent Events: событие update с отрендеренными строками изменившихся монет.
+    Клиент передаёт известную ему версию (since или Last-Event-ID при переподключении).
+    """
+    try:
+        since = int(request.headers.get('Last-Event-ID') or request.args.get('since', ''))
+    except ValueError:
+        since = None
+    subscriber, missed = live.subscribe(since)
+    logger.info(f"Stream subscriber connected (since={since}, catch-up: "
+                f"{'snapshot' if missed is None else len(missed)})")
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            sent = since if since is not None else 0
+            if missed is None:
+                frame, version, updated_at = state.snapshot()
+                if frame is not None:
+                    yield live.encode({'version': version,
+                                       'last_update': updated_at.strftime('%Y-%m-%d %H:%M:%S'),
+                                       'full': True, 'rows': render_rows(frame), 'removed': []})
+                sent = version
+            else:
+                for version, message in missed:
+                    yield message
+                    sent = version
+
+            while True:
+                try:
+                    item = subscriber.get(timeout=live.keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    logger.warning("Stream subscriber is too slow, disconnecting")
+                    return
+                version, message = item
+                # События, уже вошедшие в снимок или догрузку, не повторяем
+                if version > sent:
+                    yield message
+                    sent = version
+        finally:
+            live.unsubscribe(subscriber)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def parse_time(value):
+    """ISO-время или unix-время в секундах"""
+    if value is None or value == '':
+        return None
+    try:
+        return pd.Timestamp(float(value), unit='s', tz='UTC')
+    except ValueError:
+        ts = pd.Timestamp(value)
+        return ts.tz_localize('UTC') if ts.tz is None else ts.tz_convert('UTC')
+
+
+@app.route('/api/history')
+def api_history():
+    """
+    Ряды премии, цен и объёмов монеты за период, прореженные на сервере до points точек:
+    /api/history?coin=BTCUSDT&from=2024-01-01&to=2024-12-31&points=1000&method=lttb
+    """
+    coin = request.args.get('coin')
+    if not coin:
+        return jsonify({"status": "error", "message": "coin is required"}), 400
+    try:
+        start = parse_time(request.args.get('from'))
+        end = parse_time(request.args.get('to'))
+        points = int(request.args.get('points', 1000))
+        method = request.args.get('method', 'lttb')
+        if not 2 <= points <= HISTORY_MAX_POINTS:
+            raise ValueError(f"points must be between 2 and {HISTORY_MAX_POINTS}")
+        if method not in DOWNSAMPLE_METHODS:
+            raise ValueError(f"method must be one of {', '.join(DOWNSAMPLE_METHODS)}")
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    try:
+        result = history.query(coin, start, end, points, method)
+        if result is None:
+            return jsonify({"status": "error", "message": f"No history for {coin}"}), 404
+
+        # Колонки массивами (время - мс), NaN -> null
+        series = {name: (values.tolist() if values.dtype == np.int64
+                         else np.where(np.isnan(values), None, values).tolist())
+                  for name, values in result['series'].items()}
+        return jsonify({
+            "coin": coin,
+            "from": start.isoformat() if start is not None else None,
+            "to": end.isoformat() if end is not None else None,
+            "method": method,
+            "tier": result['tier'],
+            "total": result['total'],
+            "points": len(series['time']),
+            "series": series,
+        })
+    except Exception as e:
+        logger.error(f"Error in /api/history: {str(e)}", exc_info=True)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики веб-сервера в текстовом формате Prometheus"""
+    return Response(metrics.REGISTRY.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
 if __name__ == "__main__":
     app.run(host='localhost', port=5000, debug=True)
\ No newline at end of file